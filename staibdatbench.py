@@ -0,0 +1,273 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks the StaibDat class.
+
+These benchmarks time the cold import of the package, the construction of
+StaibDat objects with each engine, the internal phases of parsing, smoothing
+and differentiation, energy windows and resampling, and batch loading, and
+measure the peak memory of construction. They run against
+synthetic winspectro files whose number of data points, channels and
+metadata lines can be scaled. The results can be written as JSON and
+compared against the results of an earlier run, e.g.:
+  python staibdatbench.py --output before.json
+  (make a change)
+  python staibdatbench.py --compare before.json
+"""
+
+from tfan_parsers import StaibDat
+from tfan_parsers import ParseStats
+from tfan_parsers import load_many
+from tfan_parsers import Analysis
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+import numpy
+
+def generate(filename, points = 807, channels = 2, metadata = 0, technique = "AES", seed = 0):
+  """
+  Write a synthetic, self-consistent winspectro .dat file.
+
+  The file has the metadata of testfiles/good_data.dat followed by metadata
+  extra metadata lines, and points lines of data with channels channels of
+  counts: a few Gaussian peaks on a sloping background with Poisson noise.
+  """
+
+  random = numpy.random.RandomState(seed)
+  startmV = 199969
+  stepmV = 496
+  basis = startmV + stepmV * numpy.arange(points)
+  energy = basis / 1000.
+  counts = numpy.zeros((points, channels), dtype = int)
+  for channel in range(channels):
+    signal = 150000 - 100 * (energy - energy[0])
+    for center in random.uniform(energy[0], energy[-1], 3):
+      signal += random.uniform(1e4, 5e4) * numpy.exp(-(energy - center) ** 2 / 20)
+    counts[:, channel] = random.poisson(numpy.maximum(signal, 0))
+
+  lines = [("Version", "2.1"),
+           ("Spektrum-Type", "Auger"),
+           ("Technique", technique),
+           ("SourceLabel", "egun"),
+           ("SourceEnergy", "0.000000"),
+           ("Mode", "Pulse"),
+           ("Channels", "%d" % channels),
+           ("Samples", "13"),
+           ("Startenergy[V]", "%f" % (basis[0] / 1000.)),
+           ("Stopenergy [V]", "%f" % (basis[-1] / 1000.)),
+           ("Stepwidth", "%f" % (stepmV / 1000.)),
+           ("ResolutionMode", "dE/E=const."),
+           ("Resolution [%]", "0.100000"),
+           ("Data Points", "%d" % points),
+           ("Scan-Number", "1"),
+           ("Dwell Time", "100"),
+           ("Retrace Time", "3000")]
+  lines += [("Extra %d" % indx, "value %d" % indx) for indx in range(metadata)]
+  lines += [("DescriptionLen", "0"),
+            ("Date and time", "Mon Feb 08 13:49:52 2010")]
+
+  datFile = open(filename,"w")
+  for key, value in lines:
+    datFile.write("%-14s:    %s\r\n" % (key, value))
+  datFile.write("reserved\r\n" * 4)
+  datFile.write(" Basis[mV]" + "".join(["  Channel_%d" % (channel + 1) for channel in range(channels)]) + "\r\n")
+  for row in range(points):
+    datFile.write("%10d" % basis[row] + "".join(["%11d" % value for value in counts[row]]) + "\r\n")
+  datFile.close()
+
+def best(function, repeat):
+  """
+  Returns the best and mean time in seconds of repeat calls of function.
+  """
+
+  times = []
+  for indx in range(repeat):
+    start = timeit.default_timer()
+    function()
+    times.append(timeit.default_timer() - start)
+  return {"best":min(times), "mean":sum(times) / len(times)}
+
+def phases(filename, engine, repeat):
+  """
+  Returns the timings of the internal phases of constructing a StaibDat object.
+
+  The object is constructed repeat times with a ParseStats object, which
+  times each phase the way StaibDat runs it; see ParseStats for the phases
+  of each engine. The best and mean of each phase are returned.
+  """
+
+  records = []
+  stats = ParseStats(records.append)
+  for indx in range(repeat):
+    StaibDat(filename, engine = engine, stats = stats)
+
+  times = {}
+  for record in records:
+    for phase in record.phases:
+      times.setdefault(phase.phase, []).append(phase.seconds)
+  return dict([(phase, {"best":min(values), "mean":sum(values) / len(values)}) for phase, values in times.items()])
+
+def memory(filename, engine, compact):
+  """
+  Returns the peak resident memory in kB of constructing a StaibDat object.
+
+  The object is constructed in a fresh interpreter, so that the peak isn't
+  hidden by whatever the benchmark did before. The peak before (after
+  importing) and after the construction are returned, as well as the
+  difference, which is what the report shows.
+  """
+
+  output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--memory-child", filename, engine, str(int(compact))], cwd = os.path.dirname(os.path.abspath(__file__)))
+  return json.loads(output.decode("utf-8"))
+
+def importtime(statement, repeat):
+  """
+  Returns the best and mean time in seconds of running statement in a fresh interpreter.
+
+  Only the statement is timed, not the start of the interpreter, so that
+  statement = "import tfan_parsers" gives the cost of a cold import.
+  """
+
+  script = "import timeit\nstart = timeit.default_timer()\n%s\nprint(timeit.default_timer() - start)" % statement
+  times = []
+  for indx in range(repeat):
+    output = subprocess.check_output([sys.executable, "-c", script], cwd = os.path.dirname(os.path.abspath(__file__)))
+    times.append(float(output.decode("utf-8").split()[-1]))
+  return {"best":min(times), "mean":sum(times) / len(times)}
+
+def _maxrss():
+  """
+  Returns the peak resident memory of this process in kB.
+  """
+
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == "darwin":
+    maxrss //= 1024
+  return maxrss
+
+def run(points = 807, channels = 2, metadata = 0, repeat = 5, files = 32, workers = None, engines = ("fast", "pyparsing", "mmap")):
+  """
+  Run every benchmark and return the results as a dictionary.
+
+  Timings are in seconds and memory in kB. The keys of "results" name the
+  benchmark, e.g. "construct.fast" or "phase.pyparsing.label".
+  """
+
+  directory = tempfile.mkdtemp()
+  try:
+    filename = os.path.join(directory, "synthetic.dat")
+    generate(filename, points, channels, metadata)
+    results = {}
+
+    results["import.package"] = importtime("import tfan_parsers", repeat)
+    results["import.header"] = importtime("import tfan_parsers\ntfan_parsers.read_header(%r)" % filename, repeat)
+    results["import.staibdat"] = importtime("from tfan_parsers import StaibDat", repeat)
+
+    for engine in engines:
+      for compact in (False, True):
+        name = "construct.%s%s" % (engine, ".compact" if compact else "")
+        results[name] = best(lambda: StaibDat(filename, engine = engine, compact = compact), repeat)
+        results["memory.%s%s" % (engine, ".compact" if compact else "")] = memory(filename, engine, compact)
+    for engine in engines:
+      for phase, timing in phases(filename, engine, repeat).items():
+        results["phase.%s.%s" % (engine, phase)] = timing
+
+    SD = StaibDat(filename, compact = True)
+    for mode in ("zero", "interp"):
+      results["smooth.%s" % mode] = best(lambda: SD.smooth("C1", mode = mode), repeat)
+      results["differentiate.%s" % mode] = best(lambda: SD.differentiate("C1", mode = mode), repeat)
+    results["smooth.allchannels"] = best(lambda: SD.smooth(SD.channelkeys()), repeat)
+
+    # Windows and resampling, with one energy axis per spectrum as spectra from different sessions have.
+    middle = numpy.median(SD["BE"])
+    results["window"] = best(lambda: SD.window(middle - 10, middle + 10), repeat)
+    energies = [SD["KE"] + 0.001 * indx for indx in range(files)]
+    counts = [SD["C1"]] * files
+    grid = numpy.linspace(SD["KE"][1], SD["KE"][-2], points)
+    results["resample.axes"] = best(lambda: Analysis.resample(energies, counts, grid), repeat)
+    results["resample.shared"] = best(lambda: Analysis.resample(SD["KE"], counts, grid), repeat)
+
+    paths = []
+    for indx in range(files):
+      paths.append(os.path.join(directory, "batch%03d.dat" % indx))
+      generate(paths[-1], points, channels, metadata, seed = indx)
+    results["batch.serial"] = best(lambda: list(load_many(paths, workers = 1)), repeat)
+    results["batch.pool"] = best(lambda: list(load_many(paths, workers = workers, chunksize = 4)), repeat)
+  finally:
+    shutil.rmtree(directory)
+
+  return {"environment":{"python":platform.python_version(),
+                         "numpy":numpy.__version__,
+                         "platform":platform.platform(),
+                         "cpus":os.sysconf("SC_NPROCESSORS_ONLN") if hasattr(os, "sysconf") else None},
+          "parameters":{"points":points, "channels":channels, "metadata":metadata,
+                        "repeat":repeat, "files":files, "workers":workers},
+          "results":results}
+
+def report(results, baseline = None):
+  """
+  Returns a table of the results as text, with ratios to a baseline if given.
+
+  A ratio above 1 means the benchmark got slower, or used more memory.
+  """
+
+  lines = []
+  for name in sorted(results["results"]):
+    result = results["results"][name]
+    if "best" in result:
+      value, unit, field = result["best"] * 1000, "ms", "best"
+    else:
+      value, unit, field = result["delta"], "kB", "delta"
+    line = "%-36s %12.3f %s" % (name, value, unit)
+    if baseline is not None and name in baseline["results"] and baseline["results"][name].get(field):
+      line += "   x%.2f" % (result[field] / float(baseline["results"][name][field]))
+    lines.append(line)
+  return "\n".join(lines)
+
+def main(arguments = None):
+  """
+  Command line interface; see --help.
+  """
+
+  parser = argparse.ArgumentParser(description = "Benchmark StaibDat parsing and analysis.")
+  parser.add_argument("--points", type = int, default = 807, help = "data points per file")
+  parser.add_argument("--channels", type = int, default = 2, help = "channels per file")
+  parser.add_argument("--metadata", type = int, default = 0, help = "extra metadata lines per file")
+  parser.add_argument("--repeat", type = int, default = 5, help = "repetitions of each timing; the best is reported")
+  parser.add_argument("--files", type = int, default = 32, help = "files in the batch loading benchmark")
+  parser.add_argument("--workers", type = int, default = None, help = "processes for batch loading")
+  parser.add_argument("--output", help = "write the results as JSON to this file")
+  parser.add_argument("--compare", help = "JSON results of an earlier run to compare against")
+  parser.add_argument("--memory-child", nargs = 3, help = argparse.SUPPRESS)
+  arguments = parser.parse_args(arguments)
+
+  if arguments.memory_child:
+    filename, engine, compact = arguments.memory_child
+    before = _maxrss()
+    StaibDat(filename, engine = engine, compact = bool(int(compact)))
+    peak = _maxrss()
+    sys.stdout.write(json.dumps({"before":before, "peak":peak, "delta":peak - before}))
+    return
+
+  results = run(arguments.points, arguments.channels, arguments.metadata, arguments.repeat, arguments.files, arguments.workers)
+  baseline = None
+  if arguments.compare:
+    compareFile = open(arguments.compare,"r")
+    baseline = json.load(compareFile)
+    compareFile.close()
+  print(report(results, baseline))
+  if arguments.output:
+    outputFile = open(arguments.output,"w")
+    json.dump(results, outputFile, indent = 1, sort_keys = True)
+    outputFile.close()
+
+if __name__ == '__main__':
+  main()
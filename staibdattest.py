@@ -12,11 +12,64 @@ can figure out if the imported file is not self-consistent.
 
 from tfan_parsers import StaibDat
 from tfan_parsers import FormatError
+from tfan_parsers import StaibGrammar
+from tfan_parsers import Analysis
+from tfan_parsers import load_many
+from tfan_parsers import ParseCache
+from tfan_parsers import StaibStack
+from tfan_parsers import MetadataIndex
+from tfan_parsers import read_header
+from tfan_parsers import MappedDat
+from tfan_parsers import save_npz
+from tfan_parsers import load_npz
+from tfan_parsers import ParseStats
+from tfan_parsers import TailingDat
+from tfan_parsers import open_dat
+from tfan_parsers import iter_archive
+import staibdatbench
+import pickle
+import json
 import unittest
 import random
 import os
+import io
+import glob
+import shutil
+import tempfile
+import zipfile
+import tarfile
+import gzip
+import bz2
+import threading
+import time
+import subprocess
+import sys
 import numpy
 
+# The asynchronous API needs asyncio, which is only available on python 3.
+try:
+  import asyncio
+  import concurrent.futures
+  from tfan_parsers import AsyncLoader
+except ImportError:
+  asyncio = None
+
+# .xz files need lzma, which is only available on python 3.3 and later.
+try:
+  import lzma
+except ImportError:
+  lzma = None
+
+# Shared memory is only available on python 3.8 and later.
+try:
+  from tfan_parsers import SharedDat
+  import multiprocessing
+except ImportError:
+  SharedDat = None
+
+# numpy 2.0 renamed trapz to trapezoid, and later releases dropped trapz.
+trapezoid = getattr(numpy, "trapezoid", None) or numpy.trapz
+
 class InvalidDataFile(unittest.TestCase):
   """
   Tests instantiation with invalid data files.
@@ -109,7 +162,22 @@ class InvalidDataFile(unittest.TestCase):
       counter = counter+1
     newfile.close()
     self.assertRaises(FormatError,StaibDat,"testfiles/data_spurious_line.dat")
-  
+
+  def testStaibDatMalformedDataLine(self):
+    """A data line that doesn't parse should raise FormatError with either engine."""
+    gd = open("testfiles/good_data.dat","r")
+    gdLines = gd.readlines()
+    gd.close()
+    gdLines[100] = "x " + gdLines[100]
+    newfile = open("testfiles/malformed_data_line.dat","w")
+    newfile.writelines(gdLines)
+    newfile.close()
+    try:
+      for engine in ("fast", "pyparsing"):
+        self.assertRaises(FormatError,StaibDat,"testfiles/malformed_data_line.dat",engine = engine)
+    finally:
+      os.remove("testfiles/malformed_data_line.dat")
+
   def testStaibDatAdditionalStuffAtEnd(self):
     """Otherwise valid file has extra crap at end."""
     self.assertRaises(FormatError,StaibDat,"testfiles/additional_stuff_at_end.dat")
@@ -157,6 +225,1742 @@ class CorrectlyImportedData(unittest.TestCase):
   """
   pass
   
+class EngineAgreement(unittest.TestCase):
+  """
+  Tests that the fast engine and the pyparsing engine give identical results.
+  """
+
+  def assertSameResult(self, filename):
+    """Both engines should raise the same exception or return equal objects."""
+    results = []
+    for engine in ("fast", "pyparsing"):
+      try:
+        results.append(StaibDat(filename, engine = engine))
+      except Exception as error:
+        results.append(type(error))
+    fast, oracle = results
+    if not isinstance(oracle, StaibDat):
+      self.assertEqual(fast, oracle)
+      return
+    self.assertTrue(isinstance(fast, StaibDat))
+    self.assertEqual(sorted(fast.keys()), sorted(oracle.keys()))
+    for key in oracle:
+      if isinstance(oracle[key], numpy.ndarray):
+        self.assertTrue(numpy.array_equal(fast[key], oracle[key]))
+      else:
+        self.assertEqual(fast[key], oracle[key])
+
+  def testStaibDatEnginesAgreeOnTestfiles(self):
+    """Every file in testfiles should give identical results with either engine."""
+    for filename in sorted(os.listdir("testfiles")):
+      if filename.endswith(".dat"):
+        self.assertSameResult(os.path.join("testfiles", filename))
+
+  def testStaibDatEnginesAgreeOnOddWhitespace(self):
+    """Lines the fast engine doesn't recognize should fall back to pyparsing."""
+    gd = open("testfiles/good_data.dat","r")
+    gdLines = gd.readlines()
+    gd.close()
+    gdLines[0] = "Version:    2.1  (beta)\n"
+    gdLines[30] = "  203443     150185   26\n"
+    newfile = open("testfiles/odd_whitespace.dat","w")
+    newfile.writelines(gdLines)
+    newfile.close()
+    try:
+      self.assertSameResult("testfiles/odd_whitespace.dat")
+    finally:
+      os.remove("testfiles/odd_whitespace.dat")
+
+  def testStaibDatInvalidEngine(self):
+    """An unknown engine name should raise ValueError."""
+    self.assertRaises(ValueError,StaibDat,"testfiles/good_data.dat",engine = "bogus")
+
+class CustomGrammar(unittest.TestCase):
+  """
+  Tests StaibDat with a grammar for a different winspectro variant.
+  """
+
+  def setUp(self):
+    gd = open("testfiles/good_data.dat","r")
+    gdText = gd.read()
+    gd.close()
+    newfile = open("testfiles/equals_delimiter.dat","w")
+    newfile.write(gdText.replace(":    "," = "))
+    newfile.close()
+    self.grammar = StaibGrammar(equalsdelimiter = "=")
+
+  def tearDown(self):
+    os.remove("testfiles/equals_delimiter.dat")
+
+  def testStaibDatCustomGrammar(self):
+    """A file in a variant format should import with a matching grammar."""
+    reference = StaibDat("testfiles/good_data.dat")
+    for engine in ("fast", "pyparsing"):
+      SD = StaibDat("testfiles/equals_delimiter.dat", engine = engine, grammar = self.grammar)
+      self.assertEqual(SD["Dateandtime"],reference["Dateandtime"])
+      self.assertEqual(SD["Startenergy"],reference["Startenergy"])
+      self.assertTrue(all(SD["C1"] == reference["C1"]))
+
+  def testStaibDatDefaultGrammarRejectsVariant(self):
+    """The default grammar should not accept the variant format."""
+    self.assertRaises(FormatError,StaibDat,"testfiles/equals_delimiter.dat")
+
+  def testStaibGrammarImmutable(self):
+    """A StaibGrammar can't be modified once built."""
+    self.assertRaises(AttributeError,setattr,self.grammar,"metadata",None)
+
+class StreamingImport(unittest.TestCase):
+  """
+  Tests instantiation from iterables of lines instead of a filename.
+  """
+
+  filename = "testfiles/good_data.dat"
+
+  def setUp(self):
+    self.reference = StaibDat(self.filename)
+    gd = open(self.filename,"rb")
+    self.gdBytes = gd.read()
+    gd.close()
+
+  def assertSameData(self, SD):
+    for key in ("DataPoints","Startenergy","Dateandtime","Basis","Channel_1","Channel_2"):
+      self.assertEqual(SD[key],self.reference[key])
+    for key in ("KE","BE","C1","C2"):
+      self.assertTrue(all(SD[key] == self.reference[key]))
+
+  def testStaibDatOpenFile(self):
+    """An open file should import like its filename, named after the file."""
+    datFile = open(self.filename,"r")
+    SD = StaibDat(datFile)
+    datFile.close()
+    self.assertSameData(SD)
+    self.assertEqual(SD["filename"],self.filename)
+
+  def testStaibDatBytesIO(self):
+    """A BytesIO should import without a filename."""
+    SD = StaibDat(io.BytesIO(self.gdBytes))
+    self.assertSameData(SD)
+    self.assertEqual(SD["filename"],None)
+
+  def testStaibDatZipMember(self):
+    """A member of a zip archive should import without extracting it."""
+    buf = io.BytesIO()
+    archive = zipfile.ZipFile(buf,"w")
+    archive.writestr("good_data.dat",self.gdBytes)
+    archive.close()
+    archive = zipfile.ZipFile(buf)
+    member = archive.open("good_data.dat")
+    SD = StaibDat(member)
+    member.close()
+    self.assertSameData(SD)
+
+  def testStaibDatSinglePass(self):
+    """The lines should only be iterated over once."""
+    SD = StaibDat(iter(self.gdBytes.splitlines(True)))
+    self.assertSameData(SD)
+
+  def testStaibDatStreamNoFileText(self):
+    """fileText should only be kept for a stream if asked for."""
+    self.assertFalse("fileText" in StaibDat(io.BytesIO(self.gdBytes)))
+    SD = StaibDat(io.BytesIO(self.gdBytes), keepText = True)
+    self.assertEqual(SD["fileText"],self.gdBytes.decode("latin-1").splitlines(True))
+
+  def testStaibDatStreamInvalid(self):
+    """An invalid stream should raise FormatError."""
+    self.assertRaises(FormatError,StaibDat,io.BytesIO(self.gdBytes[:200]))
+
+class CompactMode(unittest.TestCase):
+  """
+  Tests the memory saving compact mode.
+  """
+
+  filename = "testfiles/good_data.dat"
+
+  def testStaibDatCompactSameData(self):
+    """Compact mode should hold the same data as the default mode."""
+    reference = StaibDat(self.filename)
+    for engine in ("fast", "pyparsing"):
+      SD = StaibDat(self.filename, engine = engine, compact = True)
+      for key in ("Basis","Channel_1","Channel_2"):
+        self.assertEqual(SD[key]["unit"],reference[key]["unit"])
+        self.assertEqual(list(SD[key]["value"]),reference[key]["value"])
+      for key in ("KE","BE","C1","C2"):
+        self.assertTrue(all(SD[key] == reference[key]))
+
+  def testStaibDatCompactValueIsView(self):
+    """Compact values should be contiguous views shared with the Cn arrays."""
+    SD = StaibDat(self.filename, compact = True)
+    self.assertEqual(type(SD["Channel_1"]["value"]),numpy.ndarray)
+    self.assertTrue(SD["Channel_1"]["value"].flags["C_CONTIGUOUS"])
+    self.assertTrue(SD["C1"] is SD["Channel_1"]["value"])
+    self.assertTrue(SD["Basis"]["value"].base is SD["Channel_2"]["value"].base)
+
+  def testStaibDatCompactLazyfileText(self):
+    """fileText should be re-read from the file on first access."""
+    SD = StaibDat(self.filename, compact = True)
+    self.assertTrue("fileText" in SD)
+    datFile = open(self.filename,"r")
+    fileTextList = datFile.readlines()
+    datFile.close()
+    self.assertEqual(SD["fileText"],fileTextList)
+    self.assertEqual(dict(SD.items())["fileText"],fileTextList)
+
+  def testStaibDatCompactStreamNofileText(self):
+    """fileText can't be re-read for a stream, so it should be dropped."""
+    datFile = open(self.filename,"rb")
+    SD = StaibDat(io.BytesIO(datFile.read()), compact = True)
+    datFile.close()
+    self.assertFalse("fileText" in SD)
+
+class SavitzkyGolay(unittest.TestCase):
+  """
+  Tests the vectorized Savitzky-Golay engine.
+  """
+
+  filename = "testfiles/good_data.dat"
+
+  def referencesavgol(self, data, kernel, order, deriv):
+    """The original pure-Python Savitzky-Golay loop."""
+    half_window = (kernel -1) // 2
+    b = numpy.array([[k**i for i in range(order+1)] for k in range(-half_window, half_window+1)])
+    m = numpy.linalg.pinv(b)[deriv]
+    data = numpy.concatenate((numpy.zeros(half_window), data, numpy.zeros(half_window)))
+    smooth_data = []
+    for i in range(half_window, len(data) - half_window):
+      value = 0.0
+      for offset, weight in zip(range(-half_window, half_window+1), m):
+        value += weight * data[i + offset]
+      smooth_data.append(value)
+    return numpy.array(smooth_data)
+
+  def testSavitzkyGolayMatchesReference(self):
+    """smooth and differentiate should match the original implementation."""
+    SD = StaibDat(self.filename)
+    for kernel, order in ((13, 3), (5, 2), (21, 4)):
+      self.assertTrue(numpy.allclose(SD.smooth("C1", kernel, order), self.referencesavgol(SD["C1"], kernel, order, 0)))
+      self.assertTrue(numpy.allclose(SD.differentiate("C1", kernel, order), self.referencesavgol(SD["C1"], kernel, order, 1)))
+
+  def testSavitzkyGolayStack(self):
+    """A list of keys should be smoothed row by row in one call."""
+    SD = StaibDat(self.filename)
+    stack = SD.smooth(SD.channelkeys())
+    self.assertEqual(stack.shape,(2,SD["DataPoints"]))
+    self.assertTrue(numpy.allclose(stack[0],SD.smooth("C1")))
+    self.assertTrue(numpy.allclose(stack[1],SD.smooth("C2")))
+    self.assertTrue(numpy.allclose(SD.differentiate(numpy.array([SD["C1"]] * 3))[2],SD.differentiate("C1")))
+
+  def testSavitzkyGolayInterpEdges(self):
+    """The interp edge mode should reproduce a polynomial of the filter's order everywhere."""
+    x = numpy.linspace(-2, 3, 50)
+    y = 2 * x ** 3 - x ** 2 + 5
+    self.assertTrue(numpy.allclose(Analysis.savitzky_golay(y, 9, 3, mode = "interp"), y))
+    dx = x[1] - x[0]
+    self.assertTrue(numpy.allclose(Analysis.savitzky_golay(y, 9, 3, deriv = 1, mode = "interp") / dx, 6 * x ** 2 - 2 * x))
+
+  def testSavitzkyGolayCachedCoefficients(self):
+    """Coefficients should only be computed once per kernel, order and deriv."""
+    self.assertTrue(Analysis.savgol_coeffs(13, 3, 0) is Analysis.savgol_coeffs(13, 3, 0))
+
+  def testSavitzkyGolayInvalidKernel(self):
+    """An even kernel should raise TypeError."""
+    SD = StaibDat(self.filename)
+    self.assertRaises(TypeError,SD.smooth,"C1",12)
+
+class BatchLoading(unittest.TestCase):
+  """
+  Tests loading many files at once with load_many.
+  """
+
+  filenames = ["testfiles/good_data.dat", "testfiles/junkdata.dat", "testfiles/good_data.dat", "testfiles/incorrect_stepwidth.dat", "testfiles/no_such_file.dat"]
+
+  def assertBatch(self, results):
+    self.assertEqual([result.filename for result in results],self.filenames)
+    self.assertTrue(isinstance(results[0].data, StaibDat))
+    self.assertTrue(all(results[2].data["C1"] == StaibDat(self.filenames[2])["C1"]))
+    for indx in (1, 3):
+      self.assertEqual(results[indx].data,None)
+      self.assertTrue(isinstance(results[indx].error, FormatError))
+    self.assertTrue(isinstance(results[4].error, EnvironmentError))
+
+  def testLoadManySerial(self):
+    """Failures should be collected per file when loading in-process."""
+    self.assertBatch(list(load_many(self.filenames, workers = 1)))
+
+  def testLoadManyPool(self):
+    """A process pool should give the same results in input order."""
+    self.assertBatch(list(load_many(self.filenames, workers = 2, compact = True)))
+
+  def testLoadManyGlob(self):
+    """A glob pattern should be expanded in sorted order."""
+    results = list(load_many("testfiles/incorrect_*.dat", workers = 2))
+    self.assertEqual([result.filename for result in results],sorted(glob.glob("testfiles/incorrect_*.dat")))
+    self.assertTrue(all(isinstance(result.error, FormatError) for result in results))
+
+  def testLoadManyOtherErrors(self):
+    """A file failing with any exception should be collected, not abort the batch."""
+    gd = open("testfiles/good_data.dat","r")
+    gdLines = gd.readlines()
+    gd.close()
+    del gdLines[10]
+    newfile = open("testfiles/missing_stepwidth.dat","w")
+    newfile.writelines(gdLines)
+    newfile.close()
+    try:
+      for workers in (1, 2):
+        results = list(load_many(["testfiles/missing_stepwidth.dat", "testfiles/good_data.dat"], workers = workers))
+        self.assertEqual(results[0].data,None)
+        self.assertTrue(isinstance(results[0].error, Exception))
+        self.assertTrue(isinstance(results[1].data, StaibDat))
+    finally:
+      os.remove("testfiles/missing_stepwidth.dat")
+
+  def testStaibDatPickle(self):
+    """A StaibDat object should survive pickling."""
+    for compact in (False, True):
+      SD = StaibDat("testfiles/good_data.dat", compact = compact)
+      copy = pickle.loads(pickle.dumps(SD, 2))
+      self.assertTrue(all(copy["C1"] == SD["C1"]))
+      self.assertEqual(copy["fileText"],SD["fileText"])
+
+class ParseCacheTest(unittest.TestCase):
+  """
+  Tests the persistent on-disk parse cache.
+  """
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.cache = ParseCache(os.path.join(self.directory, "cache"))
+    self.filename = os.path.join(self.directory, "good_data.dat")
+    shutil.copy("testfiles/good_data.dat", self.filename)
+    # Whole seconds, so that setting the time again gives back exactly the same value.
+    os.utime(self.filename, (1000000000, 1000000000))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def rewrite(self, old, new, mtime):
+    """Replace text in the source file and set its modification time."""
+    datFile = open(self.filename,"rb")
+    text = datFile.read()
+    datFile.close()
+    datFile = open(self.filename,"wb")
+    datFile.write(text.replace(old.encode("ascii"), new.encode("ascii"), 1))
+    datFile.close()
+    os.utime(self.filename, (mtime, mtime))
+
+  def testParseCacheSameData(self):
+    """Loading through the cache should give the same data as parsing."""
+    reference = StaibDat(self.filename)
+    for SD in (self.cache.load(self.filename), self.cache.load(self.filename), self.cache.load(self.filename, compact = True)):
+      self.assertEqual(SD["Startenergy"],reference["Startenergy"])
+      self.assertEqual(list(SD["Channel_1"]["value"]),reference["Channel_1"]["value"])
+      self.assertTrue(all(SD["BE"] == reference["BE"]))
+      self.assertEqual(SD["fileText"],reference["fileText"])
+
+  def testParseCacheHit(self):
+    """An unchanged size and mtime should be served from the cache."""
+    mtime = os.path.getmtime(self.filename)
+    self.cache.load(self.filename)
+    self.rewrite("152061", "152062", mtime)
+    self.assertEqual(self.cache.load(self.filename)["C1"][0],152061)
+
+  def testParseCacheInvalidation(self):
+    """A changed content should be parsed again."""
+    mtime = os.path.getmtime(self.filename)
+    self.cache.load(self.filename)
+    self.rewrite("152061", "152062", mtime + 10)
+    self.assertEqual(self.cache.load(self.filename)["C1"][0],152062)
+    self.rewrite("152062", "1520620", mtime + 20)
+    self.assertEqual(self.cache.load(self.filename)["C1"][0],1520620)
+
+  def testParseCacheEviction(self):
+    """The least recently used entries should be evicted to respect maxBytes."""
+    other = os.path.join(self.directory, "other.dat")
+    shutil.copy(self.filename, other)
+    # The entries store the modification time as text, so give both files the same one for entries of the same size.
+    os.utime(other, (1000000000, 1000000000))
+    self.cache.load(self.filename)
+    self.cache.maxBytes = self.cache.size() + 1
+    self.cache.load(other)
+    self.assertEqual(len(os.listdir(self.cache.directory)),1)
+    self.assertTrue(self.cache.size() <= self.cache.maxBytes)
+
+  def testParseCacheClear(self):
+    """clear should empty the cache."""
+    self.cache.load(self.filename)
+    self.cache.clear()
+    self.assertEqual(self.cache.size(),0)
+
+  def testParseCacheJSONHeader(self):
+    """Entries should store their header as JSON, and a pickled header should be ignored."""
+    self.cache.load(self.filename)
+    entryname = os.path.join(self.cache.directory, os.listdir(self.cache.directory)[0])
+    npzFile = numpy.load(entryname, allow_pickle = False)
+    header = json.loads(npzFile["header"].tobytes().decode("utf-8"))
+    columns = npzFile["columns"]
+    npzFile.close()
+    self.assertEqual(header["size"],os.path.getsize(self.filename))
+    self.assertEqual(header["datakeys"][0],["Basis", "mV"])
+    numpy.savez(entryname, header = numpy.frombuffer(pickle.dumps(header, 2), dtype = numpy.uint8), columns = columns)
+    self.assertEqual(self.cache.load(self.filename)["C1"][0],152061)
+
+  def testParseCacheInvalidFile(self):
+    """Invalid files should raise FormatError and not be cached."""
+    self.assertRaises(FormatError,self.cache.load,"testfiles/incorrect_stepwidth.dat")
+    self.assertEqual(self.cache.size(),0)
+
+class StackedSpectra(unittest.TestCase):
+  """
+  Tests the StaibStack container.
+  """
+
+  filename = "testfiles/good_data.dat"
+
+  def setUp(self):
+    self.SD = StaibDat(self.filename)
+    self.stack = StaibStack([self.filename, self.SD, self.filename])
+
+  def testStaibStackArrays(self):
+    """Channels should be packed into one row per spectrum on a shared axis."""
+    self.assertEqual(self.stack["C1"].shape,(3,self.SD["DataPoints"]))
+    self.assertTrue(all(self.stack["C1"][1] == self.SD["C1"]))
+    self.assertTrue(all(self.stack["KE"] == self.SD["KE"]))
+    self.assertTrue(all(self.stack["BE"] == self.SD["BE"]))
+    self.assertEqual(self.stack.channelkeys(),["C1","C2"])
+    self.assertEqual(self.stack["filename"],[self.filename] * 3)
+
+  def testStaibStackMetadata(self):
+    """Metadata should be queryable as one array per key."""
+    self.assertTrue(all(self.stack["Stepwidth"] == self.SD["Stepwidth"]))
+    self.assertTrue(all(self.stack["Technique"] == "AES"))
+    self.assertEqual(self.stack["Startenergy"]["unit"],"V")
+    self.assertEqual(self.stack["Startenergy"]["value"].shape,(3,))
+
+  def testStaibStackUnitlessEnergies(self):
+    """Spectra whose energies have no unit should be compared by value."""
+    gd = open(self.filename,"r")
+    gdLines = gd.readlines()
+    gd.close()
+    gdLines[8] = "Startenergy   :    199.969482\n"
+    gdLines[9] = "Stopenergy    :    599.984741\n"
+    unitless = StaibDat(iter(gdLines))
+    stack = StaibStack([self.SD, unitless])
+    self.assertTrue(numpy.array_equal(stack["C1"][1],self.SD["C1"]))
+    gdLines[9] = "Stopenergy    :    599.985\n"
+    self.assertRaises(ValueError,StaibStack,[self.SD, StaibDat(iter(gdLines))])
+
+  def testStaibStackOperations(self):
+    """Vectorized operations should match the per-spectrum ones."""
+    self.assertTrue(numpy.allclose(self.stack.sum("C1"),3 * self.SD["C1"]))
+    self.assertTrue(numpy.allclose(self.stack.mean("C1"),self.SD["C1"]))
+    self.assertTrue(numpy.allclose(self.stack.smooth("C1")[2],self.SD.smooth("C1")))
+    self.assertTrue(numpy.allclose(self.stack.differentiate("C1")[0],self.SD.differentiate("C1")))
+    self.assertTrue(numpy.allclose(self.stack.normalize("C1").max(axis = 1),1))
+    self.assertTrue(numpy.allclose(trapezoid(self.stack.normalize("C1", "area"), self.stack["KE"]),1))
+
+  def testStaibStackDifferentAxes(self):
+    """Spectra with different energy axes can't be stacked."""
+    gd = open(self.filename,"r")
+    gdLines = gd.readlines()
+    gd.close()
+    # Drop the last data point, and fix up the metadata accordingly.
+    gdLines = gdLines[:-1]
+    gdLines[9] = "Stopenergy [V]:    599.488000\n"
+    gdLines[13] = "Data Points   :    806\n"
+    shorter = StaibDat(iter(gdLines))
+    self.assertRaises(ValueError,StaibStack,[self.SD, shorter])
+
+class BackgroundRemoval(unittest.TestCase):
+  """
+  Tests the background models of rm_background.
+  """
+
+  filename = "testfiles/good_data.dat"
+
+  def setUp(self):
+    # A Gaussian peak on top of an exact Shirley step, along increasing binding energy.
+    self.energy = numpy.linspace(0, 20, 401)
+    self.peak = 1000 * numpy.exp(-(self.energy - 10) ** 2 / 2)
+    area = numpy.cumsum(self.peak)
+    self.shirley = 100 + 50 * (area - area[0]) / (area[-1] - area[0])
+    self.counts = self.peak + self.shirley
+
+  def testBackgroundShirley(self):
+    """The Shirley iteration should recover an exact Shirley step."""
+    background = Analysis.shirley_background(self.energy, self.counts)
+    self.assertTrue(numpy.allclose(background, self.shirley, atol = 0.5))
+    reverse = Analysis.shirley_background(self.energy[::-1], self.counts[::-1])
+    self.assertTrue(numpy.allclose(reverse[::-1], background))
+
+  def testBackgroundEndpoints(self):
+    """Every model should meet the counts at both ends of the interval."""
+    for model in ("linear", "shirley", "tougaard", "blended"):
+      background = Analysis.background(self.energy, self.counts, model)
+      self.assertAlmostEqual(background[0], self.counts[0])
+      self.assertAlmostEqual(background[-1], self.counts[-1])
+
+  def testBackgroundStack(self):
+    """A 2-D array should give each row the background it gets on its own."""
+    stack = numpy.array([self.counts, 2 * self.counts + 5])
+    for model in ("linear", "shirley", "tougaard", "blended"):
+      background = Analysis.background(self.energy, stack, model)
+      self.assertTrue(numpy.allclose(background[1], Analysis.background(self.energy, stack[1], model)))
+
+  def testStaibDatrm_backgroundWindow(self):
+    """loBE, hiBE and size should select and resize the interval."""
+    SD = StaibDat(self.filename)
+    full = SD.rm_background("C1", model = "shirley")
+    self.assertEqual(full.shape,SD["C1"].shape)
+    interval = (SD["BE"] >= -400) & (SD["BE"] <= -300)
+    background = SD.rm_background("C1", loBE = -400, hiBE = -300)
+    self.assertEqual(background.shape[0],interval.sum())
+    self.assertEqual(background[0],SD["C1"][interval][0])
+    self.assertEqual(SD.rm_background("C1", loBE = -400, hiBE = -300, size = 50).shape,(50,))
+    self.assertRaises(ValueError,SD.rm_background,"C1",model = "bogus")
+
+  def testStaibStackrm_background(self):
+    """A stack should give every spectrum its own background."""
+    SD = StaibDat(self.filename)
+    stack = StaibStack([SD, SD])
+    background = stack.rm_background("C1", loBE = -400, hiBE = -300, model = "tougaard")
+    self.assertTrue(numpy.allclose(background[1], SD.rm_background("C1", loBE = -400, hiBE = -300, model = "tougaard")))
+
+class Integration(unittest.TestCase):
+  """
+  Tests integrate and its batch windows.
+  """
+
+  filename = "testfiles/good_data.dat"
+
+  def testIntegrateTrapezoid(self):
+    """A single window should match the trapezoid rule on the same points."""
+    SD = StaibDat(self.filename)
+    self.assertAlmostEqual(SD.integrate("KE", "C1"), trapezoid(SD["C1"], SD["KE"]))
+    self.assertAlmostEqual(SD.integrate("BE", "C1", 10, 40), abs(trapezoid(SD["C1"][10:41], SD["BE"][10:41])))
+
+  def testIntegrateSimpson(self):
+    """Simpson's rule should be exact for a quadratic on unevenly spaced points."""
+    energy = numpy.cumsum(numpy.linspace(0.5, 1.5, 21))
+    counts = 3 * energy ** 2 - energy + 2
+    exact = lambda a, b: (b ** 3 - b ** 2 / 2 + 2 * b) - (a ** 3 - a ** 2 / 2 + 2 * a)
+    self.assertAlmostEqual(Analysis.integrate(energy, counts, 2, 18, "simpson"), exact(energy[2], energy[18]))
+    self.assertAlmostEqual(Analysis.integrate(energy, counts, 3, 19, "simpson"), exact(energy[3], energy[19]))
+    # An odd number of intervals ends with a trapezoid.
+    self.assertAlmostEqual(Analysis.integrate(energy, counts, 2, 19, "simpson"),
+                           exact(energy[2], energy[18]) + trapezoid(counts[18:20], energy[18:20]))
+
+  def testIntegrateWindows(self):
+    """An array of windows should give the areas of the windows one at a time."""
+    SD = StaibDat(self.filename)
+    windows = numpy.array([[0, 10], [5, 5], [3, 50], [20, 21]])
+    for method in ("trapezoid", "simpson"):
+      areas = SD.integrate("BE", ["C1", "C2"], windows, integralmethod = method)
+      self.assertEqual(areas.shape,(2, 4))
+      for i, (index1, index2) in enumerate(windows):
+        self.assertAlmostEqual(areas[1, i], SD.integrate("BE", "C2", index1, index2, integralmethod = method))
+    self.assertEqual(areas[0, 1],0)
+    self.assertRaises(ValueError,SD.integrate,"BE","C1",10,5)
+    self.assertRaises(ValueError,SD.integrate,"BE","C1",0,len(SD["BE"]))
+
+  def testIntegrateBackground(self):
+    """The background of each window should be subtracted from its area."""
+    SD = StaibDat(self.filename)
+    loBE, hiBE = SD["BE"][40], SD["BE"][10]
+    for model in ("linear", "shirley"):
+      expected = trapezoid(SD["C1"][10:41] - SD.rm_background("C1", loBE, hiBE, model = model), SD["KE"][10:41])
+      self.assertAlmostEqual(SD.integrate("KE", "C1", 10, 40, model), expected)
+      self.assertAlmostEqual(SD.integrate("KE", "C1", [[10, 40]], None, model)[0], expected)
+
+  def testStaibStackIntegrate(self):
+    """A stack should give one row of areas per spectrum."""
+    SD = StaibDat(self.filename)
+    stack = StaibStack([SD, SD])
+    areas = stack.integrate("BE", "C1", [[0, 10], [3, 50]], None, "shirley", "simpson")
+    self.assertTrue(numpy.allclose(areas[1], SD.integrate("BE", "C1", [[0, 10], [3, 50]], None, "shirley", "simpson")))
+
+class GaussianFitting(unittest.TestCase):
+  """
+  Tests gaussian_fit, its warm starts and its batch mode.
+  """
+
+  filename = "testfiles/good_data.dat"
+
+  def setUp(self):
+    self.energy = numpy.linspace(280, 295, 301)
+    self.peaks = numpy.array([[1000., 285., 0.8], [400., 288.5, 1.2]])
+    self.counts = sum([a * numpy.exp(-(self.energy - c) ** 2 / (2 * w ** 2)) for a, c, w in self.peaks])
+
+  def testGaussianFitRecovery(self):
+    """A noise free pair of peaks should be recovered exactly."""
+    fit = Analysis.gaussian_fit(self.energy, self.counts + 50, order = 2, model = "linear")
+    order = numpy.argsort(fit.centers)
+    self.assertTrue(numpy.allclose(fit.amplitudes[order], self.peaks[:, 0], rtol = 1e-4))
+    self.assertTrue(numpy.allclose(fit.centers[order], self.peaks[:, 1], rtol = 1e-6))
+    self.assertTrue(numpy.allclose(fit.widths[order], self.peaks[:, 2], rtol = 1e-4))
+    areas = self.peaks[:, 0] * self.peaks[:, 2]
+    self.assertTrue(numpy.allclose(fit.coefficients[order], areas / areas.sum(), rtol = 1e-4))
+    self.assertAlmostEqual(fit.rsquared, 1)
+    self.assertTrue(numpy.allclose(fit.fit, self.counts + 50, atol = 1e-3))
+
+  def testGaussianFitWarmStart(self):
+    """A fit started from a previous fit should end at the same parameters."""
+    first = Analysis.gaussian_fit(self.energy, self.counts, order = 2)
+    second = Analysis.gaussian_fit(self.energy, self.counts * 1.1, order = 2, guess = first, maxiter = 20)
+    self.assertTrue(numpy.allclose(second.amplitudes, first.amplitudes * 1.1, rtol = 1e-4))
+    self.assertTrue(numpy.allclose(second.centers, first.centers))
+
+  def testGaussianFitBatch(self):
+    """A batch fit should give every row the fit it gets on its own."""
+    counts = numpy.array([self.counts, numpy.roll(self.counts, 10), self.counts * 2])
+    batch = Analysis.gaussian_fit(self.energy, counts, order = 2, size = 50)
+    self.assertEqual(batch.fit.shape,(3, 50))
+    for row in range(3):
+      single = Analysis.gaussian_fit(self.energy, counts[row], order = 2, size = 50)
+      self.assertTrue(numpy.allclose(batch.centers[row], single.centers))
+      self.assertAlmostEqual(batch.sse[row], single.sse, places = 3)
+
+  def testGaussianFitDegenerateRows(self):
+    """Flat or empty rows shouldn't stop the other rows of a batch fit."""
+    counts = numpy.array([self.counts, numpy.ones_like(self.counts), numpy.zeros_like(self.counts)])
+    batch = Analysis.gaussian_fit(self.energy, counts, order = 2)
+    single = Analysis.gaussian_fit(self.energy, self.counts, order = 2)
+    self.assertTrue(numpy.allclose(batch.centers[0], single.centers))
+    self.assertTrue(batch.converged[0])
+    # A flat row of a real spectrum has singular normal equations.
+    SD = StaibDat(self.filename)
+    energy, counts = SD["BE"][10:61], SD["C1"][10:61]
+    batch = Analysis.gaussian_fit(energy, [counts, numpy.ones_like(counts)], order = 2)
+    self.assertFalse(batch.converged[1])
+    self.assertTrue(numpy.all((batch.centers >= energy.min()) & (batch.centers <= energy.max())))
+
+  def testStaibDatgaussian_fit(self):
+    """gaussian_fit should fit the window and return fit_size points."""
+    SD = StaibDat(self.filename)
+    fit = SD.gaussian_fit("C1", 10, 60, 1, "shirley", 100)
+    self.assertEqual(fit.fit.shape,(100,))
+    self.assertEqual(fit.energy[0],SD["BE"][10])
+    self.assertEqual(fit.energy[-1],SD["BE"][60])
+    self.assertTrue(0 <= fit.rsquared <= 1)
+
+  def testStaibStackgaussian_fit(self):
+    """A series of warm-started fits should agree with the batch fit."""
+    SD = StaibDat(self.filename)
+    stack = StaibStack([SD, SD, SD])
+    batch = stack.gaussian_fit("C1", 10, 60, 1, "linear")
+    series = stack.gaussian_fit("C1", 10, 60, 1, "linear", series = True)
+    self.assertEqual(series.centers.shape,(3, 1))
+    self.assertTrue(numpy.allclose(batch.centers, series.centers))
+    self.assertTrue(numpy.allclose(batch.fit, series.fit))
+
+class DataVerification(unittest.TestCase):
+  """
+  Tests the checks of the metadata against the data and their diagnostics.
+  """
+
+  def setUp(self):
+    datFile = open("testfiles/good_data.dat","rb")
+    self.gdLines = datFile.read().split(b"\n")
+    datFile.close()
+
+  def modified(self, replacements):
+    """Returns a stream of good_data.dat with some lines (counting from 1) replaced."""
+    lines = list(self.gdLines)
+    for line, text in replacements.items():
+      lines[line - 1] = text
+    return io.BytesIO(b"\n".join(lines))
+
+  def testVerifyCauses(self):
+    """Each invalid test file should report the check that failed."""
+    for name, cause in (("incorrect_datapoints", "datapoints"), ("incorrect_startenergy", "startenergy"),
+                        ("incorrect_stopenergy", "stopenergy"), ("inconsistent_step_size", "stepsize"),
+                        ("incorrect_stepwidth", "stepwidth"), ("mixed_up_sections", "structure"),
+                        ("data_spurious_line", "structure")):
+      for engine in ("fast", "pyparsing"):
+        try:
+          StaibDat("testfiles/%s.dat" % name, engine = engine)
+        except FormatError as error:
+          self.assertEqual(error.cause,cause)
+          self.assertEqual(len(error.violations),1)
+        else:
+          self.fail("%s.dat didn't raise FormatError" % name)
+
+  def testVerifyCollect(self):
+    """collect should report every violation with its line and values."""
+    stream = self.modified({11:b"Stepwidth     :    0.7\r", 14:b"Data Points   :    800\r", 40:b"    207000     147745         26\r"})
+    try:
+      StaibDat(stream, collect = True)
+    except FormatError as error:
+      self.assertEqual(error.cause,"datapoints")
+      self.assertEqual([violation.cause for violation in error.violations],["datapoints", "stepsize", "stepsize", "stepwidth"])
+      self.assertEqual(error.violations[0],(u"datapoints", 14, 800, 807))
+      self.assertEqual([violation.line for violation in error.violations[1:]],[40, 41, 11])
+      self.assertAlmostEqual(error.violations[3].expected,0.7)
+      self.assertAlmostEqual(error.violations[1].actual,207.000 - 206.917)
+      # The error and its report should survive being sent to another process.
+      copy = pickle.loads(pickle.dumps(error))
+      self.assertEqual(copy.violations,error.violations)
+      self.assertEqual(copy.cause,"datapoints")
+    else:
+      self.fail("collect didn't raise FormatError")
+    stream.seek(0)
+    try:
+      StaibDat(stream)
+    except FormatError as error:
+      self.assertEqual(len(error.violations),1)
+
+  def testVerifyMetadata(self):
+    """Missing or non-numeric metadata should be reported as a violation."""
+    lines = list(self.gdLines)
+    lines[13] = b"Data Points   :    many\r"
+    del lines[10]
+    for engine in ("fast", "pyparsing"):
+      try:
+        StaibDat(io.BytesIO(b"\n".join(lines)), engine = engine, collect = True)
+      except FormatError as error:
+        self.assertEqual(error.cause,"metadata")
+        # The checks that don't need the bad metadata are still made, and pass.
+        self.assertEqual(error.violations,[("metadata", 13, "numeric DataPoints", "many"), ("metadata", None, "numeric Stepwidth", None)])
+      else:
+        self.fail("bad metadata didn't raise FormatError")
+
+  def testVerifyTolerance(self):
+    """A looser tolerance should accept a file the default one rejects."""
+    SD = StaibDat("testfiles/incorrect_stepwidth.dat", tolerance = {"stepwidth":0.3})
+    self.assertEqual(SD["Stepwidth"],0.7)
+    self.assertRaises(FormatError,StaibDat,"testfiles/good_data.dat",tolerance = 1e-6)
+
+  def testVerifySinglePoint(self):
+    """A file with a single data point has no steps to check."""
+    lines = self.gdLines[:25] + [b""]
+    lines[9] = b"Stopenergy [V]:    199.969482\r"
+    lines[13] = b"Data Points   :    1\r"
+    SD = StaibDat(io.BytesIO(b"\n".join(lines)))
+    self.assertEqual(len(SD["KE"]),1)
+
+class HeaderIndex(unittest.TestCase):
+  """
+  Tests the header-only reader and the metadata index.
+  """
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    os.mkdir(os.path.join(self.directory, "sub"))
+    for name in ("good_data.dat", "junkdata.dat", "incorrect_stepwidth.dat"):
+      shutil.copy(os.path.join("testfiles", name), self.directory)
+    datFile = open("testfiles/good_data.dat","rb")
+    xps = datFile.read().replace(b"Technique     :    AES", b"Technique     :    XPS").replace(b"Feb 08", b"Mar 08")
+    datFile.close()
+    datFile = open(os.path.join(self.directory, "sub", "XPS.DAT"),"wb")
+    datFile.write(xps)
+    datFile.close()
+    self.index = MetadataIndex()
+
+  def tearDown(self):
+    self.index.close()
+    shutil.rmtree(self.directory)
+
+  def testReadHeader(self):
+    """The header should match the metadata of a full parse without reading the data."""
+    SD = StaibDat("testfiles/good_data.dat")
+    header = read_header("testfiles/good_data.dat")
+    self.assertEqual(sorted(header),sorted(SD.metadatakeys() + ["filename"]))
+    for key in SD.metadatakeys():
+      self.assertEqual(header[key],SD[key])
+    datFile = open("testfiles/good_data.dat","rb")
+    lines = iter(datFile)
+    read_header(lines)
+    self.assertEqual(next(lines).strip(),b"reserved")
+    datFile.close()
+    self.assertRaises(FormatError,read_header,io.BytesIO(b"Version       :    2.1\r\n"))
+
+  def testIndexSelect(self):
+    """Queries on the index should select files by their metadata."""
+    failures = self.index.scan(self.directory)
+    self.assertEqual([os.path.basename(filename) for filename, error in failures],["junkdata.dat"])
+    self.assertTrue(isinstance(failures[0][1], FormatError))
+    self.assertEqual(len(self.index.select()),3)
+    self.assertEqual([os.path.basename(filename) for filename in self.index.select(Technique = "XPS")],["XPS.DAT"])
+    february = self.index.select("strftime('%m', timestamp) = ? AND abs(Stepwidth - ?) < 0.005", ("02", 0.5))
+    self.assertEqual([os.path.basename(filename) for filename in february],["good_data.dat"])
+    self.assertEqual(self.index.select(Nonsense = 1),[])
+    self.assertTrue("Startenergy_unit" in self.index.columns())
+
+  def testIndexRescan(self):
+    """A rescan should pick up changed files and forget deleted ones."""
+    self.index.scan(self.directory)
+    os.remove(os.path.join(self.directory, "incorrect_stepwidth.dat"))
+    filename = os.path.join(self.directory, "good_data.dat")
+    datFile = open(filename,"rb")
+    text = datFile.read().replace(b"Technique     :    AES", b"Technique     :    XPS")
+    datFile.close()
+    datFile = open(filename,"wb")
+    datFile.write(text)
+    datFile.close()
+    os.utime(filename, (1e9, 1e9))
+    self.index.scan(self.directory)
+    self.assertEqual([os.path.basename(filename) for filename in self.index.select(Technique = "XPS")],["good_data.dat", "XPS.DAT"])
+    self.assertEqual(len(self.index.select()),2)
+
+  def testIndexPersistent(self):
+    """An index in a database file should be there when it is opened again."""
+    database = os.path.join(self.directory, "index.sqlite")
+    index = MetadataIndex(database)
+    index.scan(self.directory)
+    index.close()
+    index = MetadataIndex(database)
+    self.assertEqual(len(index.select(Technique = "AES")),2)
+    index.close()
+
+  def testIndexColumnClashes(self):
+    """Keys differing only in case or named like a bookkeeping column should get columns of their own."""
+    datFile = open("testfiles/good_data.dat","rb")
+    text = datFile.read().replace(b"Mode          :    Pulse\r\n", b"Mode          :    Pulse\r\nmode          :    Fixed\r\nsize          :    3\r\n")
+    datFile.close()
+    datFile = open(os.path.join(self.directory, "clashes.dat"),"wb")
+    datFile.write(text)
+    datFile.close()
+    database = os.path.join(self.directory, "index.sqlite")
+    index = MetadataIndex(database)
+    self.assertEqual([os.path.basename(filename) for filename, error in index.scan(self.directory)],["junkdata.dat"])
+    self.assertEqual((index.column("Mode"), index.column("mode"), index.column("size")),("Mode", "mode_2", "size_2"))
+    self.assertEqual(index.column("Nonsense"),None)
+    self.assertEqual([os.path.basename(filename) for filename in index.select(mode = "Fixed", size = 3)],["clashes.dat"])
+    self.assertEqual(len(index.select("size > 1000")),4)
+    index.close()
+    index = MetadataIndex(database)
+    self.assertEqual([os.path.basename(filename) for filename in index.select(mode = "Fixed")],["clashes.dat"])
+    index.close()
+
+class MemoryMapped(unittest.TestCase):
+  """
+  Tests the memory-mapped engine and lazy access through MappedDat.
+  """
+
+  filename = "testfiles/good_data.dat"
+
+  def testMappedEngineAgrees(self):
+    """The mmap engine should accept and reject the same files as the fast engine."""
+    for filename in sorted(os.listdir("testfiles")):
+      if not filename.endswith(".dat"):
+        continue
+      filename = os.path.join("testfiles", filename)
+      try:
+        fast = StaibDat(filename, compact = True)
+      except FormatError:
+        self.assertRaises(FormatError,StaibDat,filename,engine = "mmap")
+        continue
+      mapped = StaibDat(filename, engine = "mmap", compact = True)
+      self.assertEqual(sorted(mapped.keys()),sorted(fast.keys()))
+      for key in mapped.channelkeys() + ["KE", "BE"]:
+        self.assertTrue(numpy.array_equal(mapped[key], fast[key]))
+      self.assertEqual(mapped["fileText"],StaibDat(filename)["fileText"])
+    self.assertRaises(ValueError,StaibDat,io.BytesIO(b""),engine = "mmap")
+
+  def testMappedColumns(self):
+    """Rows and columns should be read lazily and equal the full parse."""
+    SD = StaibDat(self.filename)
+    mapped = MappedDat(self.filename)
+    try:
+      self.assertEqual(len(mapped),807)
+      self.assertEqual(mapped.header()["Technique"],"AES")
+      self.assertTrue(numpy.array_equal(mapped.rows(10, 20)[:, 1], SD["C1"][10:20]))
+      self.assertTrue(numpy.array_equal(mapped.column("C2", 700), SD["C2"][700:]))
+      self.assertTrue(numpy.array_equal(mapped.column("BE"), SD["BE"]))
+      self.assertTrue(numpy.array_equal(mapped.column("Channel_1", -5), SD["C1"][-5:]))
+    finally:
+      mapped.close()
+
+  def testMappedWindow(self):
+    """window should find the rows of an energy range by bisection."""
+    SD = StaibDat(self.filename)
+    with MappedDat(self.filename) as mapped:
+      for lo, hi in ((300, 400), (None, 250), (SD["KE"][5], SD["KE"][9]), (1000, 2000)):
+        expected = numpy.flatnonzero((SD["KE"] >= (lo if lo is not None else -numpy.inf)) & (SD["KE"] <= hi))
+        window = mapped.window(lo, hi)
+        self.assertEqual(list(range(window.start, window.stop)),list(expected))
+
+  def testMappedInvalidRows(self):
+    """Invalid rows should raise FormatError with the line they are on."""
+    datFile = open(self.filename,"rb")
+    lines = datFile.read().split(b"\n")
+    datFile.close()
+    lines[99] = b"    247000     1x7745         26\r"
+    lines[199] = b"    247000     147745\r"
+    directory = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(directory, "bad.dat")
+      datFile = open(filename,"wb")
+      datFile.write(b"\n".join(lines))
+      datFile.close()
+      with MappedDat(filename) as mapped:
+        self.assertEqual(mapped.rows(0, 5).shape,(5, 3))
+        try:
+          mapped.rows(150, 250)
+        except FormatError as error:
+          self.assertEqual((error.cause, error.violations[0].line),("columns", 200))
+        else:
+          self.fail("rows didn't raise FormatError")
+        try:
+          mapped.column("KE")
+        except FormatError as error:
+          self.assertEqual((error.cause, error.violations[0].line),("syntax", 100))
+        else:
+          self.fail("column didn't raise FormatError")
+    finally:
+      shutil.rmtree(directory)
+
+class NpzExport(unittest.TestCase):
+  """
+  Tests saving StaibDat objects to .npz files and loading them back.
+  """
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.npzname = os.path.join(self.directory, "spectra.npz")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def assertSameSpectrum(self, loaded, original):
+    """Every entry of the original should come back unchanged."""
+    self.assertEqual(sorted(loaded.keys()),sorted(original.keys()))
+    self.assertEqual(loaded.metadatakeys(),original.metadatakeys())
+    for key in original:
+      if isinstance(original[key], numpy.ndarray):
+        self.assertTrue(numpy.array_equal(loaded[key], original[key]))
+      elif isinstance(original[key], dict) and isinstance(original[key]["value"], (list, numpy.ndarray)):
+        self.assertTrue(numpy.array_equal(loaded[key]["value"], original[key]["value"]))
+        self.assertEqual(loaded[key]["unit"],original[key]["unit"])
+      else:
+        self.assertEqual(loaded[key],original[key])
+
+  def testNpzRoundTrip(self):
+    """A collection of objects should load back equal, in order."""
+    spectra = [StaibDat("testfiles/good_data.dat", compact = True), StaibDat("testfiles/incorrect_stepwidth.dat", tolerance = 1)]
+    save_npz(self.npzname, spectra)
+    for mmap in (True, False):
+      loaded = load_npz(self.npzname, mmap = mmap)
+      self.assertEqual(len(loaded),2)
+      for SD, original in zip(loaded, spectra):
+        self.assertSameSpectrum(SD, original)
+    self.assertSameSpectrum(load_npz(self.npzname, compact = False)[1], spectra[1])
+
+  def testNpzZeroCopy(self):
+    """Channels loaded through the memory map should be views of the file."""
+    save_npz(self.npzname, StaibDat("testfiles/good_data.dat"))
+    SD = load_npz(self.npzname)[0]
+    base = SD["C1"]
+    while not isinstance(base, numpy.memmap) and base.base is not None:
+      base = base.base
+    self.assertTrue(isinstance(base, numpy.memmap))
+    self.assertFalse(SD["C1"].flags.writeable)
+
+  def testNpzInvalid(self):
+    """Files not written by save_npz should raise FormatError."""
+    numpy.savez(self.npzname, data = numpy.arange(3))
+    self.assertRaises(FormatError,load_npz,self.npzname)
+    SD = StaibDat("testfiles/good_data.dat")
+    metadata, datakeys, columns = SD.parts()
+    save_npz(self.npzname, SD)
+    archive = numpy.load(self.npzname)
+    numpy.savez_compressed(self.npzname, metadata = archive["metadata"], columns_0 = archive["columns_0"])
+    archive.close()
+    self.assertRaises(FormatError,load_npz,self.npzname)
+    self.assertSameSpectrum(load_npz(self.npzname, mmap = False)[0], SD)
+
+  def testNpzNotArchive(self):
+    """Files that aren't .npz archives or lack the metadata table should raise FormatError with the syntax cause."""
+    save_npz(self.npzname, StaibDat("testfiles/good_data.dat"))
+    npzFile = open(self.npzname,"rb")
+    truncated = npzFile.read(200)
+    npzFile.close()
+    gd = open("testfiles/good_data.dat","rb")
+    text = gd.read()
+    gd.close()
+    for content in (text, truncated, b""):
+      npzFile = open(self.npzname,"wb")
+      npzFile.write(content)
+      npzFile.close()
+      for mmap in (True, False):
+        try:
+          load_npz(self.npzname, mmap = mmap)
+        except FormatError as error:
+          self.assertEqual(error.cause,"syntax")
+        else:
+          self.fail("load_npz didn't raise FormatError")
+    for save in (numpy.save, numpy.savez):
+      npzFile = open(self.npzname,"wb")
+      save(npzFile, numpy.arange(3))
+      npzFile.close()
+      try:
+        load_npz(self.npzname)
+      except FormatError as error:
+        self.assertEqual(error.cause,"syntax")
+      else:
+        self.fail("load_npz didn't raise FormatError")
+
+class BenchmarkFiles(unittest.TestCase):
+  """
+  Tests the synthetic files of the benchmark suite.
+  """
+
+  def testGeneratedFilesParse(self):
+    """Generated files should be valid at any size, with either engine."""
+    directory = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(directory, "synthetic.dat")
+      for points, channels, metadata in ((1, 1, 0), (50, 4, 3), (2000, 2, 0)):
+        staibdatbench.generate(filename, points, channels, metadata)
+        SD = StaibDat(filename)
+        self.assertEqual(len(SD["KE"]),points)
+        self.assertEqual(SD.channelkeys(),["C%d" % (indx + 1) for indx in range(channels)])
+        self.assertEqual(len(SD.metadatakeys()),19 + metadata)
+        if points < 100:
+          self.assertEqual(StaibDat(filename, engine = "pyparsing").parts()[2].tolist(),SD.parts()[2].tolist())
+    finally:
+      shutil.rmtree(directory)
+
+  def testPhaseTimings(self):
+    """Every phase of every engine should be timed through ParseStats."""
+    for engine, names in (("fast", ["read", "populate"]), ("pyparsing", ["read", "label", "verifystructure", "parse"]), ("mmap", ["map", "parse", "populate"])):
+      timings = staibdatbench.phases("testfiles/good_data.dat", engine, 2)
+      self.assertEqual(sorted(timings),sorted(names + ["verifydata", "userfriendify"]))
+      self.assertTrue(all(0 <= timing["best"] <= timing["mean"] for timing in timings.values()))
+
+  def testReportCompare(self):
+    """The report should give the ratio of each result to the baseline."""
+    results = {"results":{"construct.fast":{"best":0.002, "mean":0.003}, "memory.fast":{"before":10, "peak":30, "delta":20}}}
+    baseline = {"results":{"construct.fast":{"best":0.001, "mean":0.001}, "memory.fast":{"before":10, "peak":20, "delta":10}}}
+    lines = staibdatbench.report(results, baseline).split("\n")
+    self.assertTrue(lines[0].startswith("construct.fast") and lines[0].endswith("x2.00"))
+    self.assertTrue(lines[1].startswith("memory.fast") and lines[1].endswith("x2.00"))
+
+class PhaseStatistics(unittest.TestCase):
+  """
+  Tests the per-phase instrumentation of StaibDat construction.
+  """
+
+  filename = "testfiles/good_data.dat"
+
+  def testStatsPhases(self):
+    """Each engine should record its phases in order, with lines and bytes."""
+    records = []
+    stats = ParseStats(records.append)
+    for engine in ("fast", "pyparsing", "mmap"):
+      StaibDat(self.filename, engine = engine, stats = stats)
+    self.assertEqual([[phase.phase for phase in record.phases] for record in records],
+                     [["read", "populate", "verifydata", "userfriendify"],
+                      ["read", "label", "verifystructure", "parse", "verifydata", "userfriendify"],
+                      ["map", "parse", "populate", "verifydata", "userfriendify"]])
+    # The text engines read the file in text mode, whose newlines may differ from the bytes on disk.
+    datFile = open(self.filename,"r")
+    size = len(datFile.read())
+    datFile.close()
+    self.assertEqual(records[0].phases[0][2:],(831, size))
+    self.assertEqual(records[1].phases[0][2:],(831, size))
+    self.assertEqual(records[2].phases[1].lines,807)
+    self.assertEqual(records[2].phases[0].bytes + records[2].phases[1].bytes,os.path.getsize(self.filename))
+    for record in records:
+      self.assertEqual(record.filename,self.filename)
+      self.assertEqual(record.failure,None)
+      self.assertTrue(record.seconds >= sum([phase.seconds for phase in record.phases]))
+    self.assertEqual(stats.files,3)
+    self.assertEqual(stats.phases["parse"]["calls"],2)
+    self.assertEqual(stats.phases["verifydata"]["lines"],3 * 807)
+
+  def testStatsFailures(self):
+    """Failures should be counted per cause."""
+    stats = ParseStats()
+    for filename in ("incorrect_stepwidth.dat", "incorrect_stepwidth.dat", "mixed_up_sections.dat", "does_not_exist.dat"):
+      try:
+        StaibDat(os.path.join("testfiles", filename), stats = stats)
+      except (FormatError, EnvironmentError):
+        pass
+    self.assertEqual((stats.files, stats.failures),(4, 4))
+    self.assertEqual(stats.causes,{"stepwidth":2, "structure":1, "IOError" if str is bytes else "FileNotFoundError":1})
+
+  def testStatsBatch(self):
+    """A batch should add up the stats of every worker in the calling process."""
+    paths = ["testfiles/good_data.dat", "testfiles/incorrect_stepwidth.dat", "testfiles/good_data.dat"]
+    summaries = []
+    for workers in (1, 2):
+      records = []
+      stats = ParseStats(records.append)
+      results = list(load_many(paths, workers = workers, stats = stats, compact = True))
+      self.assertEqual(len(results),len(paths))
+      self.assertEqual([isinstance(result.data, StaibDat) for result in results],[True, False, True])
+      self.assertEqual(len(records),3)
+      summaries.append(stats.summary())
+    for summary in summaries:
+      self.assertEqual((summary["files"], summary["failures"], summary["causes"]),(3, 1, {"stepwidth":1}))
+      self.assertEqual(summary["phases"]["userfriendify"]["calls"],2)
+    total = ParseStats()
+    total.merge(stats)
+    total.merge(stats)
+    self.assertEqual(total.phases["read"]["bytes"],2 * stats.phases["read"]["bytes"])
+    self.assertEqual(total.causes,{"stepwidth":2})
+
+class LazyColumns(unittest.TestCase):
+  """
+  Tests that the datakey entries, KE, BE and Cn are only computed when accessed.
+  """
+
+  filename = "testfiles/good_data.dat"
+
+  def testKeysBeforeAccess(self):
+    """Every key should be present before any data is computed."""
+    SD = StaibDat(self.filename)
+    for key in ("Basis","Channel_1","Channel_2","KE","BE","C1","C2"):
+      self.assertTrue(key in SD)
+      self.assertTrue(key in SD.keys())
+      self.assertTrue(key in list(SD))
+      self.assertTrue(dict.__getitem__(SD, key).__class__.__name__ == "_Deferred")
+
+  def testCachedOnAccess(self):
+    """An entry should be computed once, and only the entry accessed."""
+    SD = StaibDat(self.filename)
+    KE = SD["KE"]
+    self.assertTrue(SD["KE"] is KE)
+    self.assertTrue(isinstance(dict.__getitem__(SD, "KE"), numpy.ndarray))
+    self.assertTrue(dict.__getitem__(SD, "C1").__class__.__name__ == "_Deferred")
+    self.assertTrue(isinstance(SD["Basis"]["value"], list))
+    self.assertTrue(SD.get("Basis") is SD["Basis"])
+
+  def testSameValues(self):
+    """Lazy entries should equal those of the pyparsing engine."""
+    SD = StaibDat(self.filename)
+    reference = StaibDat(self.filename, engine = "pyparsing")
+    self.assertEqual(sorted(SD.keys()),sorted(reference.keys()))
+    numpy.testing.assert_array_equal(SD["BE"],reference["BE"])
+    numpy.testing.assert_array_equal(SD["C2"],reference["C2"])
+    self.assertEqual(SD["Channel_1"],reference["Channel_1"])
+    self.assertEqual(dict(SD.items())["KE"].tolist(),reference["KE"].tolist())
+
+  def testPickleUnaccessed(self):
+    """An object should pickle before any of its data is accessed."""
+    SD = pickle.loads(pickle.dumps(StaibDat(self.filename), 2))
+    numpy.testing.assert_array_equal(SD["C1"],StaibDat(self.filename)["C1"])
+
+@unittest.skipUnless(asyncio, "asyncio isn't available")
+class AsyncLoading(unittest.TestCase):
+  """
+  Tests loading StaibDat objects from an asyncio event loop.
+  """
+
+  filename = "testfiles/good_data.dat"
+
+  def setUp(self):
+    self.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(self.loop)
+    datFile = open(self.filename,"rb")
+    self.content = datFile.read()
+    datFile.close()
+
+  def tearDown(self):
+    self.loop.close()
+    asyncio.set_event_loop(None)
+
+  def stream(self, content):
+    """Returns a StreamReader that receives content in small blocks from the loop."""
+    reader = asyncio.StreamReader()
+    for indx in range(0, len(content), 1000):
+      self.loop.call_soon(reader.feed_data, content[indx:indx + 1000])
+    self.loop.call_soon(reader.feed_eof)
+    return reader
+
+  def testAsyncSources(self):
+    """Filenames, bytes and streams should give the same data as parsing."""
+    loader = AsyncLoader(compact = True)
+    reference = StaibDat(self.filename)
+    def sources():
+      return asyncio.gather(loader.load(self.filename),
+                            loader.load(self.content, name = "bytes.dat"),
+                            loader.load(self.stream(self.content), name = "stream.dat"))
+    spectra = self.loop.run_until_complete(sources())
+    self.assertEqual([SD["filename"] for SD in spectra],[self.filename, "bytes.dat", "stream.dat"])
+    for SD in spectra:
+      self.assertTrue(numpy.array_equal(SD["C1"],reference["C1"]))
+      self.assertEqual(SD["Startenergy"],reference["Startenergy"])
+
+  def testAsyncFormatError(self):
+    """A bad file should raise FormatError from its future only."""
+    loader = AsyncLoader()
+    bad = loader.load(self.content.replace(b"Basis", b"Basis Channel_3"))
+    good = loader.load(self.content)
+    self.assertRaises(FormatError,self.loop.run_until_complete,bad)
+    self.assertEqual(self.loop.run_until_complete(good)["DataPoints"],807)
+
+  def testAsyncLimit(self):
+    """No more than limit files should be parsed at once."""
+    active = [0, 0]
+    lock = threading.Lock()
+    class CountingExecutor(concurrent.futures.ThreadPoolExecutor):
+      def submit(self, function, *args):
+        def counted():
+          with lock:
+            active[0] += 1
+            active[1] = max(active)
+          time.sleep(0.02)
+          try:
+            return function(*args)
+          finally:
+            with lock:
+              active[0] -= 1
+        return concurrent.futures.ThreadPoolExecutor.submit(self, counted)
+    executor = CountingExecutor(8)
+    try:
+      loader = AsyncLoader(executor, limit = 2)
+      spectra = self.loop.run_until_complete(asyncio.gather(*[loader.load(self.content) for indx in range(8)]))
+    finally:
+      executor.shutdown()
+    self.assertEqual(len(spectra),8)
+    self.assertEqual(active[1],2)
+
+  def testAsyncProcesses(self):
+    """Parsing should also work in a pool of processes."""
+    executor = concurrent.futures.ProcessPoolExecutor(2)
+    try:
+      loader = AsyncLoader(executor)
+      SD = self.loop.run_until_complete(loader.load(self.stream(self.content), name = "stream.dat"))
+    finally:
+      executor.shutdown()
+    self.assertEqual(SD["filename"],"stream.dat")
+    self.assertEqual(len(SD["KE"]),807)
+
+class TailingFiles(unittest.TestCase):
+  """
+  Tests reading a file incrementally while it is being written.
+  """
+
+  filename = "testfiles/good_data.dat"
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.growing = os.path.join(self.directory, "growing.dat")
+    datFile = open(self.filename,"rb")
+    self.lines = datFile.readlines()
+    datFile.close()
+    self.reference = StaibDat(self.filename)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def write(self, text, mode = "ab"):
+    datFile = open(self.growing,mode)
+    datFile.write(text)
+    datFile.close()
+
+  def testTailingGrows(self):
+    """New rows should be appended as they are written, and partial lines held back."""
+    self.write(b"".join(self.lines[:30]), "wb")
+    TD = TailingDat(self.growing)
+    self.assertEqual(len(TD),6)
+    self.assertEqual(TD["Technique"],"AES")
+    self.assertFalse(TD.complete())
+    self.write(b"".join(self.lines[30:100]) + self.lines[100][:5])
+    self.assertEqual(TD.poll(),70)
+    self.assertEqual(TD.poll(),0)
+    self.write(b"".join([self.lines[100][5:]] + self.lines[101:]))
+    self.assertEqual(TD.poll(),731)
+    self.assertTrue(TD.complete())
+    self.assertEqual(TD.progress(),1.)
+    self.assertTrue(numpy.array_equal(TD["KE"],self.reference["KE"]))
+    self.assertTrue(numpy.array_equal(TD["BE"],self.reference["BE"]))
+    self.assertTrue(numpy.array_equal(TD["C2"],self.reference["C2"]))
+    self.assertEqual(TD["Basis"]["value"].tolist(),self.reference["Basis"]["value"])
+    self.assertEqual(set(TD.keys()) - set(["fileText"]),set(self.reference.keys()) - set(["fileText"]))
+
+  def testTailingMetadata(self):
+    """Missing or unitless metadata should be handled as StaibDat handles it."""
+    lines = list(self.lines)
+    lines[8] = b"Startenergy   :    199.969000\r\n"
+    self.write(b"".join(lines), "wb")
+    self.assertTrue(TailingDat(self.growing).complete())
+    StaibDat(self.growing)
+    del lines[13]
+    self.write(b"".join(lines), "wb")
+    for reader in (TailingDat, StaibDat):
+      try:
+        reader(self.growing)
+      except FormatError as error:
+        self.assertEqual(error.violations,[("metadata", None, "numeric DataPoints", None)])
+      else:
+        self.fail("%s accepted a file without Data Points" % reader.__name__)
+
+  def testTailingHeaderOnly(self):
+    """A file without any data yet should have no rows and no arrays."""
+    self.write(b"".join(self.lines[:10]), "wb")
+    TD = TailingDat(self.growing)
+    self.assertEqual(len(TD),0)
+    self.assertEqual(TD.progress(),0.)
+    self.assertFalse("KE" in TD)
+    self.assertRaises(FormatError,TD.snapshot)
+
+  def testTailingSnapshot(self):
+    """A snapshot should be a StaibDat object of the rows so far."""
+    self.write(b"".join(self.lines[:400]), "wb")
+    TD = TailingDat(self.growing)
+    partial = TD.snapshot()
+    self.assertEqual(len(partial["C1"]),376)
+    self.write(b"".join(self.lines[400:]))
+    for new in TD.follow(interval = 0):
+      pass
+    self.assertEqual(len(partial["C1"]),376)
+    self.assertTrue(numpy.array_equal(TD.snapshot()["C1"],self.reference["C1"]))
+
+  def testTailingRestart(self):
+    """A file that shrinks should be read again from the start."""
+    self.write(b"".join(self.lines), "wb")
+    TD = TailingDat(self.growing)
+    self.write(b"".join(self.lines[:50]), "wb")
+    TD.poll()
+    self.assertEqual(len(TD),26)
+
+  def testTailingVerify(self):
+    """Bad rows should raise FormatError with the same cause as StaibDat."""
+    for name, cause in (("incorrect_startenergy", "startenergy"),
+                        ("inconsistent_step_size", "stepsize"),
+                        ("incorrect_stepwidth", "stepwidth"),
+                        ("incorrect_stopenergy", "stopenergy")):
+      try:
+        TailingDat("testfiles/%s.dat" % name)
+      except FormatError as error:
+        self.assertEqual(error.cause,cause)
+      else:
+        self.fail("%s didn't raise FormatError" % name)
+
+class CompactPickling(unittest.TestCase):
+  """
+  Tests pickling StaibDat objects as metadata and a single array.
+  """
+
+  filename = "testfiles/good_data.dat"
+
+  def testPickleSize(self):
+    """The pickle should be little more than the data section as an array."""
+    SD = StaibDat(self.filename)
+    SD["KE"], SD["C1"], SD["Basis"]
+    self.assertTrue(len(pickle.dumps(SD, 2)) < 807 * 3 * 8 + 4096)
+
+  def testPickleContents(self):
+    """The unpickled object should have the same keys and data, computed lazily."""
+    for compact in (False, True):
+      SD = StaibDat(self.filename, compact = compact)
+      SD["sample"] = "Cu(111)"
+      copy = pickle.loads(pickle.dumps(SD, 2))
+      self.assertEqual(type(copy),StaibDat)
+      self.assertEqual(sorted(copy.keys()),sorted(SD.keys()))
+      self.assertEqual(copy.metadatakeys(),SD.metadatakeys())
+      self.assertEqual(dict.__getitem__(copy, "KE").__class__.__name__,"_Deferred")
+      self.assertTrue(numpy.array_equal(copy["BE"],SD["BE"]))
+      self.assertEqual(list(copy["Channel_2"]["value"]),list(SD["Channel_2"]["value"]))
+      self.assertEqual(isinstance(copy["Channel_2"]["value"], list),not compact)
+      self.assertEqual(copy["sample"],"Cu(111)")
+      self.assertEqual(copy["fileText"],SD["fileText"])
+
+  def testPickleStreamText(self):
+    """Kept text of a stream can't be re-read, so it should be pickled."""
+    datFile = open(self.filename,"rb")
+    SD = StaibDat(io.BytesIO(datFile.read()), keepText = True)
+    datFile.close()
+    self.assertEqual(pickle.loads(pickle.dumps(SD))["fileText"],SD["fileText"])
+
+def _sharedsum(SD):
+  """Returns the sum of C1 and whether it is writeable, in a worker process."""
+  return float(SD["C1"].sum()), SD["C1"].flags.writeable
+
+@unittest.skipUnless(SharedDat, "multiprocessing.shared_memory isn't available")
+class SharedMemory(unittest.TestCase):
+  """
+  Tests handing StaibDat objects to other processes through shared memory.
+  """
+
+  filename = "testfiles/good_data.dat"
+
+  def testSharedLoad(self):
+    """An attached object should be a compact, read-only view of the data."""
+    SD = StaibDat(self.filename)
+    with SharedDat(SD) as shared:
+      copy = pickle.loads(pickle.dumps(shared))
+      self.assertTrue(len(pickle.dumps(shared)) < 4096)
+      self.assertTrue(numpy.array_equal(copy["C2"],SD["C2"]))
+      self.assertTrue(numpy.array_equal(shared.load()["KE"],SD["KE"]))
+      self.assertTrue(copy["C1"] is copy["Channel_1"]["value"])
+      self.assertFalse(copy["C1"].flags.writeable)
+      del copy
+
+  def testSharedPool(self):
+    """Workers of a pool should attach to the shared data."""
+    SD = StaibDat(self.filename)
+    pool = multiprocessing.Pool(2)
+    try:
+      with SharedDat(SD) as shared:
+        results = pool.map(_sharedsum, [shared] * 4)
+    finally:
+      pool.close()
+      pool.join()
+    self.assertEqual(results,[(float(SD["C1"].sum()), False)] * 4)
+
+  def testSharedTracking(self):
+    """Only the owner should unlink the block, whenever the workers were started."""
+    script = "\n".join(["import multiprocessing",
+                        "from tfan_parsers import StaibDat, SharedDat",
+                        "from staibdattest import _sharedsum",
+                        "if __name__ == '__main__':",
+                        "  multiprocessing.set_start_method('%s')",
+                        "  pool = multiprocessing.Pool(2)",
+                        "  with SharedDat(StaibDat('%s')) as shared:",
+                        "    pool.map(_sharedsum, [shared] * 4)",
+                        "    shared.load()",
+                        "    with multiprocessing.Pool(2) as later:",
+                        "      later.map(_sharedsum, [shared] * 4)",
+                        "  pool.close()",
+                        "  pool.join()"])
+    for method in set(["fork", "spawn"]) & set(multiprocessing.get_all_start_methods()):
+      process = subprocess.Popen([sys.executable, "-c", script % (method, self.filename)], stderr = subprocess.PIPE)
+      errors = process.communicate()[1].decode("utf-8")
+      self.assertEqual(process.returncode,0)
+      self.assertFalse("resource_tracker" in errors, errors)
+
+class LazyImports(unittest.TestCase):
+  """
+  Tests that importing the package doesn't import its heavy dependencies.
+  """
+
+  def modules(self, statement):
+    """Returns which of numpy, pyparsing and pdb are imported after running statement in a fresh interpreter."""
+    script = "import sys\n%s\nprint(' '.join([name for name in ('numpy', 'pyparsing', 'pdb') if name in sys.modules]))" % statement
+    return subprocess.check_output([sys.executable, "-c", script]).decode("utf-8").split()
+
+  def testImportPackage(self):
+    """Importing the package should import none of them."""
+    self.assertEqual(self.modules("import tfan_parsers"),[])
+    self.assertEqual(self.modules("from tfan_parsers import FormatError, MetadataIndex"),[])
+
+  def testImportHeader(self):
+    """Reading a header should import none of them."""
+    self.assertEqual(self.modules("import tfan_parsers\ntfan_parsers.read_header('testfiles/good_data.dat')"),[])
+
+  def testImportOnUse(self):
+    """The public names should be imported when they are used."""
+    self.assertEqual(self.modules("from tfan_parsers import StaibDat\nStaibDat('testfiles/good_data.dat')"),["numpy"])
+    self.assertEqual(self.modules("from tfan_parsers import StaibDat\nStaibDat('testfiles/good_data.dat', engine = 'pyparsing')"),["numpy", "pyparsing"])
+    import tfan_parsers
+    self.assertTrue(tfan_parsers.StaibDat is StaibDat)
+    self.assertTrue(tfan_parsers.StaibGrammar is StaibGrammar)
+    self.assertTrue("load_npz" in dir(tfan_parsers))
+    self.assertRaises(AttributeError,getattr,tfan_parsers,"bogus")
+
+  def testImportTime(self):
+    """A cold import should cost a small fraction of importing numpy and pyparsing."""
+    lazy = staibdatbench.importtime("import tfan_parsers", 3)["best"]
+    heavy = staibdatbench.importtime("import numpy, pyparsing", 3)["best"]
+    self.assertTrue(lazy < 0.25 * heavy, "import took %.4f s, numpy and pyparsing %.4f s" % (lazy, heavy))
+
+class CompressedFiles(unittest.TestCase):
+  """
+  Tests reading compressed files and archives without extracting them.
+  """
+
+  filename = "testfiles/good_data.dat"
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    datFile = open(self.filename,"rb")
+    self.gdBytes = datFile.read()
+    datFile.close()
+    self.reference = StaibDat(self.filename)
+    self.compressors = {".gz":gzip.compress if hasattr(gzip, "compress") else self.gzipcompress,
+                        ".bz2":bz2.compress}
+    if lzma is not None:
+      self.compressors[".xz"] = lzma.compress
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def gzipcompress(self, content):
+    buf = io.BytesIO()
+    gzFile = gzip.GzipFile(fileobj = buf, mode = "wb")
+    gzFile.write(content)
+    gzFile.close()
+    return buf.getvalue()
+
+  def write(self, name, content):
+    filename = os.path.join(self.directory, name)
+    datFile = open(filename,"wb")
+    datFile.write(content)
+    datFile.close()
+    return filename
+
+  def testNonAsciiBytes(self):
+    """A plain file should be decoded like a compressed one, as latin-1."""
+    content = self.gdBytes.replace(b"\n", b"\n\xb5A\n", 1)
+    plain = self.write("micro.dat", content)
+    compressed = self.write("micro.dat.gz", self.gzipcompress(content))
+    for filename in (plain, compressed):
+      try:
+        StaibDat(filename)
+      except FormatError as error:
+        self.assertEqual(error.violations[0].line,2)
+      else:
+        self.fail("%s didn't raise FormatError" % filename)
+    lines = open_dat(plain)
+    self.assertEqual(list(lines)[1],u"\xb5A\n")
+    lines.close()
+
+  def assertSameData(self, SD):
+    for key in ("DataPoints","Startenergy","Dateandtime"):
+      self.assertEqual(SD[key],self.reference[key])
+    for key in ("Basis","Channel_1","Channel_2"):
+      self.assertEqual(list(SD[key]["value"]),self.reference[key]["value"])
+    for key in ("KE","BE","C1","C2"):
+      self.assertTrue(all(SD[key] == self.reference[key]))
+
+  def testCompressedFiles(self):
+    """Each compressed file should import like the plain file, keeping its text."""
+    for suffix, compress in self.compressors.items():
+      filename = self.write("good_data.dat" + suffix, compress(self.gdBytes))
+      SD = StaibDat(filename)
+      self.assertSameData(SD)
+      self.assertEqual(SD["filename"],filename)
+      self.assertEqual(SD["fileText"],self.gdBytes.decode("latin-1").splitlines(True))
+      SD = StaibDat(filename, compact = True)
+      self.assertSameData(SD)
+      self.assertEqual(SD["fileText"],self.gdBytes.decode("latin-1").splitlines(True))
+      self.assertEqual(read_header(filename)["Dateandtime"],self.reference["Dateandtime"])
+
+  def testCompressedStreams(self):
+    """Concatenated gzip streams should read as one file."""
+    lines = self.gdBytes.splitlines(True)
+    filename = self.write("split.dat.gz", self.compressors[".gz"](b"".join(lines[:50])) + self.compressors[".gz"](b"".join(lines[50:])))
+    self.assertSameData(StaibDat(filename))
+
+  def testCompressedTruncated(self):
+    """A truncated or corrupt compressed file should raise IOError, not misparse."""
+    for suffix, compress in self.compressors.items():
+      content = compress(self.gdBytes)
+      filename = self.write("truncated.dat" + suffix, content[:len(content) // 2])
+      self.assertRaises(IOError,StaibDat,filename)
+      filename = self.write("corrupt.dat" + suffix, content[:20] + b"junk" * 20 + content[100:])
+      self.assertRaises(IOError,StaibDat,filename)
+
+  def testCompressedLines(self):
+    """open_dat should yield the decompressed lines, and plain files should simply be opened."""
+    filename = self.write("good_data.dat.bz2", bz2.compress(self.gdBytes))
+    lines = open_dat(filename)
+    self.assertEqual(list(lines),self.gdBytes.splitlines(True))
+    lines.close()
+    lines = open_dat(self.filename)
+    self.assertEqual(lines.readlines(),self.reference["fileText"])
+    lines.close()
+
+  def testCompressedMapped(self):
+    """A compressed file can't be memory mapped."""
+    filename = self.write("good_data.dat.gz", self.compressors[".gz"](self.gdBytes))
+    self.assertRaises(ValueError,StaibDat,filename,engine = "mmap")
+
+  def testCompressedBatch(self):
+    """load_many should load compressed files."""
+    filename = self.write("good_data.dat.gz", self.compressors[".gz"](self.gdBytes))
+    results = list(load_many([filename, self.filename], workers = 1))
+    self.assertEqual([result.error for result in results],[None, None])
+    self.assertSameData(results[0].data)
+
+  def members(self):
+    """Returns the name and content of each member of the test archives."""
+    return [("session/good_data.dat", self.gdBytes),
+            ("session/packed.DAT.gz", self.compressors[".gz"](self.gdBytes)),
+            ("session/notes.txt", b"not a spectrum"),
+            ("session/junk.dat", self.gdBytes[:200])]
+
+  def assertArchive(self, results):
+    self.assertEqual([result.filename for result in results],["session/good_data.dat", "session/packed.DAT.gz", "session/junk.dat"])
+    self.assertSameData(results[0].data)
+    self.assertSameData(results[1].data)
+    self.assertEqual(results[1].data["filename"],"session/packed.DAT.gz")
+    self.assertEqual(results[2].data,None)
+    self.assertTrue(isinstance(results[2].error, FormatError))
+
+  def testZipArchive(self):
+    """Each .dat member of a zip archive should be read in turn, failures included."""
+    filename = os.path.join(self.directory, "session.zip")
+    archive = zipfile.ZipFile(filename,"w",zipfile.ZIP_DEFLATED)
+    for name, content in self.members():
+      archive.writestr(name, content)
+    archive.close()
+    self.assertArchive(list(iter_archive(filename)))
+    results = list(iter_archive(filename, pattern = "notes.*"))
+    self.assertEqual([result.filename for result in results],["session/notes.txt"])
+
+  def testTarArchive(self):
+    """Each .dat member of a compressed tar archive should be read in turn, failures included."""
+    filename = os.path.join(self.directory, "session.tar.gz")
+    archive = tarfile.open(filename,"w:gz")
+    for name, content in self.members():
+      info = tarfile.TarInfo(name)
+      info.size = len(content)
+      archive.addfile(info, io.BytesIO(content))
+    archive.close()
+    self.assertArchive(list(iter_archive(filename, compact = True)))
+
+class IntegerStorage(unittest.TestCase):
+  """
+  Tests storing the data section as integers.
+  """
+
+  filename = "testfiles/good_data.dat"
+
+  def setUp(self):
+    self.reference = StaibDat(self.filename)
+    gd = open(self.filename,"rb")
+    self.gdBytes = gd.read()
+    gd.close()
+
+  def testIntegerAuto(self):
+    """auto should store the smallest integer type holding the values, with the same values and float energies."""
+    for options in ({}, {"compact":True}, {"engine":"pyparsing"}, {"engine":"mmap", "compact":True}):
+      SD = StaibDat(self.filename, dtype = "auto", **options)
+      self.assertEqual(SD.dtype(),numpy.int32)
+      self.assertEqual(SD["C1"].dtype,numpy.int32)
+      self.assertEqual(list(SD["Basis"]["value"]),self.reference["Basis"]["value"])
+      self.assertTrue(all(SD["C2"] == self.reference["C2"]))
+      self.assertEqual(SD["KE"].dtype,numpy.float64)
+      self.assertTrue(numpy.allclose(SD["KE"],self.reference["KE"]))
+      self.assertTrue(numpy.allclose(SD["BE"],self.reference["BE"]))
+    self.assertEqual(self.reference.dtype(),numpy.float64)
+
+  def testIntegerMemory(self):
+    """int32 storage should take half the memory of float storage."""
+    SD = StaibDat(self.filename, dtype = "int32", compact = True)
+    self.assertEqual(2 * SD["Basis"]["value"].nbytes,StaibDat(self.filename, compact = True)["Basis"]["value"].nbytes)
+    self.assertTrue(numpy.allclose(SD.smooth("C1"),self.reference.smooth("C1")))
+
+  def testIntegerOverflow(self):
+    """A value that doesn't fit the type should raise FormatError at its line."""
+    try:
+      StaibDat(self.filename, dtype = "int16")
+      self.fail("FormatError not raised")
+    except FormatError as error:
+      self.assertEqual(error.cause,"dtype")
+      self.assertEqual(error.violations[0].line,25)
+      self.assertEqual(error.violations[0].expected,"int16")
+      self.assertEqual(error.violations[0].actual,199969.)
+
+  def testIntegerFraction(self):
+    """Columns from elsewhere with a value that isn't a whole number should raise FormatError."""
+    metadata, datakeys, columns = self.reference.parts()
+    columns[1, 2] = 2.5
+    self.assertEqual(StaibDat.fromparts(None, metadata, datakeys, columns)["C2"][1],2.5)
+    try:
+      StaibDat.fromparts(None, metadata, datakeys, columns, dtype = "auto")
+      self.fail("FormatError not raised")
+    except FormatError as error:
+      self.assertEqual(error.cause,"dtype")
+      self.assertEqual(error.violations[0].line,None)
+      self.assertEqual(error.violations[0].actual,2.5)
+    columns[1, 2] = numpy.nan
+    self.assertRaises(FormatError,StaibDat.fromparts,None,metadata,datakeys,columns,dtype = "int64")
+
+  def testIntegerInvalid(self):
+    """dtype should be an integer type."""
+    self.assertRaises(ValueError,StaibDat,self.filename,dtype = "float32")
+
+  def testIntegerRoundTrip(self):
+    """Pickling and save_npz should keep the integer type."""
+    for SD in (StaibDat(self.filename, dtype = "auto"), StaibDat(self.filename, dtype = "auto", compact = True)):
+      SD["Basis"]
+      self.assertEqual(pickle.loads(pickle.dumps(SD)).dtype(),numpy.int32)
+    directory = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(directory, "spectra.npz")
+      save_npz(filename, [SD, self.reference])
+      spectra = load_npz(filename)
+      self.assertEqual([spectrum.dtype() for spectrum in spectra],[numpy.int32, numpy.float64])
+      self.assertTrue(all(spectra[0]["C1"] == self.reference["C1"]))
+      del spectra
+    finally:
+      shutil.rmtree(directory)
+
+class EnergyWindows(unittest.TestCase):
+  """
+  Tests finding energy windows and resampling onto a shared energy grid.
+  """
+
+  filename = "testfiles/good_data.dat"
+
+  def setUp(self):
+    self.SD = StaibDat(self.filename)
+
+  def shifted(self, shift, points = None):
+    """Returns the spectrum with its Basis values shifted by shift mV and cut to the first points rows."""
+    metadata, datakeys, columns = self.SD.parts()
+    columns = columns[:points].copy()
+    columns[:, 0] += shift
+    return StaibDat.fromparts("shifted.dat", metadata, datakeys, columns, verify = False)
+
+  def testWindowIndices(self):
+    """The binary search should find the same windows as a scan, on increasing and decreasing axes."""
+    random.seed(0)
+    for abscissa in ("KE", "BE"):
+      energy = self.SD[abscissa]
+      for trial in range(50):
+        lo, hi = sorted([random.uniform(energy.min() - 5, energy.max() + 5) for indx in range(2)])
+        inside = numpy.nonzero((energy >= lo) & (energy <= hi))[0]
+        index1, index2 = Analysis.window_indices(energy, lo, hi)
+        if len(inside) == 0:
+          self.assertTrue(index2 < index1)
+        else:
+          self.assertEqual((index1, index2),(inside[0], inside[-1]))
+      self.assertEqual(Analysis.window_indices(energy),(0, len(energy) - 1))
+
+  def testWindowMethod(self):
+    """window should give the indices integrate and gaussian_fit take, singly or as arrays."""
+    index1, index2 = self.SD.window(-500, -450)
+    self.assertTrue(isinstance(index1, int))
+    self.assertTrue(all(self.SD["BE"][index1:index2 + 1] >= -500))
+    self.assertTrue(all(self.SD["BE"][index1:index2 + 1] <= -450))
+    self.assertEqual(self.SD.integrate("BE", "C1", *self.SD.window(-500, -450)),self.SD.integrate("BE", "C1", index1, index2))
+    indices1, indices2 = self.SD.window(numpy.array([-500, -400]), numpy.array([-450, -300]), abscissa = "BE")
+    self.assertEqual(list(indices1),[index1, self.SD.window(-400, -300)[0]])
+    self.assertEqual(self.SD.window(abscissa = "KE"),(0, len(self.SD["KE"]) - 1))
+    self.assertRaises(ValueError,self.SD.window,10000,20000)
+
+  def testResampleAxes(self):
+    """Spectra with different axes and lengths should match interpolating each one separately."""
+    spectra = [self.SD, self.shifted(250, 700), self.shifted(-130)]
+    grid = numpy.linspace(self.SD["KE"][0] - 1, self.SD["KE"][-1] + 1, 500)
+    resampled = Analysis.resample([spectrum["KE"] for spectrum in spectra], [spectrum["C1"] for spectrum in spectra], grid)
+    self.assertEqual(resampled.shape,(3, 500))
+    for spectrum, row in zip(spectra, resampled):
+      expected = numpy.interp(grid, spectrum["KE"], spectrum["C1"], left = numpy.nan, right = numpy.nan)
+      self.assertTrue(numpy.allclose(row, expected, equal_nan = True))
+      self.assertTrue(numpy.isnan(row[0]))
+    # Decreasing axes and grids give the same values.
+    decreasing = Analysis.resample([spectrum["BE"] for spectrum in spectra], [spectrum["C1"] for spectrum in spectra], self.SD["SourceEnergy"] - grid)
+    self.assertTrue(numpy.allclose(decreasing, resampled, equal_nan = True))
+
+  def testResampleShared(self):
+    """Spectra sharing an axis should be resampled at once, and a spectrum onto its own axis unchanged."""
+    grid = numpy.linspace(self.SD["KE"][0], self.SD["KE"][-1], 300)
+    counts = numpy.array([self.SD["C1"], self.SD["C2"]])
+    resampled = Analysis.resample(self.SD["KE"], counts, grid, fill = 0)
+    self.assertTrue(numpy.allclose(resampled, Analysis.resample([self.SD["KE"]] * 2, counts, grid, fill = 0)))
+    self.assertTrue(numpy.allclose(resampled[1], numpy.interp(grid, self.SD["KE"], self.SD["C2"])))
+    self.assertTrue(numpy.allclose(self.SD.resample("C1", self.SD["KE"]), self.SD["C1"]))
+    self.assertEqual(self.SD.resample(["C1", "C2"], grid).shape,(2, 300))
+
+  def testResampleStack(self):
+    """Spectra from different sessions should stack once resampled onto a grid."""
+    spectra = [self.SD, self.shifted(250)]
+    self.assertRaises(ValueError,StaibStack,spectra)
+    grid = numpy.arange(210., 590., 0.5)
+    stack = StaibStack(spectra, grid = grid)
+    self.assertTrue(numpy.array_equal(stack["KE"], grid))
+    self.assertEqual(stack["C1"].shape,(2, len(grid)))
+    self.assertTrue(numpy.allclose(stack["C1"][1], numpy.interp(grid, spectra[1]["KE"], spectra[1]["C1"])))
+    self.assertEqual(stack.window(250, 260, abscissa = "KE"),(80, 100))
+    self.assertEqual(stack.integrate("KE", "C1", *stack.window(250, 260, abscissa = "KE")).shape,(2,))
+
 class APITest(unittest.TestCase):
   """
   Tests to see if the API is correct.
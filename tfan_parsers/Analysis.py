@@ -0,0 +1,631 @@
+# -*- coding: utf-8 -*-
+
+"""
+Numerical routines shared by StaibDat and the other tfan_parsers containers.
+
+The routines work on numpy arrays. Wherever it makes sense they accept a 2-D
+array holding one spectrum per row and treat every row at once.
+"""
+
+import collections
+import numpy
+
+# Savitzky-Golay coefficients keyed by (kernel, order, deriv).
+_savgolCache = {}
+
+def savgol_coeffs(kernel, order, deriv):
+  """
+  Returns the Savitzky-Golay coefficients for a window of kernel points.
+
+  The coefficients are returned as a tuple of three read-only arrays: the
+  weights applied to the kernel points around each sample, followed by the
+  weight matrices of the polynomial fits to the first and to the last kernel
+  points of the data, which are used by the "interp" edge mode. The arrays are
+  computed once per (kernel, order, deriv) and cached.
+  """
+
+  try:
+    kernel = abs(int(kernel))
+    order = abs(int(order))
+  except ValueError:
+    raise ValueError("kernel and order have to be of type int (floats will be converted).")
+  if kernel % 2 != 1 or kernel < 1:
+    raise TypeError("kernel size must be a positive odd number, was: %d" % kernel)
+  if kernel < order + 2:
+    raise TypeError("kernel is to small for the polynomals\nshould be > order + 2")
+
+  cacheKey = (kernel, order, deriv)
+  if cacheKey not in _savgolCache:
+    # a second order polynomal has 3 coefficients
+    halfWindow = (kernel - 1) // 2
+    offsets = numpy.arange(-halfWindow, halfWindow + 1, dtype = float)
+    powers = numpy.arange(order + 1)
+    pinv = numpy.linalg.pinv(offsets[:, numpy.newaxis] ** powers)
+
+    # The derivative of the fitted polynomial at offset t is the sum over the powers p of p!/(p-deriv)! c_p t^(p-deriv).
+    scale = numpy.array([numpy.prod(numpy.arange(power - deriv + 1, power + 1)) if power >= deriv else 0. for power in powers])
+
+    # At the center of the window (t = 0) only the term p = deriv survives.
+    weights = scale[deriv] * pinv[deriv]
+
+    # At the edges, evaluate the derivative of the fitted polynomial at the offsets of the points the center weights can't reach.
+    exponents = numpy.clip(powers - deriv, 0, None)
+    left = (scale * offsets[:halfWindow, numpy.newaxis] ** exponents).dot(pinv)
+    right = (scale * offsets[halfWindow + 1:, numpy.newaxis] ** exponents).dot(pinv)
+
+    for array in (weights, left, right):
+      array.flags.writeable = False
+    _savgolCache[cacheKey] = (weights, left, right)
+
+  return _savgolCache[cacheKey]
+
+def savitzky_golay(data, kernel = 13, order = 3, deriv = 0, mode = "zero"):
+  """
+  Return smooth or differentiated data according to the Savitzky-Golay
+  algorithm.
+
+  The filter is applied along the last axis of data, so a 2-D array holding
+  one spectrum per row is filtered in a single call. The returned array has
+  the same shape as data. Input arguments as well as their default values are
+  given as follows:
+    data: A numpy array (or anything numpy.asarray accepts).
+    kernel: A positive odd integer giving the number of points the algorithm
+      should consider. Default = 13.
+    order: A positive integer giving the order of the polynomial. Default = 3.
+    deriv: The order of the derivative to return; 0 smooths. Default = 0.
+    mode: How the first and last kernel/2 points are treated. "zero" pads the
+      data with zeros, which pulls the edges towards zero. "interp" fits a
+      polynomial to the first and last kernel points and evaluates it at the
+      edge points instead; the data needs at least kernel points for this.
+      Default = "zero".
+
+  The implementation of Savitzky-Golay was originally copied and slightly
+  modified from the SciPy cookbook:
+    http://www.scipy.org/Cookbook/SavitzkyGolay
+
+  See the original Savitzky-Golay paper at DOI: 10.1021/ac60214a047
+  """
+
+  if mode not in ("zero", "interp"):
+    raise ValueError("mode must be \"zero\" or \"interp\", was: %s" % mode)
+  weights, left, right = savgol_coeffs(kernel, order, deriv)
+  halfWindow = len(weights) // 2
+
+  data = numpy.asarray(data, dtype = float)
+  length = data.shape[-1]
+
+  # temporary data, with padded zeros (since we want the same length after smoothing)
+  padded = numpy.zeros(data.shape[:-1] + (length + 2 * halfWindow,))
+  padded[..., halfWindow:halfWindow + length] = data
+
+  # Accumulate one shifted copy of the data per weight; the kernel is short, so this loop is over a handful of whole-array operations.
+  result = numpy.zeros(data.shape)
+  for offset, weight in enumerate(weights):
+    result += weight * padded[..., offset:offset + length]
+
+  if mode == "interp" and halfWindow > 0:
+    if length < len(weights):
+      raise ValueError("mode \"interp\" needs at least kernel = %d points, got %d" % (len(weights), length))
+    result[..., :halfWindow] = data[..., :len(weights)].dot(left.T)
+    result[..., length - halfWindow:] = data[..., length - len(weights):].dot(right.T)
+
+  return result
+
+def window_indices(energy, lo = None, hi = None):
+  """
+  Returns the (index1, index2) of the elements of a monotonic energy axis with lo <= energy <= hi.
+
+  Both indices are included, as for integrate and gaussian_fit. The axis may
+  be increasing (e.g. KE) or decreasing (e.g. BE), and is searched with a
+  binary search, so each window costs O(log n) whatever the length of the
+  axis. A bound of None means the corresponding end of the axis. lo and hi
+  may be arrays, to find many windows at once, in which case index1 and
+  index2 are arrays too. A window holding no element of the axis has index2
+  = index1 - 1.
+  """
+
+  energy = numpy.asarray(energy)
+  if lo is None:
+    lo = min(energy[0], energy[-1])
+  if hi is None:
+    hi = max(energy[0], energy[-1])
+  if len(energy) > 1 and energy[0] > energy[-1]:
+    # Search the increasing view of a decreasing axis, and count the indices from its other end.
+    increasing = energy[::-1]
+    return len(energy) - numpy.searchsorted(increasing, hi, "right"), len(energy) - 1 - numpy.searchsorted(increasing, lo, "left")
+  return numpy.searchsorted(energy, lo, "left"), numpy.searchsorted(energy, hi, "right") - 1
+
+def window(energy, lo = None, hi = None):
+  """
+  Returns the slice of a monotonic energy axis with lo <= energy <= hi.
+
+  The axis may be increasing (e.g. KE) or decreasing (e.g. BE), see
+  window_indices. A bound of None means the corresponding end of the axis.
+  Raises ValueError if no element of the axis lies within the bounds.
+  """
+
+  index1, index2 = window_indices(energy, lo, hi)
+  if index2 < index1:
+    raise ValueError("no data between %g and %g eV" % (numpy.min(energy) if lo is None else lo, numpy.max(energy) if hi is None else hi))
+  return slice(int(index1), int(index2) + 1)
+
+def linear_background(energy, counts):
+  """
+  Returns the straight line joining the first and last counts.
+
+  energy is a 1-D array and counts an array whose last axis runs along
+  energy; each row of a 2-D counts array gets its own background.
+  """
+
+  energy = numpy.asarray(energy, dtype = float)
+  counts = numpy.asarray(counts, dtype = float)
+  fraction = (energy - energy[0]) / (energy[-1] - energy[0])
+  return counts[..., :1] + (counts[..., -1:] - counts[..., :1]) * fraction
+
+def shirley_background(energy, counts, tol = 1e-6, maxiter = 50):
+  """
+  Returns the Shirley background of counts along a binding energy axis.
+
+  The background at each energy is proportional to the area of the signal
+  above the background on the low binding energy side of that energy. It
+  runs from the counts at the low binding energy end of the data to the
+  counts at the high binding energy end. The area is computed as a cumulative
+  trapezoid integral for every row at once, and the iteration stops when no
+  point of the background changes by more than tol times the largest count,
+  or after maxiter iterations.
+  """
+
+  energy = numpy.asarray(energy, dtype = float)
+  counts = numpy.asarray(counts, dtype = float)
+
+  # Work with the low binding energy end first.
+  reverse = energy[0] > energy[-1]
+  if reverse:
+    energy = energy[::-1]
+    counts = counts[..., ::-1]
+
+  low = counts[..., :1]
+  high = counts[..., -1:]
+  steps = numpy.diff(energy)
+  tolerance = tol * numpy.abs(counts).max()
+
+  background = numpy.repeat(low, counts.shape[-1], axis = -1)
+  for iteration in range(maxiter):
+    signal = counts - background
+    area = numpy.zeros(counts.shape)
+    area[..., 1:] = numpy.cumsum(0.5 * (signal[..., 1:] + signal[..., :-1]) * steps, axis = -1)
+    total = area[..., -1:]
+    # A row without any signal above its background keeps a flat background.
+    total = numpy.where(total == 0, 1., total)
+    newBackground = low + (high - low) * area / total
+    converged = numpy.abs(newBackground - background).max() <= tolerance
+    background = newBackground
+    if converged:
+      break
+
+  if reverse:
+    background = background[..., ::-1]
+  return background
+
+# Fourier transforms of the Tougaard kernel, keyed by (points, step, C, fft length).
+_tougaardCache = {}
+
+def tougaard_background(energy, counts, C = 1643.):
+  """
+  Returns the Tougaard background of counts along a binding energy axis.
+
+  The background at each energy is the convolution of the counts on its low
+  binding energy side with the universal inelastic scattering cross section
+  K(T) = T / (C + T^2)^2, where T is the energy loss and C is in eV^2. The
+  counts at the low binding energy end are taken as a constant offset, and
+  the background is scaled to meet the counts at the high binding energy end.
+  The energy axis has to be evenly spaced. The convolution is done with
+  FFTs over every row at once, and the transform of the kernel is cached.
+  """
+
+  energy = numpy.asarray(energy, dtype = float)
+  counts = numpy.asarray(counts, dtype = float)
+
+  reverse = energy[0] > energy[-1]
+  if reverse:
+    energy = energy[::-1]
+    counts = counts[..., ::-1]
+
+  points = counts.shape[-1]
+  step = abs(energy[1] - energy[0])
+  length = 1
+  while length < 2 * points:
+    length *= 2
+
+  cacheKey = (points, step, C, length)
+  if cacheKey not in _tougaardCache:
+    loss = numpy.arange(points) * step
+    kernel = numpy.zeros(length)
+    kernel[:points] = step * loss / (C + loss ** 2) ** 2
+    _tougaardCache[cacheKey] = numpy.fft.rfft(kernel)
+  kernelTransform = _tougaardCache[cacheKey]
+
+  # The background at point i collects the counts at points j < i (lower binding energy) weighted by K((i - j) * step).
+  low = counts[..., :1]
+  signal = counts - low
+  convolution = numpy.fft.irfft(numpy.fft.rfft(signal, length, axis = -1) * kernelTransform, length, axis = -1)[..., :points]
+  scale = signal[..., -1:] / numpy.where(convolution[..., -1:] == 0, 1., convolution[..., -1:])
+  background = low + scale * convolution
+
+  if reverse:
+    background = background[..., ::-1]
+  return background
+
+def background(energy, counts, model = "linear", blend = 0.5, **args):
+  """
+  Returns the background of counts along a binding energy axis.
+
+  model is a string indicating the background model: "linear", "shirley",
+  "tougaard", or "blended" for a blended Shirley type background, which is
+  blend times the Shirley background plus (1 - blend) times the linear one.
+  Any other keyword arguments are passed on to the background function.
+  counts may be 2-D with one spectrum per row.
+  """
+
+  if model == "linear":
+    return linear_background(energy, counts)
+  elif model == "shirley":
+    return shirley_background(energy, counts, **args)
+  elif model == "tougaard":
+    return tougaard_background(energy, counts, **args)
+  elif model == "blended":
+    return blend * shirley_background(energy, counts, **args) + (1 - blend) * linear_background(energy, counts)
+  else:
+    raise ValueError("model must be \"linear\", \"shirley\", \"tougaard\" or \"blended\", was: %s" % model)
+
+def resize(energy, values, size):
+  """
+  Returns values linearly interpolated onto size evenly spaced energies.
+
+  The new energies run from the first to the last element of energy, which
+  has to be monotonic. values may be 2-D with one spectrum per row; the
+  interpolation weights are computed once and applied to every row.
+  """
+
+  energy = numpy.asarray(energy, dtype = float)
+  values = numpy.asarray(values, dtype = float)
+  if len(energy) == 1:
+    return numpy.repeat(values, size, axis = -1)
+
+  # Fractional index of each new energy along the old axis; the old axis has to be increasing for numpy.interp.
+  newEnergy = numpy.linspace(energy[0], energy[-1], size)
+  indices = numpy.arange(len(energy), dtype = float)
+  if energy[0] > energy[-1]:
+    position = numpy.interp(newEnergy, energy[::-1], indices[::-1])
+  else:
+    position = numpy.interp(newEnergy, energy, indices)
+  lower = numpy.clip(numpy.floor(position).astype(int), 0, len(energy) - 2)
+  fraction = position - lower
+  return values[..., lower] * (1 - fraction) + values[..., lower + 1] * fraction
+
+def resample(energies, counts, grid, fill = numpy.nan):
+  """
+  Returns many spectra linearly interpolated onto one shared energy grid.
+
+  Spectra from different sessions have slightly different energy axes, and
+  even different numbers of points. Every spectrum is interpolated in a
+  single batch. Spectra sharing one axis need a single binary search of the
+  grid along it, and the weights are applied to every spectrum at once.
+  Otherwise the axes are shifted apart by a fixed offset per spectrum and
+  joined into one increasing array, so that one binary search finds the
+  neighbours of every grid energy in every spectrum. Input arguments as well
+  as their default values are given as follows:
+    energies: A sequence with the monotonic energy axis of each spectrum,
+      increasing or decreasing, each with at least two points. A 1-D array
+      is the axis of every spectrum.
+    counts: A sequence with the counts of each spectrum along its axis, or
+      a 2-D array with one spectrum per row.
+    grid: A monotonic 1-D array of the energies to interpolate onto.
+    fill: The value at grid energies outside the axis of a spectrum.
+      Default = numpy.nan.
+
+  The result is a 2-D float array with one row per spectrum and one column
+  per grid energy.
+  """
+
+  grid = numpy.asarray(grid, dtype = float)
+  reverse = len(grid) > 1 and grid[0] > grid[-1]
+  if reverse:
+    grid = grid[::-1]
+
+  if numpy.ndim(energies[0]) == 0:
+    # A shared axis is searched once, and the counts are a single 2-D array.
+    energy = numpy.asarray(energies, dtype = float)
+    values = numpy.atleast_2d(numpy.asarray(counts, dtype = float))
+    if len(energy) < 2 or values.shape[1] != len(energy):
+      raise ValueError("the energy axis needs at least two points, as many as the counts of each spectrum")
+    if energy[0] > energy[-1]:
+      energy = energy[::-1]
+      values = values[:, ::-1]
+    lower = numpy.clip(numpy.searchsorted(energy, grid, "right") - 1, 0, len(energy) - 2)
+    fraction = (grid - energy[lower]) / (energy[lower + 1] - energy[lower])
+    result = values[:, lower] * (1 - fraction) + values[:, lower + 1] * fraction
+    result[:, (grid < energy[0]) | (grid > energy[-1])] = fill
+    return result[:, ::-1] if reverse else result
+
+  energies = [numpy.asarray(axis, dtype = float) for axis in energies]
+  counts = [numpy.asarray(row, dtype = float) for row in counts]
+  if len(energies) != len(counts):
+    raise ValueError("there are %d energy axes for %d spectra" % (len(energies), len(counts)))
+  if len(counts) == 0:
+    return numpy.empty((0, len(grid)))
+  for indx, axis in enumerate(energies):
+    if len(axis) < 2 or len(axis) != len(counts[indx]):
+      raise ValueError("spectrum %d needs an energy axis of at least two points, as many as its counts" % indx)
+    if axis[0] > axis[-1]:
+      energies[indx] = axis[::-1]
+      counts[indx] = counts[indx][::-1]
+
+  # Shift spectrum k by k times more than the whole energy range, so the shifted axes follow one another without overlapping.
+  low = min(grid[0], min([axis[0] for axis in energies]))
+  span = max(grid[-1], max([axis[-1] for axis in energies])) - low + 1.
+  lengths = numpy.array([len(axis) for axis in energies])
+  first = numpy.concatenate([[0], numpy.cumsum(lengths)[:-1]])[:, numpy.newaxis]
+  last = first + lengths[:, numpy.newaxis] - 1
+  offsets = span * numpy.arange(len(energies))
+  energy = numpy.concatenate(energies)
+  values = numpy.concatenate(counts)
+  shifted = energy - low + numpy.repeat(offsets, lengths)
+  queries = (grid - low)[numpy.newaxis, :] + offsets[:, numpy.newaxis]
+
+  # One search for every grid energy of every spectrum, kept within each spectrum. The interpolation itself uses the unshifted energies, so the offsets cost no precision.
+  lower = numpy.searchsorted(shifted, queries, "right") - 1
+  lower = numpy.clip(lower, first, last - 1)
+  slopes = numpy.diff(values) / numpy.diff(energy)
+  result = values[lower] + slopes[lower] * (grid - energy[lower])
+  result[(grid < energy[first]) | (grid > energy[last])] = fill
+  return result[:, ::-1] if reverse else result
+
+def integrate(energy, counts, index1 = 0, index2 = None, method = "trapezoid", model = None, bindingEnergy = None, **args):
+  """
+  Returns the area under counts between pairs of indices along energy.
+
+  The area of a window runs from energy[index1] to energy[index2], both
+  included, and is positive whichever direction energy runs in. Every window
+  is computed in one pass: the integral of each interval (trapezoid) or pair
+  of intervals (Simpson) is summed cumulatively once, and the area of a window
+  is the difference of the cumulative sums at its ends. Input arguments as
+  well as their default values are given as follows:
+    energy: A monotonic 1-D array.
+    counts: An array whose last axis runs along energy; each row of a 2-D
+      array is integrated separately.
+    index1: Integer or array of integers with the first index of each window.
+      An array of shape (n, 2) holding (index1, index2) pairs is accepted if
+      index2 is None. Default = 0.
+    index2: Integer or array of integers with the last index of each window,
+      broadcast against index1. Default = the last index of energy.
+    method: "trapezoid" or "simpson". Simpson's rule for unevenly spaced
+      points is used; a window with an odd number of intervals has its last
+      interval integrated with the trapezoid rule. Default = "trapezoid".
+    model: None, or the model of a background to subtract from each window,
+      see background. A linear background is subtracted in the same
+      pass; any other model is computed separately for each window.
+      Default = None.
+    bindingEnergy: The binding energy axis the background is computed along;
+      it only has to have the spacing and direction of the binding energy.
+      Default = energy.
+    args: Any other keyword arguments are passed on to the background model.
+
+  The returned array has the shape of counts without its last axis, followed
+  by the broadcast shape of index1 and index2.
+  """
+
+  energy = numpy.asarray(energy, dtype = float)
+  counts = numpy.asarray(counts, dtype = float)
+  points = len(energy)
+
+  if index2 is None:
+    if numpy.ndim(index1) == 2 and numpy.shape(index1)[-1] == 2:
+      index1, index2 = numpy.asarray(index1)[:, 0], numpy.asarray(index1)[:, 1]
+    else:
+      index2 = points - 1
+  index1, index2 = numpy.broadcast_arrays(numpy.asarray(index1, dtype = int), numpy.asarray(index2, dtype = int))
+  index1 = numpy.where(index1 < 0, index1 + points, index1)
+  index2 = numpy.where(index2 < 0, index2 + points, index2)
+  if numpy.any(index1 < 0) or numpy.any(index2 >= points) or numpy.any(index1 > index2):
+    raise ValueError("windows must satisfy 0 <= index1 <= index2 < %d" % points)
+
+  steps = numpy.abs(numpy.diff(energy))
+  # Cumulative trapezoid integral from the first point to each point.
+  trapezoid = numpy.zeros(counts.shape)
+  trapezoid[..., 1:] = numpy.cumsum(0.5 * (counts[..., 1:] + counts[..., :-1]) * steps, axis = -1)
+
+  if method == "trapezoid":
+    area = trapezoid[..., index2] - trapezoid[..., index1]
+  elif method == "simpson":
+    # Simpson's rule on the pair of intervals starting at each point, for unevenly spaced points.
+    h0 = steps[:-1]
+    h1 = steps[1:]
+    panels = (h0 + h1) / 6 * ((2 - h1 / h0) * counts[..., :-2] + (h0 + h1) ** 2 / (h0 * h1) * counts[..., 1:-1] + (2 - h0 / h1) * counts[..., 2:])
+    # simpson[i] is the integral from point 0 or 1, whichever has the parity of i, to point i.
+    simpson = numpy.zeros(counts.shape)
+    simpson[..., 2::2] = numpy.cumsum(panels[..., 0::2], axis = -1)
+    simpson[..., 3::2] = numpy.cumsum(panels[..., 1::2], axis = -1)
+    even = index2 - (index2 - index1) % 2
+    area = simpson[..., even] - simpson[..., index1] + trapezoid[..., index2] - trapezoid[..., even]
+  else:
+    raise ValueError("method must be \"trapezoid\" or \"simpson\", was: %s" % method)
+
+  if model is not None:
+    if bindingEnergy is None:
+      bindingEnergy = energy
+    if model == "linear":
+      # Both rules integrate a straight line exactly.
+      area = area - 0.5 * (counts[..., index1] + counts[..., index2]) * numpy.abs(energy[index2] - energy[index1])
+    else:
+      area = numpy.array(area)
+      for window in numpy.ndindex(*index1.shape):
+        first, last = index1[window], index2[window]
+        if first == last:
+          continue
+        interval = slice(first, last + 1)
+        windowBackground = background(bindingEnergy[interval], counts[..., interval], model, **args)
+        area[(Ellipsis,) + window] -= integrate(energy[interval], windowBackground, 0, None, method)
+
+  return area[()]
+
+# The result of gaussian_fit. For a 2-D counts array every field gets a leading axis with one entry per row.
+GaussianFit = collections.namedtuple("GaussianFit", ["energy", "fit", "amplitudes", "centers", "widths", "coefficients", "sse", "rsquared", "converged"])
+
+def _gaussians(energy, amplitudes, centers, widths):
+  """
+  Returns the individual peaks along the last axis, and the offsets from their centers.
+  """
+
+  offsets = energy - centers[..., numpy.newaxis]
+  return amplitudes[..., numpy.newaxis] * numpy.exp(-offsets ** 2 / (2 * widths[..., numpy.newaxis] ** 2)), offsets
+
+def _gaussianguess(energy, counts, order):
+  """
+  Returns initial (amplitude, center, width) guesses of shape (rows, order, 3).
+
+  The peaks are picked greedily: the largest remaining count becomes a peak,
+  its width is estimated from the number of points above half its height,
+  and the peak is subtracted before the next one is picked.
+  """
+
+  rows = numpy.arange(counts.shape[0])
+  step = abs(energy[-1] - energy[0]) / max(len(energy) - 1, 1)
+  remaining = counts.copy()
+  guess = numpy.zeros((counts.shape[0], order, 3))
+  for peak in range(order):
+    index = remaining.argmax(axis = -1)
+    amplitude = remaining[rows, index]
+    aboveHalf = (remaining > amplitude[:, numpy.newaxis] / 2).sum(axis = -1)
+    guess[:, peak] = numpy.array([amplitude, energy[index], numpy.maximum(aboveHalf, 1) * step / 2.3548]).T
+    remaining = remaining - _gaussians(energy, guess[:, peak, 0], guess[:, peak, 1], guess[:, peak, 2])[0]
+  return guess
+
+def gaussian_fit(energy, counts, order = 1, guess = None, model = None, size = 0, maxiter = 200, tol = 1e-10, **args):
+  """
+  Returns an n-peak Gaussian fit of counts as a GaussianFit.
+
+  The sum of order peaks A exp(-(E - c)^2 / (2 w^2)) is fitted to counts by
+  Levenberg-Marquardt least squares with the analytic Jacobian of the peaks.
+  A 2-D counts array is fitted row by row in a single batch: every iteration
+  solves the damped normal equations of all rows at once. A row whose normal
+  equations are singular, such as a flat or empty spectrum, stops where it is
+  without holding up the other rows, and the centers are kept within the
+  energies of the fit. Input arguments as
+  well as their default values are given as follows:
+    energy: A monotonic 1-D array.
+    counts: An array whose last axis runs along energy; 1-D or 2-D.
+    order: The number of peaks. Default = 1.
+    guess: Initial (amplitude, center, width) of each peak, as an array of
+      shape (order, 3), or (rows, order, 3) for one guess per row, or a
+      previous GaussianFit to warm-start from. Default = None, which picks
+      the peaks greedily from the counts.
+    model: None, or the background model subtracted from counts before the
+      peaks are fitted, see background. Default = None.
+    size: The number of evenly spaced points of the returned fit. Default =
+      the number of points in energy.
+    maxiter: The maximum number of iterations. Default = 200.
+    tol: A row has converged when an iteration improves its SSE by less than
+      tol times the SSE. Default = 1e-10.
+    args: Any other keyword arguments are passed on to the background model.
+
+  The fields of the returned GaussianFit are:
+    energy: The size evenly spaced energies the fit is evaluated at.
+    fit: The sum of the fitted peaks and the background at those energies.
+    amplitudes, centers, widths: The parameters of each peak. The widths are
+      standard deviations.
+    coefficients: The area of each peak relative to the total area.
+    sse: The sum of the squared errors of the fit.
+    rsquared: The coefficient of determination of the fit.
+    converged: True if the fit stopped because no step improved its SSE any
+      more, False if it ran out of iterations or its normal equations were
+      singular.
+  """
+
+  energy = numpy.asarray(energy, dtype = float)
+  counts = numpy.asarray(counts, dtype = float)
+  single = counts.ndim == 1
+  counts = counts.reshape(-1, counts.shape[-1])
+  rowCount = counts.shape[0]
+
+  if model is not None:
+    backgroundCounts = background(energy, counts, model, **args)
+  else:
+    backgroundCounts = numpy.zeros(counts.shape)
+  signal = counts - backgroundCounts
+
+  if guess is None:
+    parameters = _gaussianguess(energy, signal, order)
+  else:
+    if isinstance(guess, GaussianFit):
+      guess = numpy.stack([guess.amplitudes, guess.centers, guess.widths], axis = -1)
+    parameters = numpy.array(numpy.broadcast_to(numpy.asarray(guess, dtype = float), (rowCount, order, 3)))
+
+  def residuals(parameters):
+    peaks = _gaussians(energy, parameters[..., 0], parameters[..., 1], parameters[..., 2])[0]
+    return signal - peaks.sum(axis = 1)
+
+  residual = residuals(parameters)
+  sse = (residual ** 2).sum(axis = -1)
+  damping = numpy.full(rowCount, 1e-3)
+  active = numpy.ones(rowCount, dtype = bool)
+  singular = numpy.zeros(rowCount, dtype = bool)
+  for iteration in range(maxiter):
+    # Analytic Jacobian of the peaks with respect to amplitude, center and width, shape (rows, points, order * 3).
+    amplitudes, centers, widths = parameters[..., 0], parameters[..., 1], parameters[..., 2]
+    peaks, offsets = _gaussians(energy, amplitudes, centers, widths)
+    shape = numpy.exp(-offsets ** 2 / (2 * widths[..., numpy.newaxis] ** 2))
+    jacobian = numpy.stack([shape,
+                            peaks * offsets / widths[..., numpy.newaxis] ** 2,
+                            peaks * offsets ** 2 / widths[..., numpy.newaxis] ** 3], axis = -1)
+    jacobian = jacobian.transpose(0, 2, 1, 3).reshape(rowCount, len(energy), order * 3)
+
+    normal = numpy.einsum("rpi,rpj->rij", jacobian, jacobian)
+    gradient = numpy.einsum("rpi,rp->ri", jacobian, residual)
+    diagonal = numpy.maximum(numpy.diagonal(normal, axis1 = 1, axis2 = 2), 1e-12)
+    damped = normal + damping[:, numpy.newaxis, numpy.newaxis] * (diagonal[:, :, numpy.newaxis] * numpy.eye(order * 3))
+    delta = numpy.zeros((rowCount, order * 3))
+    try:
+      delta[active] = numpy.linalg.solve(damped[active], gradient[active][..., numpy.newaxis])[..., 0]
+    except numpy.linalg.LinAlgError:
+      # Solve row by row, so that a singular system only stops its own row.
+      for row in numpy.nonzero(active)[0]:
+        try:
+          delta[row] = numpy.linalg.solve(damped[row], gradient[row])
+        except numpy.linalg.LinAlgError:
+          singular[row] = True
+    singular |= active & ~numpy.isfinite(delta).all(axis = -1)
+    active &= ~singular
+    delta[singular] = 0
+
+    trial = parameters + delta.reshape(rowCount, order, 3)
+    trial[..., 1] = numpy.clip(trial[..., 1], energy.min(), energy.max())
+    trialResidual = residuals(trial)
+    trialSse = (trialResidual ** 2).sum(axis = -1)
+
+    accept = active & (trialSse < sse)
+    converged = accept & (sse - trialSse <= tol * sse)
+    parameters[accept] = trial[accept]
+    residual[accept] = trialResidual[accept]
+    sse = numpy.where(accept, trialSse, sse)
+    damping = numpy.where(accept, damping / 10, damping * 10)
+    active &= ~converged & (damping < 1e12)
+    if not active.any():
+      break
+
+  converged = ~active & ~singular
+  amplitudes, centers, widths = parameters[..., 0], parameters[..., 1], numpy.abs(parameters[..., 2])
+  areas = amplitudes * widths
+  total = areas.sum(axis = -1)[:, numpy.newaxis]
+  coefficients = areas / numpy.where(total == 0, 1., total)
+  spread = ((signal - signal.mean(axis = -1)[:, numpy.newaxis]) ** 2).sum(axis = -1)
+  rsquared = 1 - sse / numpy.where(spread == 0, 1., spread)
+
+  if not size:
+    size = len(energy)
+  fitEnergy = numpy.linspace(energy[0], energy[-1], size)
+  fit = _gaussians(fitEnergy, amplitudes, centers, widths)[0].sum(axis = 1) + resize(energy, backgroundCounts, size)
+
+  if single:
+    return GaussianFit(fitEnergy, fit[0], amplitudes[0], centers[0], widths[0], coefficients[0], sse[0], rsquared[0], converged[0])
+  return GaussianFit(fitEnergy, fit, amplitudes, centers, widths, coefficients, sse, rsquared, converged)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+import bz2
+import fnmatch
+import io
+import os
+import zlib
+
+# lzma, for .xz files, is only part of python 3.3 and later.
+try:
+  import lzma
+except ImportError:
+  lzma = None
+
+def _gzipdecompressor():
+  """
+  Returns a decompressor for a gzip stream.
+  """
+
+  return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def _xzdecompressor():
+  """
+  Returns a decompressor for an xz stream.
+  """
+
+  if lzma is None:
+    raise IOError("reading .xz files needs the lzma module of python 3.3 or later")
+  return lzma.LZMADecompressor()
+
+# The suffixes of compressed files and the decompressors of their streams.
+_DECOMPRESSORS = {".gz":_gzipdecompressor,
+                  ".bz2":bz2.BZ2Decompressor,
+                  ".xz":_xzdecompressor}
+
+# The errors a decompressor raises for data that isn't valid.
+_ERRORS = (zlib.error, EOFError, ValueError, IOError, OSError) + ((lzma.LZMAError,) if lzma is not None else ())
+
+def compression(name):
+  """
+  Returns the suffix of a compressed file, ".gz", ".bz2" or ".xz", or None if name isn't one.
+  """
+
+  suffix = os.path.splitext(name)[1].lower()
+  if suffix in _DECOMPRESSORS:
+    return suffix
+  return None
+
+def _ended(decompressor):
+  """
+  Returns whether the compressed stream of decompressor has ended.
+  """
+
+  if hasattr(decompressor, "eof"):
+    return decompressor.eof
+  # The decompressors of python 2 don't say so, but once their stream has ended they set aside any further data, or refuse it, instead of decompressing it.
+  try:
+    decompressor.decompress(b"\0")
+  except EOFError:
+    return True
+  except _ERRORS:
+    return False
+  return len(decompressor.unused_data) != 0
+
+def decompress(fileobj, suffix, blockSize = 64 * 1024):
+  """
+  Yields the lines of a compressed binary file as bytes, decompressing it a block at a time.
+
+  suffix is the compression of the file, as returned by compression. Only a
+  block of the compressed file and the lines decompressed from it are held
+  in memory at a time, so the file can be a stream that can't seek, e.g. a
+  member of a tar archive. Several compressed streams one after the other,
+  as made by concatenating .gz files, are read as one. Raises IOError if the
+  data isn't valid or ends before the end of the compressed stream.
+  """
+
+  factory = _DECOMPRESSORS[suffix]
+  decompressor = factory()
+  pending = b""
+  while True:
+    block = fileobj.read(blockSize)
+    if len(block) == 0:
+      break
+    decompressed = []
+    while len(block) != 0:
+      # A new compressed stream may start right after the previous one ended.
+      if getattr(decompressor, "eof", False):
+        decompressor = factory()
+      try:
+        decompressed.append(decompressor.decompress(block))
+      except _ERRORS as error:
+        raise IOError("the %s data isn't valid: %s" % (suffix, error))
+      block = decompressor.unused_data
+      if len(block) != 0:
+        decompressor = factory()
+    lines = (pending + b"".join(decompressed)).split(b"\n")
+    pending = lines.pop()
+    for line in lines:
+      yield line + b"\n"
+
+  if not _ended(decompressor):
+    raise IOError("the %s data ends before the end of the compressed stream" % suffix)
+  if len(pending) != 0:
+    yield pending
+
+def open_dat(filename, mode = "r"):
+  """
+  Returns an iterator of the lines of a .dat file, decompressing it on the fly if needed.
+
+  A file whose name ends in .gz, .bz2 or .xz is decompressed a block at a
+  time as its lines are read, without writing it anywhere, and its lines are
+  bytes. Any other file is simply opened with mode, "r" or "rb"; in text mode
+  it is decoded as latin-1, like the lines of every other source. Call
+  close() on the iterator when done with it, to close the file.
+  """
+
+  suffix = compression(filename)
+  if suffix is None:
+    if "b" in mode:
+      return open(filename,mode)
+    return io.open(filename,mode,encoding = "latin-1")
+  return _decompressfile(filename, suffix)
+
+def _decompressfile(filename, suffix):
+  """
+  Yields the lines of a compressed file, closing the file when done or closed.
+  """
+
+  datFile = open(filename,"rb")
+  try:
+    for line in decompress(datFile, suffix):
+      yield line
+  finally:
+    datFile.close()
+
+def iter_archive(archive, pattern = "*.dat", **options):
+  """
+  Yields a BatchResult for each .dat file in a zip or tar archive.
+
+  The members are read one by one straight from the archive, and decompressed
+  on the fly if they are compressed themselves, without extracting anything
+  to disk. A tar archive, compressed or not, is read as a stream from start
+  to end. Like load_many, a member that raises FormatError, can't be read or
+  fails in any other way gives a BatchResult carrying the exception instead
+  of stopping the iteration. Input arguments as well as their default values
+  are given as follows:
+    archive: The filename of a .zip, .tar, .tar.gz, .tar.bz2 or .tar.xz file.
+    pattern: The members whose name, without any directory and compression
+      suffix, matches this pattern are read. The match is case insensitive.
+      Default = "*.dat", which also reads e.g. "session/1.dat.gz".
+    options: Any other keyword arguments are passed on to StaibDat, e.g.
+      compact = True.
+
+  The filename of each BatchResult, and the filename key of its StaibDat
+  object, is the name of the member in the archive.
+  """
+
+  import zipfile
+  if zipfile.is_zipfile(archive):
+    zipFile = zipfile.ZipFile(archive)
+    try:
+      for info in zipFile.infolist():
+        if not info.filename.endswith("/") and _matches(info.filename, pattern):
+          yield _loadmember(info.filename, lambda: zipFile.open(info), options)
+    finally:
+      zipFile.close()
+  else:
+    import tarfile
+    tarFile = tarfile.open(archive, "r|*")
+    try:
+      for info in tarFile:
+        if info.isfile() and _matches(info.name, pattern):
+          yield _loadmember(info.name, lambda: tarFile.extractfile(info), options)
+    finally:
+      tarFile.close()
+
+def _matches(name, pattern):
+  """
+  Returns whether the name of a member, without directory and compression suffix, matches pattern.
+  """
+
+  name = name.rsplit("/", 1)[-1]
+  if compression(name) is not None:
+    name = os.path.splitext(name)[0]
+  return fnmatch.fnmatch(name.lower(), pattern.lower())
+
+def _loadmember(name, openmember, options):
+  """
+  Returns the BatchResult of loading the member name of an archive, opened by calling openmember.
+  """
+
+  from .StaibDat import StaibDat
+  from .Batch import BatchResult
+  try:
+    member = openmember()
+    try:
+      suffix = compression(name)
+      SD = StaibDat(member if suffix is None else decompress(member, suffix), **options)
+    finally:
+      member.close()
+  except Exception as error:
+    return BatchResult(name, None, error)
+  SD["filename"] = name
+  return BatchResult(name, SD, None)
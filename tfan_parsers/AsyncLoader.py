@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+from .StaibDat import StaibDat
+import asyncio
+import io
+
+try:
+  _basestring = basestring
+except NameError:
+  _basestring = str
+
+def _loadfile(filename, options):
+  """
+  Returns the StaibDat object of a file; run in the executor of an AsyncLoader.
+  """
+
+  return StaibDat(filename, **options)
+
+def _loadbytes(content, name, options):
+  """
+  Returns the StaibDat object of the content of a file; run in the executor of an AsyncLoader.
+  """
+
+  stream = io.BytesIO(content)
+  stream.name = name
+  return StaibDat(stream, **options)
+
+class AsyncLoader(object):
+  """
+  Loads StaibDat objects from an asyncio event loop without blocking it.
+
+  Constructing a StaibDat object reads, parses and verifies the whole file in
+  one go, which would stall every other task of an event loop for the
+  duration. An AsyncLoader reads network streams in the event loop, a block
+  at a time as the data arrives, and hands the parsing and verification to an
+  executor. Input arguments as well as their default values are given as
+  follows:
+    executor: A concurrent.futures executor for the parsing. Threads keep
+      the loop responsive; a ProcessPoolExecutor also parses on several
+      cores at once, in which case the options and the StaibDat objects are
+      pickled between the processes and stats isn't updated. Default = None,
+      for the default executor of the event loop.
+    limit: The largest number of files read and parsed at once. Any further
+      loads wait for one of them to finish before they start reading, so at
+      most limit files are held in memory however many uploads arrive.
+      Default = 4.
+    options: Any other keyword arguments are passed on to StaibDat, e.g.
+      compact = True.
+
+  load returns an asyncio future, to be awaited in a coroutine, e.g.:
+    loader = AsyncLoader(compact = True)
+    async def handle(reader, writer):
+      SD = await loader.load(reader, name = "upload.dat")
+  An AsyncLoader may be shared by any number of tasks of one event loop.
+  """
+
+  # The number of bytes asked for at a time when reading a stream.
+  blockSize = 64 * 1024
+
+  def __init__(self, executor = None, limit = 4, **options):
+    """
+    Instantiation of AsyncLoader object.
+    """
+
+    if limit < 1:
+      raise ValueError("limit must be at least 1, was: %r" % (limit,))
+    self.executor = executor
+    self.limit = limit
+    self.options = options
+    self.__semaphore = None
+    self.__loop = None
+
+  def load(self, source, name = None):
+    """
+    Returns a future of the StaibDat object of source.
+
+    source is the filename of a .dat file, the bytes of one, or a stream with
+    a read coroutine such as an asyncio.StreamReader, which is read to its
+    end. A filename is opened and read in the executor, as files on disk
+    can't be read without blocking. name is the filename key of the object
+    when source isn't a filename. The future raises FormatError, or the error
+    reading the source, if the file can't be loaded.
+    """
+
+    loop = asyncio.get_event_loop()
+    if self.__loop is not loop:
+      self.__loop = loop
+      self.__semaphore = asyncio.Semaphore(self.limit)
+    result = loop.create_future()
+    semaphore = self.__semaphore
+    acquire = asyncio.ensure_future(semaphore.acquire())
+    acquire.add_done_callback(lambda acquire: self.__start(source, name, result, semaphore))
+    return result
+
+  def __start(self, source, name, result, semaphore):
+    """
+    Start loading source once one of the limit slots is free.
+    """
+
+    if result.cancelled():
+      semaphore.release()
+      return
+    if isinstance(source, _basestring):
+      self.__parse(_loadfile, (source, self.options), result, semaphore)
+    elif isinstance(source, bytes):
+      self.__parse(_loadbytes, (source, name, self.options), result, semaphore)
+    else:
+      self.__read(source, name, [], result, semaphore)
+
+  def __read(self, stream, name, blocks, result, semaphore):
+    """
+    Read the next block of stream, and parse the blocks once it ends.
+    """
+
+    try:
+      block = asyncio.ensure_future(stream.read(self.blockSize))
+    except Exception as error:
+      self.__finish(error, None, result, semaphore)
+      return
+
+    def done(block):
+      if result.cancelled() or block.cancelled() or block.exception() is not None:
+        self.__finish(None if block.cancelled() else block.exception(), None, result, semaphore)
+      elif len(block.result()) != 0:
+        blocks.append(block.result())
+        self.__read(stream, name, blocks, result, semaphore)
+      else:
+        self.__parse(_loadbytes, (b"".join(blocks), name, self.options), result, semaphore)
+    block.add_done_callback(done)
+
+  def __parse(self, function, args, result, semaphore):
+    """
+    Run function with args in the executor and hand its outcome to result.
+    """
+
+    job = self.__loop.run_in_executor(self.executor, function, *args)
+
+    def done(job):
+      if job.cancelled():
+        self.__finish(None, None, result, semaphore)
+      else:
+        self.__finish(job.exception(), None if job.exception() is not None else job.result(), result, semaphore)
+    job.add_done_callback(done)
+
+  def __finish(self, error, SD, result, semaphore):
+    """
+    Free the slot of a load and settle its future; without an error or object, it is cancelled.
+    """
+
+    semaphore.release()
+    if result.cancelled():
+      return
+    if error is not None:
+      result.set_exception(error)
+    elif SD is not None:
+      result.set_result(SD)
+    else:
+      result.cancel()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+from .StaibDat import StaibDat
+from .ParseStats import ParseStats
+import collections
+import glob
+import multiprocessing
+
+# The outcome of loading a single file with load_many. data is the StaibDat object, or None if loading the file failed, in which case error holds the exception.
+BatchResult = collections.namedtuple("BatchResult", ["filename", "data", "error"])
+
+try:
+  _basestring = basestring
+except NameError:
+  _basestring = str
+
+def _load(job):
+  """
+  Loads a single file for load_many and returns a BatchResult and a list of FileStats.
+
+  Any exception raised loading the file, whether the file isn't a valid
+  winspectro file, can't be read or decoded, or lacks a key StaibDat needs,
+  gives a BatchResult carrying the exception instead of stopping the batch. If the
+  job asks for stats, the FileStats of the file are collected in the process
+  that loads it, to be added up by the calling process; otherwise the list is
+  empty.
+  """
+
+  filename, options, recordStats = job
+  records = []
+  if recordStats:
+    options = dict(options, stats = ParseStats(records.append))
+  try:
+    return BatchResult(filename, StaibDat(filename, **options), None), records
+  except Exception as error:
+    return BatchResult(filename, None, error), records
+
+def _collect(loaded, stats):
+  """
+  Yields the BatchResult of each (BatchResult, records) pair, adding the records to stats.
+  """
+
+  for result, records in loaded:
+    for record in records:
+      stats.add(record)
+    yield result
+
+def load_many(paths, workers = None, ordered = True, chunksize = 1, stats = None, **options):
+  """
+  Loads many winspectro .dat files across a pool of processes.
+
+  Returns an iterator of BatchResult, one per file. Results are yielded as
+  soon as they are available, so the caller can start on the first files
+  while the rest are still being parsed. Files that raise FormatError, can't
+  be read or fail in any other way don't abort the batch; their BatchResult has data None and
+  the exception in error. Input arguments as well as their default values are
+  given as follows:
+    paths: A list of filenames, or a string with a glob pattern such as
+      "archive/2010-02-*/*.dat", which is expanded in sorted order.
+    workers: The number of worker processes. With 1, the files are loaded in
+      the calling process without a pool. Default: the number of CPUs.
+    ordered: If True, results come back in the order of paths. If False,
+      they come back in the order the files finish. Default = True.
+    chunksize: The number of files handed to a worker at a time. Larger
+      values cut the inter-process overhead for many small files. Default = 1.
+    stats: A ParseStats object to record every file in, see StaibDat. Each
+      worker records its files and the records are added to stats, and
+      passed to its callback, in the calling process as the results come
+      back. Default = None.
+    options: Any other keyword arguments are passed on to StaibDat, e.g.
+      compact = True.
+  """
+
+  if isinstance(paths, _basestring):
+    paths = sorted(glob.glob(paths))
+  jobs = [(filename, options, stats is not None) for filename in paths]
+  if stats is None:
+    stats = ParseStats()
+
+  if workers is None:
+    workers = multiprocessing.cpu_count()
+  if workers == 1 or len(jobs) <= 1:
+    return _collect((_load(job) for job in jobs), stats)
+  return _collect(_pooled(jobs, workers, ordered, chunksize), stats)
+
+def _pooled(jobs, workers, ordered, chunksize):
+  """
+  Yields the results of _load over a process pool, shutting the pool down afterwards.
+  """
+
+  pool = multiprocessing.Pool(min(workers, len(jobs)))
+  try:
+    if ordered:
+      results = pool.imap(_load, jobs, chunksize)
+    else:
+      results = pool.imap_unordered(_load, jobs, chunksize)
+    for result in results:
+      yield result
+    pool.close()
+  finally:
+    # Reached early if the caller stops iterating or an exception is raised.
+    pool.terminate()
+    pool.join()
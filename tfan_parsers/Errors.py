@@ -1,7 +1,101 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import numbers
+
+# A single problem found in a file: the cause code of the check that failed, the line of the file it was found on (None if unknown), and the value the check expected and the value actually found.
+Violation = collections.namedtuple("Violation", ["cause", "line", "expected", "actual"])
+
 class FormatError(Exception):
   """
+  Raised when a file isn't a valid winspectro .dat file.
+
+  The cause attribute is a short code saying which check failed, or None if
+  unknown:
+    syntax: A line looks like part of a section but doesn't parse.
+    structure: A line doesn't belong to any section, the sections are out of
+      order or missing, or there is more than one datakeys line.
+    columns: A line of the data section has a different number of values
+      than there are datakeys.
+    metadata: DataPoints, Startenergy, Stopenergy or Stepwidth is missing
+      from the metadata section or isn't a number, so the data can't be
+      checked against it.
+    datapoints: DataPoints differs from the number of lines of data.
+    startenergy, stopenergy: Startenergy or Stopenergy differs from the first
+      or last Basis value.
+    stepsize: The steps between Basis values aren't consistent.
+    stepwidth: Stepwidth differs from the step between Basis values.
+    dtype: A value of the data section isn't a whole number, or doesn't fit
+      the integer type asked for by StaibDat's dtype argument.
+  The violations attribute is a list of Violation giving the details of every
+  problem found, see StaibDat's collect argument for finding more than the
+  first one.
+  """
+
+  def __init__(self, message = "", cause = None, violations = None):
+    Exception.__init__(self, message)
+    self.cause = cause
+    self.violations = list(violations or [])
+
+  def __reduce__(self):
+    # Keep the cause and violations when the error is sent between processes.
+    return (self.__class__, (self.args[0] if self.args else "", self.cause, self.violations))
+
+# The metadata the data section is checked against, in the order the checks are reported.
+CHECKEDKEYS = ("DataPoints", "Stopenergy", "Startenergy", "Stepwidth")
+
+def mergetolerances(defaults, tolerance):
+  """
+  Returns the tolerances of the checks given the tolerance argument of a reader.
+
+  tolerance is None for the defaults, a number for every check, or a
+  dictionary overriding some of the defaults, keyed by cause code.
+  """
+
+  tolerances = dict(defaults)
+  if isinstance(tolerance, dict):
+    tolerances.update(tolerance)
+  elif tolerance is not None:
+    tolerances = dict.fromkeys(tolerances, tolerance)
+  return tolerances
+
+def metadatavalue(entry):
   """
-  pass
-  
\ No newline at end of file
+  Returns the value of a metadata entry, whether or not it has a unit.
+  """
+
+  return entry.get("value") if isinstance(entry, dict) else entry
+
+def checkedmetadata(metadata, lineNumbers, violations):
+  """
+  Returns a dictionary of the numeric value of each key of CHECKEDKEYS in metadata.
+
+  A key that is missing, or isn't a number, is left out of the dictionary
+  and a "metadata" Violation is appended to violations instead, so that only
+  the checks needing it are skipped.
+  """
+
+  values = {}
+  for key in CHECKEDKEYS:
+    entry = metadata.get(key)
+    value = metadatavalue(entry)
+    if isinstance(value, numbers.Real) and not isinstance(value, bool):
+      values[key] = value
+    else:
+      violations.append(Violation("metadata", lineNumbers.get(key), "numeric %s" % key, entry))
+  return values
+
+def raiseviolations(violations, collect):
+  """
+  Raises FormatError with the first of violations, or all of them if collect is True.
+
+  Does nothing if there are no violations.
+  """
+
+  if len(violations) != 0:
+    if not collect:
+      violations = violations[:1]
+    messages = []
+    for violation in violations:
+      messages.append("%s: expected %r, found %r%s" % (violation.cause, violation.expected, violation.actual, "" if violation.line is None else " at line %d" % violation.line))
+    raise FormatError("; ".join(messages), violations[0].cause, violations)
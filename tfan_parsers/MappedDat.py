@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+from .Errors import FormatError, Violation
+from .StaibReader import StaibReader
+import mmap
+import os
+import numpy
+
+# Bytes that may appear in the data section: digits, minus signs and whitespace.
+_ALLOWED = numpy.zeros(256, dtype = bool)
+_ALLOWED[numpy.frombuffer(b"0123456789- \t\r\n", dtype = numpy.uint8)] = True
+_SPACE = numpy.zeros(256, dtype = bool)
+_SPACE[numpy.frombuffer(b" \t\r\n", dtype = numpy.uint8)] = True
+
+class MappedDat(object):
+  """
+  Memory-mapped access to the data section of a large winspectro .dat file.
+
+  A MappedDat maps the file into memory instead of reading it. On opening,
+  only the metadata section and the datakeys line are parsed; the rest of the
+  file is scanned once with numpy for the offsets of its lines, which takes
+  8 bytes per line of data. Rows of the data section are then parsed
+  straight from the mapped file into preallocated arrays, and only the rows
+  asked for, so a window of energies or a single channel of a huge file can
+  be read without reading the rest of it. Input arguments as well as their
+  default values are given as follows:
+    filename: The name of the .dat file.
+    grammar: A StaibGrammar for variants of the format. Default = None, for
+      DEFAULT_GRAMMAR.
+
+  The following attributes are available:
+    filename: The name of the file.
+    metadata: List of (key, entry) pairs of the metadata section, as in a
+      StaibDat object.
+    datakeys: List of DataKey from the datakeys line.
+    lineNumbers: Dictionary of the line number of each metadata key, and of
+      the first line of data under "datavalues".
+    offsets: Array of the byte offsets of the lines of data in the file,
+      followed by the offset of the end of the last line.
+
+  len() of a MappedDat is the number of lines of data. Each row is checked to
+  contain only integers and to have one value per datakey when it is parsed;
+  FormatError is raised otherwise. Call close(), or use the object in a with
+  statement, to unmap the file. To load the whole file into a StaibDat
+  object through the map, use StaibDat(filename, engine = "mmap").
+  """
+
+  # The number of rows parsed at a time, and the number of bytes scanned at a time for line offsets.
+  chunkRows = 4096
+  blockSize = 16 * 1024 * 1024
+
+  def __init__(self, filename, grammar = None):
+    """
+    Instantiation of MappedDat object.
+    """
+
+    self.filename = filename
+    self.__file = open(filename,"rb")
+    size = os.fstat(self.__file.fileno()).st_size
+    if size == 0:
+      self.__file.close()
+      raise FormatError("the file is empty", "structure", [Violation("structure", 0, "metadata", "end of file")])
+    self.__map = mmap.mmap(self.__file.fileno(), 0, access = mmap.ACCESS_READ)
+
+    try:
+      # Parse lines up to and including the datakeys line.
+      reader = StaibReader(grammar)
+      while reader.datakeys is None:
+        line = self.__map.readline()
+        if len(line) == 0:
+          raise FormatError("the file ends before the datakeys line", "structure", [Violation("structure", reader.lineCount, "datakeys", "end of file")])
+        reader.feed(line)
+      self.metadata = reader.metadata
+      self.datakeys = reader.datakeys
+      self.lineNumbers = dict(reader.lineNumbers)
+      self.lineNumbers["datavalues"] = reader.lineCount + 1
+
+      # Each line of data starts after a newline; the last one may not end in one.
+      dataOffset = self.__map.tell()
+      starts = [numpy.array([dataOffset])]
+      for base in range(dataOffset, size, self.blockSize):
+        block = numpy.frombuffer(self.__map, dtype = numpy.uint8, count = min(self.blockSize, size - base), offset = base)
+        starts.append(numpy.flatnonzero(block == 10) + (base + 1))
+        del block
+      offsets = numpy.concatenate(starts).astype(numpy.int64)
+      if offsets[-1] != size:
+        offsets = numpy.append(offsets, size)
+      if len(offsets) < 2:
+        raise FormatError("the file ends before the datavalues section", "structure", [Violation("structure", reader.lineCount, "datavalues", "end of file")])
+      self.offsets = offsets
+    except:
+      self.close()
+      raise
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exception):
+    self.close()
+
+  def close(self):
+    """
+    Unmap and close the file.
+    """
+
+    if self.__map is not None:
+      self.__map.close()
+      self.__map = None
+    self.__file.close()
+
+  def header(self):
+    """
+    Returns the metadata as a dictionary, as read_header does.
+    """
+
+    header = dict(self.metadata)
+    header["filename"] = self.filename
+    return header
+
+  def rows(self, start = 0, stop = None):
+    """
+    Returns the rows start to stop of the data section as a 2-D array.
+
+    The array has one column per datakey and is filled chunk by chunk
+    straight from the mapped file.
+    """
+
+    start, stop, step = slice(start, stop).indices(len(self))
+    columns = numpy.empty((max(stop - start, 0), len(self.datakeys)))
+    for first, last, values in self.__chunks(start, stop):
+      columns[first - start:last - start] = values
+    return columns
+
+  def column(self, key, start = 0, stop = None):
+    """
+    Returns a single column of the rows start to stop as a 1-D array.
+
+    key is a datakey, e.g. "Basis", or one of the StaibDat conveniences "KE",
+    "BE" or "Cn". Only the requested column is kept while the rows are parsed.
+    """
+
+    start, stop, step = slice(start, stop).indices(len(self))
+    if key in ("KE", "BE"):
+      index = 0
+    elif key[:1] == "C" and key[1:].isdigit() and 0 < int(key[1:]) < len(self.datakeys):
+      index = int(key[1:])
+    else:
+      index = [datakey.key for datakey in self.datakeys].index(key)
+
+    column = numpy.empty(max(stop - start, 0))
+    for first, last, values in self.__chunks(start, stop):
+      column[first - start:last - start] = values[:, index]
+
+    if key == "KE":
+      column /= 1000
+    elif key == "BE":
+      column = dict(self.metadata)["SourceEnergy"] - column / 1000
+    return column
+
+  def window(self, loKE = None, hiKE = None):
+    """
+    Returns the slice of rows with kinetic energies between loKE and hiKE in eV.
+
+    The rows are found by bisection on the Basis column, so only a handful of
+    rows are parsed whatever the size of the file. A bound of None means the
+    corresponding end of the data.
+    """
+
+    if len(self) == 0:
+      return slice(0, 0)
+    # Bisect on increasing values; a decreasing Basis column is negated, which swaps the bounds.
+    if self.__energy(0) <= self.__energy(len(self) - 1):
+      sign, lower, upper = 1, loKE, hiKE
+    else:
+      sign, lower, upper = -1, hiKE, loKE
+    start = 0 if lower is None else self.__bisect(lower, sign, False)
+    stop = len(self) if upper is None else self.__bisect(upper, sign, True)
+    return slice(start, max(start, stop))
+
+  def __energy(self, row):
+    """
+    Returns the kinetic energy of a single row.
+    """
+
+    return self.rows(row, row + 1)[0, 0] / 1000
+
+  def __bisect(self, energy, sign, right):
+    """
+    Returns the first row whose energy is past energy, in the direction of sign.
+
+    With right False the row's energy may also equal energy.
+    """
+
+    lo = 0
+    hi = len(self)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      value = sign * self.__energy(mid)
+      if value < sign * energy or (right and value == sign * energy):
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def __chunks(self, start, stop):
+    """
+    Yields (first, last, values) for the rows start to stop, chunkRows at a time.
+
+    values is the 2-D array of the rows first to last. Raises FormatError for
+    the first invalid row found.
+    """
+
+    columnCount = len(self.datakeys)
+    for first in range(start, stop, self.chunkRows):
+      last = min(first + self.chunkRows, stop)
+      begin = self.offsets[first]
+      text = self.__map[begin:self.offsets[last]]
+      textBytes = numpy.frombuffer(text, dtype = numpy.uint8)
+
+      invalid = numpy.flatnonzero(~_ALLOWED[textBytes])
+      if len(invalid) != 0:
+        line = self.__linenumber(begin + invalid[0])
+        raise FormatError("line %d of the data section isn't a line of integers" % line, "syntax", [Violation("syntax", line, "datavalues", "other")])
+
+      # Count the values in each row: a value starts wherever a non-space byte follows a space or the start of the row.
+      space = _SPACE[textBytes]
+      valueStarts = ~space
+      valueStarts[1:] &= space[:-1]
+      counts = numpy.add.reduceat(valueStarts.astype(numpy.int32), self.offsets[first:last] - begin)
+      wrong = numpy.flatnonzero(counts != columnCount)
+      if len(wrong) != 0:
+        line = self.lineNumbers["datavalues"] + first + int(wrong[0])
+        if counts[wrong[0]] == 0:
+          raise FormatError("line %d isn't part of any section" % line, "structure", [Violation("structure", line, None, "other")])
+        raise FormatError("line %d has %d values but there are %d datakeys" % (line, counts[wrong[0]], columnCount), "columns", [Violation("columns", line, columnCount, int(counts[wrong[0]]))])
+
+      values = numpy.fromstring(text, dtype = float, sep = " ")
+      if len(values) != (last - first) * columnCount:
+        line = self.lineNumbers["datavalues"] + first + len(values) // columnCount
+        raise FormatError("line %d of the data section isn't a line of integers" % line, "syntax", [Violation("syntax", line, "datavalues", "other")])
+      yield first, last, values.reshape(last - first, columnCount)
+
+  def __linenumber(self, offset):
+    """
+    Returns the line number of the file of the byte at offset in the data section.
+    """
+
+    return self.lineNumbers["datavalues"] + int(numpy.searchsorted(self.offsets, offset, "right")) - 1
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+from .StaibReader import StaibReader
+from .Archives import open_dat
+import fnmatch
+import os
+import sqlite3
+import time
+
+try:
+  _basestring = basestring
+except NameError:
+  _basestring = str
+
+def read_header(filename, grammar = None):
+  """
+  Returns the metadata section of a winspectro .dat file as a dictionary.
+
+  Only the lines up to the first reserved line are read. The keys and entries
+  are the same as those of a StaibDat object of the file: whitespace is
+  compressed out of the keys, values are coerced into numbers where possible,
+  and metadata with a unit becomes a dictionary with "value" and "unit"
+  entries. The dictionary also has the filename key. Like StaibDat, filename
+  may be any iterable yielding the lines of a file instead, and grammar takes
+  a StaibGrammar for variants of the format; a compressed file is only
+  decompressed up to the end of its header, see open_dat. Raises FormatError
+  if the metadata section isn't valid.
+  """
+
+  if isinstance(filename, _basestring):
+    lines = open_dat(filename,"rb")
+  else:
+    lines = filename
+  try:
+    reader = StaibReader(grammar).readheader(lines)
+  finally:
+    if lines is not filename:
+      lines.close()
+
+  header = dict(reader.metadata)
+  header["filename"] = filename if isinstance(filename, _basestring) else getattr(filename, "name", None)
+  return header
+
+def _quote(name):
+  """
+  Returns a column name quoted for SQL.
+  """
+  return '"' + name.replace('"', '""') + '"'
+
+class MetadataIndex(object):
+  """
+  Queryable SQLite index of the metadata of the winspectro files in a directory tree.
+
+  Choosing which spectra to load from a large archive shouldn't need every
+  file to be parsed. A MetadataIndex reads only the metadata section of each
+  file, see read_header, and keeps it in a single table of an SQLite
+  database, so that a selection is an SQL query. Input arguments as well as
+  their default values are given as follows:
+    database: The filename of the SQLite database. It is created if needed,
+      and an existing index is reused. Default = ":memory:", an index that is
+      forgotten when the object is.
+
+  The table, spectra, has one row per file and the following columns:
+    filename: The absolute filename of the file.
+    mtime, size: The modification time and size of the file when it was read.
+    timestamp: The Dateandtime metadata as "YYYY-MM-DDTHH:MM:SS", or NULL if
+      the file doesn't have it or it can't be read.
+    One column per metadata key, named after the key as it appears in a
+      StaibDat object, holding the value. For metadata with a unit, the unit
+      is in a second column named after the key followed by "_unit". A column
+      is NULL for files without that key.
+
+  Column names are case insensitive in SQLite, so a key whose name is
+  already taken, such as "mode" after "Mode" or a key named "size", gets a
+  column with a number appended instead, "mode_2" or "size_2". The database
+  remembers which column belongs to which key, see column.
+
+  For example, all XPS spectra from February with a Stepwidth of 0.5 eV:
+    index = MetadataIndex("archive.sqlite")
+    index.scan("archive")
+    index.select("strftime('%m', timestamp) = '02' AND abs(Stepwidth - 0.5) < 0.005", Technique = "XPS")
+  """
+
+  def __init__(self, database = ":memory:"):
+    """
+    Instantiation of MetadataIndex object.
+    """
+
+    self.database = database
+    self.connection = sqlite3.connect(database)
+    self.connection.execute("CREATE TABLE IF NOT EXISTS spectra (filename TEXT PRIMARY KEY, mtime REAL, size INTEGER, timestamp TEXT)")
+    self.connection.execute("CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY, name TEXT)")
+    self.connection.commit()
+    self.__columns = self.__tablecolumns()
+    self.__names = dict(self.connection.execute("SELECT key, name FROM keys"))
+
+  def scan(self, directory, pattern = "*.dat", grammar = None):
+    """
+    Index every file below directory whose name matches pattern.
+
+    The match is case insensitive. A file already in the index is only read
+    again if its modification time or size changed, and files that are no
+    longer below directory are removed from the index. Returns a list of
+    (filename, error) pairs for the files that couldn't be read or whose
+    metadata section isn't valid, or that failed in any other way; these
+    aren't indexed.
+    """
+
+    known = dict([(row[0], (row[1], row[2])) for row in self.connection.execute("SELECT filename, mtime, size FROM spectra")])
+    root = os.path.join(os.path.abspath(directory), "")
+    pattern = pattern.lower()
+    found = set()
+    failures = []
+
+    for dirpath, dirnames, filenames in os.walk(root):
+      dirnames.sort()
+      for name in sorted(filenames):
+        if not fnmatch.fnmatch(name.lower(), pattern):
+          continue
+        filename = os.path.join(dirpath, name)
+        found.add(filename)
+        try:
+          stat = os.stat(filename)
+          if known.get(filename) == (stat.st_mtime, stat.st_size):
+            continue
+          header = read_header(filename, grammar)
+          header["filename"] = filename
+          self.__store(header, stat)
+        except Exception as error:
+          failures.append((filename, error))
+
+    # Forget the files below directory that have gone.
+    for filename in known:
+      if filename.startswith(root) and filename not in found:
+        self.connection.execute("DELETE FROM spectra WHERE filename = ?", (filename,))
+    self.connection.commit()
+    return failures
+
+  def select(self, where = None, parameters = (), **equals):
+    """
+    Returns a sorted list of the filenames of the files matching a query.
+
+    where is an SQL expression on the columns of the spectra table, with "?"
+    placeholders filled in from parameters. Any keyword arguments select the
+    files whose metadata key of that name equals the given value. Without any
+    conditions every filename in the index is returned.
+    """
+
+    conditions = []
+    if where:
+      conditions.append("(" + where + ")")
+    parameters = list(parameters)
+    for key in sorted(equals):
+      name = self.column(key)
+      if name is None:
+        return []
+      conditions.append(_quote(name) + " = ?")
+      parameters.append(equals[key])
+
+    query = "SELECT filename FROM spectra"
+    if len(conditions) != 0:
+      query += " WHERE " + " AND ".join(conditions)
+    return [row[0] for row in self.connection.execute(query + " ORDER BY filename", parameters)]
+
+  def columns(self):
+    """
+    Returns a list of the columns of the spectra table.
+    """
+
+    return list(self.__columns)
+
+  def column(self, key):
+    """
+    Returns the column of the spectra table holding a metadata key.
+
+    The unit of metadata with one is under the key followed by "_unit".
+    Returns None for a key that isn't in the index.
+    """
+
+    return self.__names.get(key)
+
+  def close(self):
+    """
+    Close the database.
+    """
+
+    self.connection.close()
+
+  def __tablecolumns(self):
+    """
+    Returns the columns of the spectra table in the database.
+    """
+
+    return [row[1] for row in self.connection.execute("PRAGMA table_info(spectra)")]
+
+  def __column(self, key):
+    """
+    Returns the column of a metadata key, adding it to the table if it's new.
+    """
+
+    if key in self.__names:
+      return self.__names[key]
+
+    taken = set([column.lower() for column in self.__columns])
+    name = key
+    number = 1
+    while name.lower() in taken:
+      number += 1
+      name = "%s_%d" % (key, number)
+    self.connection.execute("ALTER TABLE spectra ADD COLUMN " + _quote(name))
+    self.connection.execute("INSERT INTO keys (key, name) VALUES (?, ?)", (key, name))
+    self.__columns.append(name)
+    self.__names[key] = name
+    return name
+
+  def __store(self, header, stat):
+    """
+    Insert or replace the row of a file, adding columns for new metadata keys.
+    """
+
+    row = {"filename":header.pop("filename"),
+           "mtime":stat.st_mtime,
+           "size":stat.st_size,
+           "timestamp":None}
+    for key, entry in header.items():
+      if isinstance(entry, dict):
+        row[self.__column(key)] = entry["value"]
+        row[self.__column(key + "_unit")] = entry["unit"]
+      else:
+        row[self.__column(key)] = entry
+
+    # The date in winspectro files looks like "Mon Feb 08 13:49:52 2010".
+    try:
+      row["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%S", time.strptime(str(header["Dateandtime"]), "%a %b %d %H:%M:%S %Y"))
+    except (KeyError, ValueError):
+      pass
+
+    keys = sorted(row)
+    self.connection.execute("INSERT OR REPLACE INTO spectra (" + ", ".join([_quote(key) for key in keys]) + ") VALUES (" + ", ".join(["?"] * len(keys)) + ")",
+                            [row[key] for key in keys])
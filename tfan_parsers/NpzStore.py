@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+from .Errors import FormatError
+from .StaibDat import StaibDat
+import json
+import struct
+import zipfile
+import numpy
+import numpy.lib.format
+
+try:
+  _basestring = basestring
+except NameError:
+  _basestring = str
+
+try:
+  _BadZipFile = zipfile.BadZipFile
+except AttributeError:
+  _BadZipFile = zipfile.BadZipfile
+
+# Identifies the files written by save_npz, in their metadata table.
+_FORMAT = "tfan_parsers.npz"
+_VERSION = 1
+
+def save_npz(filename, spectra):
+  """
+  Saves one or more StaibDat objects to an uncompressed .npz file.
+
+  spectra is a StaibDat object or a list of them. The file holds a metadata
+  table, stored as JSON in the "metadata" member, with the filename, the
+  metadata entries (values and units) and the datakeys of each object in
+  order. The data section of the i-th object is stored in the "columns_i"
+  member as a 2-D array with one contiguous row per datakey, of the type the
+  data section is stored as, see the dtype argument of StaibDat. KE, BE and
+  the Cn arrays are computed from these on loading exactly as they are when
+  a file is parsed, so nothing is lost. filename may also be an open file.
+  """
+
+  if isinstance(spectra, StaibDat):
+    spectra = [spectra]
+
+  table = []
+  arrays = {}
+  for indx, SD in enumerate(spectra):
+    metadata, datakeys, columns = SD.parts()
+    table.append({"filename":SD["filename"],
+                  "metadata":[[key, entry] for key, entry in metadata],
+                  "datakeys":[list(datakey) for datakey in datakeys]})
+    arrays["columns_%d" % indx] = numpy.ascontiguousarray(columns.T)
+
+  header = json.dumps({"format":_FORMAT, "version":_VERSION, "spectra":table})
+  arrays["metadata"] = numpy.frombuffer(header.encode("utf-8"), dtype = numpy.uint8)
+  numpy.savez(filename, **arrays)
+
+def load_npz(filename, mmap = True, compact = True):
+  """
+  Returns the list of StaibDat objects saved in a .npz file by save_npz.
+
+  The objects come back in the order they were saved, with the same keys
+  and entries as the originals, without parsing any text. Input arguments as
+  well as their default values are given as follows:
+    filename: The name of the .npz file, or an open file.
+    mmap: If True and filename is a name, the data of each object is a
+      read-only numpy.memmap of the file at the offset where the array is
+      stored, so nothing is copied until it is used. Default = True.
+    compact: See StaibDat. In compact mode the Cn arrays and the "value" of
+      each datakey are views onto the stored array, so with mmap they are
+      read straight from the file. Default = True.
+
+  Raises FormatError if the file wasn't written by save_npz.
+  """
+
+  # A file that isn't an .npz archive at all is either refused as pickled data or found to be a bare .npy array.
+  try:
+    npzFile = numpy.load(filename)
+  except (ValueError, EOFError, _BadZipFile):
+    raise FormatError("%s wasn't written by save_npz" % filename, "syntax")
+  if isinstance(npzFile, numpy.ndarray):
+    raise FormatError("%s wasn't written by save_npz" % filename, "syntax")
+  try:
+    try:
+      header = json.loads(npzFile["metadata"].tobytes().decode("utf-8"))
+    except (KeyError, ValueError, _BadZipFile):
+      raise FormatError("%s wasn't written by save_npz" % filename, "syntax")
+    if not isinstance(header, dict) or header.get("format") != _FORMAT or header.get("version") != _VERSION:
+      raise FormatError("%s wasn't written by save_npz" % filename, "structure")
+    if mmap and isinstance(filename, _basestring):
+      arrays = _memmaps(filename)
+    else:
+      arrays = dict([(name, npzFile[name]) for name in npzFile.files if name.startswith("columns_")])
+  finally:
+    npzFile.close()
+
+  spectra = []
+  for indx, entry in enumerate(header["spectra"]):
+    metadata = [(str(key), value) for key, value in entry["metadata"]]
+    datakeys = [(str(key), str(unit)) for key, unit in entry["datakeys"]]
+    # The stored array has one row per datakey; fromparts takes one column per datakey. An integer array was saved from an object storing integers, and is kept as it is.
+    columns = arrays["columns_%d" % indx]
+    dtype = columns.dtype if numpy.issubdtype(columns.dtype, numpy.integer) else None
+    spectra.append(StaibDat.fromparts(entry["filename"], metadata, datakeys, columns.T, compact = compact, verify = False, dtype = dtype))
+  return spectra
+
+def _memmaps(filename):
+  """
+  Returns a dictionary of read-only memmaps of the arrays stored in an uncompressed .npz file.
+  """
+
+  arrays = {}
+  archive = zipfile.ZipFile(filename)
+  npzFile = open(filename,"rb")
+  try:
+    for info in archive.infolist():
+      name = info.filename[:-len(".npy")]
+      if not name.startswith("columns_"):
+        continue
+      if info.compress_type != zipfile.ZIP_STORED:
+        raise FormatError("%s is compressed and can't be memory mapped" % info.filename, "structure")
+      # The member's data follows its local file header, whose name and extra fields can differ from the central directory's.
+      npzFile.seek(info.header_offset)
+      localHeader = npzFile.read(30)
+      nameLength, extraLength = struct.unpack("<HH", localHeader[26:30])
+      npzFile.seek(info.header_offset + 30 + nameLength + extraLength)
+      version = numpy.lib.format.read_magic(npzFile)
+      if version == (1, 0):
+        shape, fortranOrder, dtype = numpy.lib.format.read_array_header_1_0(npzFile)
+      else:
+        shape, fortranOrder, dtype = numpy.lib.format.read_array_header_2_0(npzFile)
+      arrays[name] = numpy.memmap(filename, dtype = dtype, mode = "r", offset = npzFile.tell(), shape = shape, order = "F" if fortranOrder else "C")
+  finally:
+    npzFile.close()
+    archive.close()
+  return arrays
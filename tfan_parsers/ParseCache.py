@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+from .StaibDat import StaibDat
+from .StaibReader import StaibReader
+from .Archives import compression, decompress
+import hashlib
+import io
+import json
+import os
+import tempfile
+import numpy
+
+try:
+  _replace = os.replace
+except AttributeError:
+  def _replace(source, destination):
+    """
+    Renames source to destination, replacing it.
+
+    Python 2 has no os.replace. Its os.rename replaces the destination
+    atomically on POSIX; only where it can't, on Windows, is the destination
+    removed first.
+    """
+
+    try:
+      os.rename(source, destination)
+    except OSError:
+      os.remove(destination)
+      os.rename(source, destination)
+
+class ParseCache(object):
+  """
+  Persistent on-disk cache of parsed winspectro .dat files.
+
+  Parsing a file is much more expensive than reading back its parsed
+  contents, so a ParseCache stores the metadata and the columns of every file
+  it loads in a directory of .npz files, one per source file. Loading a file
+  that is already in the cache reads that .npz file instead of parsing the
+  source. Input arguments as well as their default values are given as
+  follows:
+    directory: The directory holding the cache. It is created if needed.
+    maxBytes: The maximum total size of the cache in bytes. When storing an
+      entry pushes the cache over this size, the least recently used entries
+      are deleted. Default = 256 MB.
+
+  An entry is keyed by the absolute path of its source file, and records the
+  modification time, size and SHA-1 hash of the source's content. An entry is
+  used as long as the source's size and modification time are unchanged. If
+  only the modification time changed, the content hash decides; a source
+  whose size or content changed is parsed again and its entry replaced.
+  """
+
+  def __init__(self, directory, maxBytes = 256 * 1024 * 1024):
+    """
+    Instantiation of ParseCache object.
+    """
+
+    self.directory = directory
+    self.maxBytes = maxBytes
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def load(self, filename, compact = False):
+    """
+    Returns a StaibDat object for filename, from the cache if possible.
+
+    On a cache miss the file is parsed as by StaibDat(filename) and stored.
+    FormatError is raised for invalid files, which are never cached. The
+    fileText of a StaibDat object loaded through the cache is re-read from
+    the file the first time it is accessed.
+    """
+
+    entryname = self.__entryname(filename)
+    stat = os.stat(filename)
+
+    entry = self.__readentry(entryname)
+    if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+      return self.__hit(filename, entryname, entry, compact)
+
+    # Read the file once, both to hash it and, if its content changed, to parse it.
+    datFile = open(filename,"rb")
+    content = datFile.read()
+    datFile.close()
+    digest = hashlib.sha1(content).hexdigest()
+    if entry is not None and entry["size"] == stat.st_size and entry["sha1"] == digest:
+      # The file was only touched.
+      entry["mtime"] = stat.st_mtime
+      self.__writeentry(entryname, entry)
+      return self.__hit(filename, entryname, entry, compact)
+
+    # A compressed file is hashed as it is on disk, and decompressed for parsing.
+    suffix = compression(filename)
+    reader = StaibReader().read(io.BytesIO(content) if suffix is None else decompress(io.BytesIO(content), suffix))
+    SD = StaibDat.fromparts(filename, reader.metadata, reader.datakeys, reader.columns, compact = compact)
+    self.__writeentry(entryname, {"mtime":stat.st_mtime,
+                                  "size":stat.st_size,
+                                  "sha1":digest,
+                                  "metadata":reader.metadata,
+                                  "datakeys":[tuple(datakey) for datakey in reader.datakeys],
+                                  "columns":reader.columns})
+    self.__evict()
+    return SD
+
+  def clear(self):
+    """
+    Deletes every entry of the cache.
+    """
+
+    for entryname in self.__entrynames():
+      os.remove(entryname)
+
+  def size(self):
+    """
+    Returns the total size in bytes of the entries in the cache.
+    """
+
+    return sum([os.path.getsize(entryname) for entryname in self.__entrynames()])
+
+  def __hit(self, filename, entryname, entry, compact):
+    """
+    Builds the StaibDat object from a cache entry and marks the entry as used.
+    """
+
+    os.utime(entryname, None)
+    return StaibDat.fromparts(filename, entry["metadata"], entry["datakeys"], entry["columns"], compact = compact, verify = False)
+
+  def __entryname(self, filename):
+    """
+    Returns the name of the cache entry for filename.
+    """
+
+    return os.path.join(self.directory, hashlib.sha1(os.path.abspath(filename).encode("utf-8")).hexdigest() + ".npz")
+
+  def __entrynames(self):
+    """
+    Returns the names of all entries in the cache.
+    """
+
+    return [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".npz")]
+
+  def __readentry(self, entryname):
+    """
+    Returns the contents of a cache entry, or None if it doesn't exist or can't be read.
+    """
+
+    try:
+      npzFile = numpy.load(entryname, allow_pickle = False)
+      try:
+        entry = json.loads(npzFile["header"].tobytes().decode("utf-8"))
+        entry["columns"] = npzFile["columns"]
+      finally:
+        npzFile.close()
+    except Exception:
+      return None
+    # JSON turns the (key, entry) pairs and DataKey tuples into lists.
+    entry["metadata"] = [(str(key), value) for key, value in entry["metadata"]]
+    entry["datakeys"] = [(str(key), str(unit)) for key, unit in entry["datakeys"]]
+    return entry
+
+  def __writeentry(self, entryname, entry):
+    """
+    Writes a cache entry, replacing any previous one atomically.
+    """
+
+    header = dict(entry)
+    columns = header.pop("columns")
+    # The header is stored as JSON, like the metadata table of save_npz, so reading an entry never unpickles anything.
+    header = numpy.frombuffer(json.dumps(header).encode("utf-8"), dtype = numpy.uint8)
+    descriptor, tempname = tempfile.mkstemp(suffix = ".tmp", dir = self.directory)
+    tempFile = os.fdopen(descriptor, "wb")
+    try:
+      numpy.savez(tempFile, header = header, columns = columns)
+    finally:
+      tempFile.close()
+    _replace(tempname, entryname)
+
+  def __evict(self):
+    """
+    Deletes the least recently used entries until the cache fits in maxBytes.
+    """
+
+    entries = [(os.path.getmtime(entryname), os.path.getsize(entryname), entryname) for entryname in self.__entrynames()]
+    total = sum([entry[1] for entry in entries])
+    for mtime, size, entryname in sorted(entries):
+      if total <= self.maxBytes:
+        break
+      os.remove(entryname)
+      total -= size
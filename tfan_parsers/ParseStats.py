@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+from .Errors import FormatError
+import collections
+import timeit
+
+# One phase of constructing a StaibDat object: its name, wall time in seconds, and the number of lines and bytes it processed (0 if not applicable).
+PhaseStats = collections.namedtuple("PhaseStats", ["phase", "seconds", "lines", "bytes"])
+
+# The record of constructing one StaibDat object: the filename, a tuple of PhaseStats in the order the phases ran, the total wall time in seconds, and the cause of the failure, or None if the object was constructed.
+FileStats = collections.namedtuple("FileStats", ["filename", "phases", "seconds", "failure"])
+
+class ParseStats(object):
+  """
+  Opt-in instrumentation of the construction of StaibDat objects.
+
+  Pass a ParseStats object to StaibDat, or to load_many for a whole batch,
+  through the stats argument. Every file constructed with it is timed phase
+  by phase, and the results are added up across files. Without a ParseStats
+  object, StaibDat only checks for one at each phase, so there is nothing to
+  turn off in production. Input arguments as well as their default values
+  are given as follows:
+    callback: A function called with the FileStats of each file as soon as
+      the file is done, or None. Default = None.
+
+  The phases depend on the engine. The fast engine has "read" (labeling,
+  verifying the structure and parsing in a single pass) and "populate"; the
+  pyparsing engine has "read", "label", "verifystructure", "parse" and, in
+  compact mode, "populate"; the mmap engine has "map", "parse" and
+  "populate". All of them end with "verifydata" and "userfriendify".
+
+  The following attributes add up every file recorded:
+    files: The number of files.
+    failures: The number of files that raised an exception.
+    causes: Dictionary of the number of failures per cause: the cause code of
+      a FormatError (see FormatError), "unknown" for a FormatError without
+      one, or the name of any other exception, e.g. "IOError".
+    phases: Dictionary of the totals per phase, each a dictionary with the
+      number of "calls", and the "seconds", "lines" and "bytes".
+    seconds: The total wall time.
+  """
+
+  def __init__(self, callback = None):
+    """
+    Instantiation of ParseStats object.
+    """
+
+    self.callback = callback
+    self.reset()
+
+  def reset(self):
+    """
+    Set every counter back to zero.
+    """
+
+    self.files = 0
+    self.failures = 0
+    self.causes = {}
+    self.phases = {}
+    self.seconds = 0.
+
+  def timer(self, filename):
+    """
+    Returns a FileTimer recording the phases of a single file into this object.
+    """
+
+    return FileTimer(self, filename)
+
+  def add(self, record):
+    """
+    Add the FileStats of a file to the totals and pass it to the callback.
+    """
+
+    self.files += 1
+    self.seconds += record.seconds
+    if record.failure is not None:
+      self.failures += 1
+      self.causes[record.failure] = self.causes.get(record.failure, 0) + 1
+    for phase in record.phases:
+      totals = self.phases.setdefault(phase.phase, {"calls":0, "seconds":0., "lines":0, "bytes":0})
+      totals["calls"] += 1
+      totals["seconds"] += phase.seconds
+      totals["lines"] += phase.lines
+      totals["bytes"] += phase.bytes
+    if self.callback is not None:
+      self.callback(record)
+
+  def merge(self, other):
+    """
+    Add the totals of another ParseStats object to this one.
+
+    The callback isn't called for the files of the other object.
+    """
+
+    self.files += other.files
+    self.failures += other.failures
+    self.seconds += other.seconds
+    for cause, count in other.causes.items():
+      self.causes[cause] = self.causes.get(cause, 0) + count
+    for name, other in other.phases.items():
+      totals = self.phases.setdefault(name, {"calls":0, "seconds":0., "lines":0, "bytes":0})
+      for counter in totals:
+        totals[counter] += other[counter]
+
+  def summary(self):
+    """
+    Returns the totals as a dictionary that can be written as JSON.
+    """
+
+    return {"files":self.files,
+            "failures":self.failures,
+            "causes":dict(self.causes),
+            "phases":dict([(name, dict(totals)) for name, totals in self.phases.items()]),
+            "seconds":self.seconds}
+
+  def __repr__(self):
+    return "<ParseStats %d files, %d failures, %.3f s>" % (self.files, self.failures, self.seconds)
+
+class FileTimer(object):
+  """
+  Records the phases of constructing a single StaibDat object.
+
+  Each call of lap ends a phase, which started when the previous phase ended
+  or the timer was made. finish adds the resulting FileStats to the
+  ParseStats object the timer came from.
+  """
+
+  __slots__ = ("stats", "filename", "phases", "start", "last")
+
+  def __init__(self, stats, filename):
+    self.stats = stats
+    self.filename = filename
+    self.phases = []
+    self.start = self.last = timeit.default_timer()
+
+  def lap(self, phase, lines = 0, bytes = 0):
+    """
+    End a phase that processed the given number of lines and bytes.
+    """
+
+    now = timeit.default_timer()
+    self.phases.append(PhaseStats(phase, now - self.last, lines, bytes))
+    self.last = now
+
+  def finish(self, error = None):
+    """
+    Record the file, as failed with error if it isn't None.
+    """
+
+    failure = None
+    if error is not None:
+      if isinstance(error, FormatError):
+        failure = error.cause or "unknown"
+      else:
+        failure = type(error).__name__
+    self.stats.add(FileStats(self.filename, tuple(self.phases), timeit.default_timer() - self.start, failure))
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+from .StaibDat import StaibDat
+from multiprocessing import shared_memory, resource_tracker
+import weakref
+import os
+import numpy
+
+def _tracker():
+  """
+  Returns an identity of the resource tracker of this process, or None if there is none.
+
+  Processes sharing a resource tracker, such as a process and the children
+  it spawns, or forks after its tracker started, write to the same pipe, so
+  the identity is that of the pipe.
+  """
+
+  if os.name != "posix":
+    return None
+  stat = os.fstat(resource_tracker.getfd())
+  return stat.st_dev, stat.st_ino
+
+def _attach(name, shape, dtype, state, tracker):
+  """
+  Returns a compact StaibDat object whose data section is the shared memory block name.
+
+  The block stays mapped as long as any array of the object is alive. Only
+  the owner of the block, whose resource tracker is tracker, may unlink it.
+  """
+
+  try:
+    block = shared_memory.SharedMemory(name, track = False)
+  except TypeError:
+    # Before python 3.13 every block attached to is registered with the resource tracker, which unlinks it when the tracker exits. A tracker of its own has to forget it again; the owner's tracker has to keep it.
+    block = shared_memory.SharedMemory(name)
+    if tracker is not None and _tracker() != tracker:
+      resource_tracker.unregister(block._name, "shared_memory")
+  columns = numpy.ndarray(shape, dtype = dtype, buffer = block.buf)
+  columns.flags.writeable = False
+  # Every array of the object is a view onto columns, so the block can be closed once columns is gone.
+  weakref.finalize(columns, block.close)
+  SD = StaibDat.__new__(StaibDat)
+  SD.__setstate__(dict(state, columns = columns))
+  return SD
+
+class SharedDat(object):
+  """
+  The data section of a StaibDat object in shared memory, for other processes to attach to.
+
+  Pickling a StaibDat object copies its data section, which adds up when the
+  same spectra are sent to many tasks of a pool of processes. A SharedDat
+  copies the data section once, into a block of shared memory, and pickles as
+  little more than the name of the block and the metadata. Unpickled, in any
+  process on the same machine, it becomes a compact StaibDat object whose
+  data section, and with it the "value" of each datakey and the Cn arrays,
+  is a read-only view onto the shared block, e.g.:
+    with SharedDat(SD) as shared:
+      results = pool.map(analyse, [shared] * 100)
+  where analyse is given a StaibDat object. Input arguments are given as
+  follows:
+    spectrum: The StaibDat object to share. It isn't changed.
+
+  The process that made the SharedDat owns the block: it has to stay open
+  until every other process has attached to it, and is freed by close(), or
+  at the end of a with statement. A process that has attached keeps the block
+  mapped until the last array of its StaibDat object is gone. load() returns
+  the StaibDat object in the process that made the SharedDat. Needs python
+  3.8 or later.
+  """
+
+  def __init__(self, spectrum):
+    """
+    Instantiation of SharedDat object.
+    """
+
+    state = spectrum.__getstate__()
+    columns = state.pop("columns")
+    state["compact"] = True
+    self.__block = shared_memory.SharedMemory(create = True, size = max(columns.nbytes, 1))
+    shared = numpy.ndarray(columns.shape, dtype = columns.dtype, buffer = self.__block.buf)
+    shared[...] = columns
+    del shared
+    self.name = self.__block.name
+    self.__tracker = _tracker()
+    self.shape = columns.shape
+    self.dtype = columns.dtype.str
+    self.__state = state
+
+  def __reduce__(self):
+    return (_attach, (self.name, self.shape, self.dtype, self.__state, self.__tracker))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exception):
+    self.close()
+
+  def load(self):
+    """
+    Returns the StaibDat object attached to the shared block.
+    """
+
+    return _attach(self.name, self.shape, self.dtype, self.__state, self.__tracker)
+
+  def close(self):
+    """
+    Free the shared block. Processes that have attached to it keep their mapping.
+    """
+
+    if self.__block is not None:
+      self.__block.close()
+      self.__block.unlink()
+      self.__block = None
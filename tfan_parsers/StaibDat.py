@@ -1,10 +1,103 @@
 # -*- coding: utf-8 -*-
 
-from Errors import FormatError
-import re
+from .Errors import FormatError, Violation, mergetolerances, checkedmetadata, raiseviolations
+from .StaibGrammar import DEFAULT_GRAMMAR, DataKey
+from .StaibReader import StaibReader
+from .MappedDat import MappedDat
+from .Archives import open_dat, compression
+from . import Analysis
 import numpy
-import pyparsing
-import pdb
+
+try:
+  _basestring = basestring
+except NameError:
+  _basestring = str
+
+def _readlines(filename):
+  """
+  Returns the lines of a file as a list, decompressing it if needed.
+  """
+
+  datFile = open_dat(filename)
+  try:
+    fileText = [StaibReader.decode(line) for line in datFile]
+  finally:
+    datFile.close()
+  return fileText
+
+class _Deferred(object):
+  """
+  Placeholder for a StaibDat entry that is computed on first access.
+
+  The entry is computed by calling function with args. The function should be
+  a module-level function so that the placeholder can be pickled.
+  """
+
+  __slots__ = ("function", "args")
+
+  def __init__(self, function, *args):
+    self.function = function
+    self.args = args
+
+  def __call__(self):
+    return self.function(*self.args)
+
+  def __repr__(self):
+    return "<deferred %s>" % self.function.__name__
+
+def _newstaibdat(cls):
+  """
+  Returns an empty object of a StaibDat class, to be filled in by __setstate__ when unpickling.
+  """
+
+  return dict.__new__(cls)
+
+def _dataentry(values, unit):
+  """
+  Returns the entry of a datakey: its values as a list, and its unit.
+  """
+
+  return {"value":numpy.asarray(values).tolist(),
+          "unit":unit}
+
+def _kineticenergy(basis):
+  """
+  Returns the KE array in eV of the Basis values in mV.
+  """
+
+  return numpy.asarray(basis, dtype = float)/1000
+
+def _bindingenergy(sourceEnergy, basis):
+  """
+  Returns the BE array in eV of the source energy and the Basis values in mV.
+  """
+
+  return sourceEnergy - _kineticenergy(basis)
+
+def _integerdtype(columns, dtype):
+  """
+  Returns the integer dtype to store columns as under the dtype policy dtype, see StaibDat.
+
+  For "auto", this is the smallest signed integer type holding every value.
+  """
+
+  if not (isinstance(dtype, _basestring) and dtype == "auto"):
+    return numpy.dtype(dtype)
+  if columns.size == 0:
+    return numpy.dtype(numpy.int8)
+  low, high = columns.min(), columns.max()
+  for candidate in (numpy.int8, numpy.int16, numpy.int32):
+    info = numpy.iinfo(candidate)
+    if info.min <= low and high <= info.max:
+      return numpy.dtype(candidate)
+  return numpy.dtype(numpy.int64)
+
+def _channel(values):
+  """
+  Returns a Cn array holding a copy of the values of a datakey.
+  """
+
+  return numpy.array(values)
 
 class StaibDat(dict):
   """
@@ -42,7 +135,8 @@ class StaibDat(dict):
   brackets):
     filename: The name of the file from which the data in the object came.
     fileText: A list with the full text of the data file. Each list item
-    contains a single line of the file.
+    contains a single line of the file. Only present if the text was kept, see
+    the keepText argument of __init__.
     KE [eV]: A numpy array containing the kinetic energy value of the
     electrons.
     BE [eV]: A numpy array containing the binding energy of the electrons
@@ -56,7 +150,20 @@ class StaibDat(dict):
     smooth: Method that returns a numpy array of smoothed data.
     differentiate: Method that returns numpy array of first derivative of
     data.
+
+  The datakey entries, KE, BE and the Cn arrays are computed the first time
+  they are accessed and kept from then on, so the data that is never used
+  costs next to nothing. The keys are there from the start: in, keys() and
+  iteration see every key, and get(), items(), values() and copy() return the
+  computed entries. Only dict(SD) copies the placeholders of the entries that
+  haven't been accessed yet; use SD.copy() instead.
       
+  A StaibDat object pickles as its metadata and a single numpy array of the
+  data section, so it is cheap to send to and from other processes. The
+  entries computed from the data are computed again after unpickling, and
+  fileText is re-read from the file. To hand the data section to other
+  processes without copying it at all, see SharedDat (python 3.8 and later).
+
   Generally, the user will find it easiest to work with the KE, BE, etc. data
   as opposed to the dictionary data pulled from the file itself.
   """
@@ -90,72 +197,399 @@ class StaibDat(dict):
   #* The step size between all the Basis values in the data section should almost precisely agree with the "Stepwidth" value in the metadata section.
 
   
-  def __init__(self,filename):
+  # Tolerances in eV of the checks comparing the metadata to the Basis values, keyed by the cause code of the check, see __init__.
+  tolerances = {"startenergy":0.005,
+                "stopenergy":0.005,
+                "stepsize":0.005,
+                "stepwidth":0.005}
+
+  def __init__(self,filename,engine = "fast",grammar = None,keepText = None,compact = False,tolerance = None,collect = False,stats = None,dtype = None):
     """
     Instantiation of StaibDat object.
 
     A StaibDat object is instantiated with a string referring to a .dat file 
-    containing AES or XPS data generated by winspectro.
+    containing AES or XPS data generated by winspectro. Instead of a filename,
+    any iterable yielding the lines of a .dat file can be given, e.g. an open
+    file, a BytesIO, or a member of a zip or tar archive. In that case the
+    filename key is taken from the name attribute of the iterable, or None if
+    it doesn't have one. A filename ending in .gz, .bz2 or .xz is decompressed
+    on the fly while it is read, see open_dat; iter_archive reads the .dat
+    files in a zip or tar archive.
+
+    The optional engine argument selects how the file is parsed. The default,
+    "fast", reads the file in a single pass with a StaibReader: each line is
+    labeled with precompiled regular expressions and the data section is
+    converted to numbers in bulk. Any line the fast engine isn't certain about
+    is handed to the pyparsing grammar. Passing "pyparsing" labels and parses
+    every line with the pyparsing grammar, which is much slower but serves as
+    the reference for the fast engine. Both engines give identical results.
+    Passing "mmap" maps a file on disk into memory with a MappedDat, and
+    parses the data section straight from the map into a single array without
+    holding the text of the file; combine it with compact = True for very
+    large files. This engine needs the filename of an uncompressed file, and
+    the text is re-read from the file the first time fileText is accessed,
+    unless keepText is True.
+
+    The optional grammar argument takes a StaibGrammar describing a variant of
+    the winspectro format. By default the module-level DEFAULT_GRAMMAR is used.
+
+    The optional keepText argument says whether the full text of the file is
+    kept under the fileText key. By default it is kept when reading from a
+    filename, and not kept when reading from any other iterable.
+
+    The optional compact argument cuts the memory used by the object. In
+    compact mode the data section is stored once, as a 2-D numpy array with
+    one contiguous row per datakey. The "value" of each datakey is a view onto
+    its row instead of a list, and the Cn arrays are the very same views. When
+    reading from a filename, fileText is not kept but re-read from the file
+    the first time it is accessed, unless keepText is True.
+
+    Once parsed, DataPoints, Startenergy, Stopenergy and Stepwidth are checked
+    against the Basis values of the data section, and FormatError is raised if
+    they disagree. The optional tolerance argument is the largest difference
+    in eV allowed by these checks, either a single number or a dictionary
+    overriding some of the class attribute tolerances, keyed by the cause
+    codes of FormatError. The default tolerances of 0.005 eV match the 0.01
+    eV resolution of the metadata. By default FormatError stops at the first
+    problem; if the optional collect argument is True, every problem with the
+    data is collected into the violations of the FormatError, each with its
+    line number and the expected and actual values.
+
+    The optional stats argument takes a ParseStats object, which records the
+    wall time, lines and bytes of each phase of the construction, or the
+    cause of the failure if it fails. By default nothing is recorded.
+
+    The optional dtype argument sets how the data section is stored. By
+    default every value is a float. The values winspectro writes are all
+    integers, so passing a numpy integer type, e.g. "int32", stores them as
+    that type instead, and passing "auto" stores them as the smallest signed
+    integer type that holds every value, which is int32 for the mV Basis
+    values of most files. Combined with compact = True, this halves the
+    memory of the data section or better. A value that isn't a whole number,
+    or doesn't fit the type, raises FormatError with the cause "dtype".
+    KE and BE are still floats, computed from the integer Basis values when
+    they are first accessed.
     """
+
+    if engine not in ("fast", "pyparsing", "mmap"):
+      raise ValueError("engine must be \"fast\", \"pyparsing\" or \"mmap\", was: %s" % engine)
+    if dtype is not None and not (isinstance(dtype, _basestring) and dtype == "auto") and not numpy.issubdtype(numpy.dtype(dtype), numpy.integer):
+      raise ValueError("dtype must be None, \"auto\" or an integer type, was: %s" % (dtype,))
+    self.__dtype = dtype
     
-    # First, I need to initialize all of the parsing. The following parsers may seem complicated, but I want them to do all of the heavy lifting.
-    # Define pyparsing forms for each type of data found in lines of the file.
-    unitword = pyparsing.Word(pyparsing.alphas + "%")
-    valueword = pyparsing.Word(pyparsing.alphanums + "./=:")
-    keyword = pyparsing.Word(pyparsing.alphanums + "-_")
-    numvalue = pyparsing.Combine(pyparsing.Optional("-") + pyparsing.Word(pyparsing.nums))
-    
-    # In the following I'm using setParseAction because some of the keys and values in the metadata are made up of multiple words. A priori I don't know which ones are, and I don't want to guess and write a bunch of fragile lookup lists and tests that I'll ultimately have to change later. The setParseAction method allows me to combine the multiple words into a single entry in the returned list. See p.19 of McGuire's "Getting Started with Pyparsing" for more details.
-    key = pyparsing.OneOrMore(keyword)
-    key.setParseAction(lambda tokens: " ".join(tokens))
-    unit = pyparsing.Suppress("[") + unitword + pyparsing.Suppress("]") 
-    equalsdelimiter = pyparsing.Suppress(":    ")
-    value = pyparsing.OneOrMore(valueword)
-    value.setParseAction(lambda tokens: " ".join(tokens))
-    
-    # Again, I'm using setParseAction in this section. For the datavalues section, I'm using setParseAction to coerce the values directly to integers since I know they are supposed to be anyway. I will also need to use Results Names in order to make the extraction of the data from the parsed results doable.
-    self.__metadata = key.setResultsName("key") + \
-      pyparsing.Optional(unit.setResultsName("unit")) + equalsdelimiter + \
-      value.setResultsName("value")
-    self.__reserved = pyparsing.Literal("reserved")
-    self.__datakeys = pyparsing.Group(keyword.setResultsName("key") + \
-      pyparsing.Optional(unit.setResultsName("unit"))) + \
-      pyparsing.OneOrMore(pyparsing.Group(keyword.setResultsName("key") + \
-      pyparsing.Optional(unit.setResultsName("unit"))))
-    self.__datavalues = numvalue.setParseAction(lambda tokens : float(tokens[0])) + \
-      pyparsing.OneOrMore(numvalue.setParseAction(lambda tokens : float(tokens[0])))
-
-    #self.__datavalues = pyparsing.Word(pyparsing.nums).setParseAction(lambda tokens : float(tokens[0])) + \
-      #pyparsing.OneOrMore(pyparsing.Word(pyparsing.nums).setParseAction(lambda tokens : float(tokens[0])))
-      
+    # All of the parsing is described by a pre-built StaibGrammar, shared between StaibDat objects.
+    if grammar is None:
+      grammar = DEFAULT_GRAMMAR
+    self.__grammar = grammar
+
+    # With a ParseStats object, time each phase of the construction and record failures.
+    if stats is None:
+      timer = None
+    else:
+      timer = stats.timer(filename if isinstance(filename, _basestring) else getattr(filename, "name", None))
+    try:
+      self.__load(filename, engine, keepText, compact, tolerance, collect, timer)
+    except Exception as error:
+      if timer is not None:
+        timer.finish(error)
+      raise
+    if timer is not None:
+      timer.finish()
+
+  def __load(self, filename, engine, keepText, compact, tolerance, collect, timer):
+    """
+    Reads, parses and verifies the file for __init__.
+
+    timer is a FileTimer to record each phase with, or None.
+    """
+
+    grammar = self.__grammar
+
     # The StaibDat object should know where its data came from.
-    self["filename"] = filename
-    
-    # Pull in the data from the file and close the file.
-    datFile = open(filename,"r")
-    self["fileText"] = datFile.readlines()
-    datFile.close()
-    
+    if isinstance(filename, _basestring):
+      self["filename"] = filename
+      if engine == "mmap" and compression(filename) is not None:
+        raise ValueError("engine \"mmap\" can't map a compressed file: %s" % filename)
+      lines = None if engine == "mmap" else open_dat(filename)
+    elif engine == "mmap":
+      raise ValueError("engine \"mmap\" needs a filename")
+    else:
+      self["filename"] = getattr(filename, "name", None)
+      lines = filename
+
+    if keepText is None:
+      keepText = isinstance(filename, _basestring) and not compact and engine != "mmap"
+    self.__compact = compact
+    self.__metadataKeys = []
+    self.__lineNumbers = {}
+
+    # Pull in the data and close the file if we opened it.
+    try:
+      if engine == "mmap":
+        # Parse the data section straight from the mapped file.
+        mapped = MappedDat(filename, grammar)
+        try:
+          if timer is not None:
+            timer.lap("map", mapped.lineNumbers["datavalues"] - 1, int(mapped.offsets[0]))
+          columns = mapped.rows()
+          if timer is not None:
+            timer.lap("parse", len(mapped), int(mapped.offsets[-1] - mapped.offsets[0]))
+          self.__lineNumbers = mapped.lineNumbers
+          self.__populate(mapped.metadata, mapped.datakeys, columns)
+          if timer is not None:
+            timer.lap("populate")
+        finally:
+          mapped.close()
+        if keepText:
+          self["fileText"] = _readlines(filename)
+      elif engine == "fast":
+        # Label, verify and parse the lines in a single pass.
+        reader = StaibReader(grammar, keepText).read(lines)
+        if timer is not None:
+          timer.lap("read", reader.lineCount, reader.byteCount)
+        if keepText:
+          self["fileText"] = reader.fileText
+        self.__lineNumbers = reader.lineNumbers
+        self.__populate(reader.metadata, reader.datakeys, reader.columns)
+        if timer is not None:
+          timer.lap("populate")
+      else:
+        self["fileText"] = [StaibReader.decode(line) for line in lines]
+        if timer is not None:
+          timer.lap("read", len(self["fileText"]), sum([len(line) for line in self["fileText"]]))
+        self.__parsefiletext(timer)
+        if not keepText:
+          del self["fileText"]
+        if compact or self.__dtype is not None:
+          columns = numpy.array([self[datakey.key]["value"] for datakey in self.__datakeysList]).T
+          self.__populate([], self.__datakeysList, columns)
+          if timer is not None:
+            timer.lap("populate")
+    finally:
+      if lines is not None and lines is not filename:
+        lines.close()
+
+    # In compact mode, the text of a file on disk can be re-read when it is needed.
+    if (compact or engine == "mmap") and not keepText and isinstance(filename, _basestring):
+      self["fileText"] = _Deferred(_readlines, filename)
+      
+    # Verify that the metadata and data in the file agree.
+    self.__verifydata(tolerance, collect)
+    if timer is not None:
+      timer.lap("verifydata", len(self.__values("Basis")))
+      
+    # Generate the user-friendly KE, C1, etc. numpy arrays.
+    self.__userfriendify()
+    if timer is not None:
+      timer.lap("userfriendify")
+
+  @classmethod
+  def fromparts(cls, filename, metadata, datakeys, columns, compact = False, verify = True, tolerance = None, collect = False, dtype = None):
+    """
+    Returns a StaibDat object built from already parsed contents.
+
+    This skips reading and parsing a file altogether, e.g. when the contents
+    come from a cache. Input arguments are given as follows:
+      filename: The filename key of the new object. If it is a string,
+        fileText is re-read from that file the first time it is accessed.
+      metadata: List of (key, entry) pairs, as returned by parts().
+      datakeys: List of DataKey, or of (key, unit) pairs.
+      columns: 2-D array of the data section with one column per datakey.
+      compact: See __init__. Default = False.
+      verify: Whether to check that the metadata and data agree, as when
+        reading a file. Default = True.
+      tolerance, collect: See __init__. The violations have no line numbers.
+      dtype: See __init__. Columns that already have an integer type allowed
+        by dtype are used as they are. Default = None.
+    """
+
+    SD = cls.__new__(cls)
+    SD.__grammar = DEFAULT_GRAMMAR
+    SD.__compact = compact
+    SD.__dtype = dtype
+    SD.__metadataKeys = []
+    SD.__lineNumbers = {}
+    SD["filename"] = filename
+    if isinstance(filename, _basestring):
+      SD["fileText"] = _Deferred(_readlines, filename)
+    SD.__populate(metadata, [DataKey(*datakey) for datakey in datakeys], numpy.asarray(columns) if dtype is not None else numpy.asarray(columns, dtype = float))
+    if verify:
+      SD.__verifydata(tolerance, collect)
+    SD.__userfriendify()
+    return SD
+
+  def __reduce__(self):
+    return (_newstaibdat, (type(self),), self.__getstate__())
+
+  def __getstate__(self):
+    """
+    Returns the contents of the object as a dictionary of metadata and a single array, for pickling.
+
+    The datakey entries, KE, BE and the Cn arrays aren't included but
+    computed again, lazily, from the "columns" array, which has one row per
+    datakey and the type the data section is stored as. The fileText of a file on disk is re-read from the file when it
+    is accessed instead of being included. Any keys added to the object
+    after it was made are included as they are, under "entries".
+    """
+
+    derived = set(["filename", "fileText", "KE", "BE"] + self.channelkeys() + self.__metadataKeys + [datakey.key for datakey in self.__datakeysList])
+    state = {"filename":self["filename"],
+             "grammar":self.__grammar,
+             "compact":self.__compact,
+             "dtype":self.__dtype,
+             "metadata":[(key, self[key]) for key in self.__metadataKeys],
+             "datakeys":[tuple(datakey) for datakey in self.__datakeysList],
+             "columns":self.__columns().T,
+             "lineNumbers":dict(self.__lineNumbers),
+             "fileText":"fileText" in self and isinstance(self["filename"], _basestring),
+             "entries":dict([(key, self[key]) for key in self if key not in derived])}
+    if "fileText" in self and not state["fileText"]:
+      state["entries"]["fileText"] = self["fileText"]
+    return state
+
+  def __setstate__(self, state):
+    """
+    Fills in an empty object from the dictionary returned by __getstate__.
+    """
+
+    self.__grammar = state["grammar"]
+    self.__compact = state["compact"]
+    self.__dtype = state.get("dtype")
+    self.__metadataKeys = []
+    self.__lineNumbers = state["lineNumbers"]
+    self["filename"] = state["filename"]
+    if state["fileText"]:
+      self["fileText"] = _Deferred(_readlines, state["filename"])
+    self.__populate(state["metadata"], [DataKey(*datakey) for datakey in state["datakeys"]], state["columns"].T)
+    self.__userfriendify()
+    for key, entry in state["entries"].items():
+      self[key] = entry
+
+  def metadatakeys(self):
+    """
+    Returns a list of the keys from the metadata section, in file order.
+    """
+
+    return list(self.__metadataKeys)
+
+  def parts(self):
+    """
+    Returns the parsed contents of the object as (metadata, datakeys, columns).
+
+    metadata is a list of the (key, entry) pairs of the metadata section,
+    datakeys a list of DataKey, and columns a 2-D numpy array of the data
+    section with one column per datakey, of the type the data section is
+    stored as, see the dtype argument of __init__. These are the arguments of
+    fromparts.
+    """
+
+    metadata = [(key, self[key]) for key in self.__metadataKeys]
+    return metadata, list(self.__datakeysList), self.__columns()
+
+  def dtype(self):
+    """
+    Returns the numpy dtype the data section is stored as.
+    """
+
+    return self.__columns().dtype
+
+  def __columns(self):
+    """
+    Returns the data section as a 2-D array with one column per datakey, of the type it is stored as.
+    """
+
+    return numpy.array([self.__values(datakey.key) for datakey in self.__datakeysList], dtype = float if self.__dtype is None else self.__integerDtype).T
+
+  def __populate(self, metadata, datakeys, columns):
+    """
+    Populates the StaibDat object's data from parsed metadata and columns.
+    """
+
+    for key, entry in metadata:
+      self[key] = entry
+      if key not in self.__metadataKeys:
+        self.__metadataKeys.append(key)
+
+    # Create dict accessable data in the StaibDat object out of the datakeys. A datakey without a unit gets an empty string. In compact mode, each value is a view onto a contiguous row of the transposed columns; otherwise the list of values is only made the first time the datakey is accessed.
+    self.__datakeysList = datakeys
+    if self.__dtype is not None:
+      columns = self.__integers(columns)
+    if self.__compact:
+      columns = numpy.ascontiguousarray(columns.T)
+    else:
+      columns = columns.T
+    for indx, datakey in enumerate(datakeys):
+      if self.__compact:
+        self[datakey.key] = {"value":columns[indx],
+                             "unit":datakey.unit}
+      else:
+        self[datakey.key] = _Deferred(_dataentry, columns[indx], datakey.unit)
+
+  def __integers(self, columns):
+    """
+    Returns the columns of the data section as the integer type of the dtype policy.
+
+    Columns that already have an integer type allowed by the policy are
+    returned as they are, so unpickling doesn't copy them. Raises FormatError
+    with the cause "dtype" at the first value that isn't a whole number or
+    doesn't fit the type.
+    """
+
+    isAuto = isinstance(self.__dtype, _basestring) and self.__dtype == "auto"
+    if numpy.issubdtype(columns.dtype, numpy.integer) and (isAuto or columns.dtype == numpy.dtype(self.__dtype)):
+      self.__integerDtype = columns.dtype
+      return columns
+    columns = numpy.asarray(columns, dtype = float)
+    dtype = _integerdtype(columns[numpy.isfinite(columns)], self.__dtype)
+    info = numpy.iinfo(dtype)
+    # NaN fails every comparison, so it is caught as not being a whole number.
+    invalid = ~(columns == numpy.round(columns)) | (columns < info.min) | (columns > info.max)
+    if invalid.any():
+      row, column = [int(indx[0]) for indx in numpy.nonzero(invalid)]
+      value = float(columns[row, column])
+      dataLine = self.__lineNumbers.get("datavalues")
+      line = None if dataLine is None else dataLine + row
+      raise FormatError("dtype: expected a whole number that fits %s, found %r%s" % (dtype.name, value, "" if line is None else " at line %d" % line), "dtype", [Violation("dtype", line, dtype.name, value)])
+    self.__integerDtype = dtype
+    return columns.astype(dtype)
+
+  def __values(self, key):
+    """
+    Returns the values of a datakey without making its entry if it is deferred.
+    """
+
+    entry = dict.__getitem__(self, key)
+    if isinstance(entry, _Deferred):
+      return entry.args[0]
+    return entry["value"]
+
+  def __parsefiletext(self, timer = None):
+    """
+    Labels, verifies and parses the file text with the pyparsing engine.
+
+    timer is a FileTimer to record each phase with, or None.
+    """
+
     # Create a list which labels each line of the file's structure.
     self.__lineTypeList = self.__labelstructure()
+    if timer is not None:
+      timer.lap("label", len(self.__lineTypeList))
     
     # Find the line index of the datakeys in the file. If there isn't one, don't worry because __verifystructure will figure it out.
     if self.__lineTypeList.count("datakeys") != 0:
       self.__datakeysLineIndx = self.__lineTypeList.index("datakeys")
       # Parse the datakeys line and keep the list.
-      self.__datakeysList = self.__datakeys.parseString(self["fileText"][self.__datakeysLineIndx])
+      self.__datakeysList = self.__grammar.parsedatakeys(self["fileText"][self.__datakeysLineIndx])
     
     # Verify the data file has the correct structure.
     self.__verifystructure()
+    if timer is not None:
+      timer.lap("verifystructure", len(self.__lineTypeList))
     
     # Parse the text and populate the StaibDat object's data.
     self.__parsetext()
-      
-    # Verify that the metadata and data in the file agree.
-    self.__verifydata()
-      
-    # Generate the user-friendly KE, C1, etc. numpy arrays.
-    self.__userfriendify()
+    if timer is not None:
+      timer.lap("parse", len(self.__lineTypeList))
     
   def __labelstructure(self):
     """
@@ -167,11 +601,10 @@ class StaibDat(dict):
     lineTypeList = []
     
     for line in self["fileText"]:
-      lineTypeList.append(self.__labelline(line))
+      lineTypeList.append(self.__grammar.labelline(line))
       
     return lineTypeList
-    
-    
+
   def __verifystructure(self):
     """
     Verify structure of imported text.
@@ -181,11 +614,12 @@ class StaibDat(dict):
     
     # If there is any data in the list of type "other," we know we are dealing with a file containing bad data.
     if "other" in self.__lineTypeList:
-      raise FormatError
+      line = self.__lineTypeList.index("other") + 1
+      raise FormatError("line %d isn't part of any section" % line, "structure", [Violation("structure", line, None, "other")])
 
     # Additionally, there should be a single line of "datakeys" type data in the file.    
     if self.__lineTypeList.count("datakeys") != 1:
-      raise FormatError
+      raise FormatError("there are %d datakeys lines" % self.__lineTypeList.count("datakeys"), "structure", [Violation("structure", None, 1, self.__lineTypeList.count("datakeys"))])
     
     # In a properly formatted file, the types of lines should come in the following order: metadata, reserved, datakeys, datavalues. If not, the file isn't properly formatted and the import should fail.
     compressedList = []
@@ -197,67 +631,60 @@ class StaibDat(dict):
         compressedList.append(lineType)
         
     if compressedList != ["metadata","reserved","datakeys","datavalues"]:
-      raise FormatError
+      raise FormatError("the sections are %s" % ", ".join(compressedList), "structure", [Violation("structure", None, ["metadata","reserved","datakeys","datavalues"], compressedList)])
     
     # All of the lines in the data section of the file should have the same number of columns. Furthermore, the number of datakeys should equal the number of columns in the data section of the file.
-    for datavaluesLine in self["fileText"][self.__datakeysLineIndx + 1:]:
+    for indx, datavaluesLine in enumerate(self["fileText"][self.__datakeysLineIndx + 1:]):
       # Parse the line
-      datavaluesList = self.__datavalues.parseString(datavaluesLine)
+      datavaluesList = self.__grammar.parsedatavalues(datavaluesLine)
       if len(self.__datakeysList) != len(datavaluesList):
-        raise FormatError
+        line = self.__datakeysLineIndx + indx + 2
+        raise FormatError("line %d has %d values but there are %d datakeys" % (line, len(datavaluesList), len(self.__datakeysList)), "columns", [Violation("columns", line, len(self.__datakeysList), len(datavaluesList))])
     
 
-  def __labelline(self,line):
-    """
-    Returns a string indicating what section of the file the line comes from.
-    """
-    
-    if len(self.__metadata.searchString(line)) != 0:
-      return "metadata"
-    elif len(self.__reserved.searchString(line)) != 0:
-      return "reserved"
-    elif len(self.__datavalues.searchString(line)) != 0:
-      return "datavalues"
-    elif len(self.__datakeys.searchString(line)) != 0:
-      return "datakeys"
-    else:
-      return "other"
-      
-  def __verifydata(self):
+  def __verifydata(self, tolerance = None, collect = False):
     """
     Compares the values in the metadata section to those in the data section.
+
+    Each check is a single numpy operation on the Basis values. Energies are
+    compared within a tolerance in eV, see __init__. Raises FormatError with
+    the first violation found, or with all of them if collect is True.
     """
-    
+
+    tolerances = mergetolerances(self.tolerances, tolerance)
+    lineNumbers = self.__lineNumbers
+    dataLine = lineNumbers.get("datavalues")
+    basis = numpy.asarray(self.__values("Basis"), dtype = float) / 1000
+    violations = []
+
+    # The metadata the data is checked against has to be there and be a number; the checks needing a missing or non-numeric value are skipped.
+    expected = checkedmetadata(self, lineNumbers, violations)
+
     # Data Points should equal the number of data points.
-    if self["DataPoints"] != len(self["Basis"]["value"]):
-      raise FormatError
-    
+    if "DataPoints" in expected and expected["DataPoints"] != len(basis):
+      violations.append(Violation("datapoints", lineNumbers.get("DataPoints"), expected["DataPoints"], len(basis)))
+
     # The last value of energy should equal Stopenergy.
-    if round(self["Stopenergy"]["value"],2) != round(self["Basis"]["value"][-1]/1000,2):
-      raise FormatError
-       
+    if "Stopenergy" in expected and abs(expected["Stopenergy"] - basis[-1]) > tolerances["stopenergy"]:
+      violations.append(Violation("stopenergy", None if dataLine is None else dataLine + len(basis) - 1, expected["Stopenergy"], float(basis[-1])))
+
     # The first value of energy should equal Startenergy.
-    if round(self["Startenergy"]["value"],2) != round(self["Basis"]["value"][0]/1000,2):
-      raise FormatError
-    
-    # The difference between each Basis value should be consistent.
-    basisList = self["Basis"]["value"][:]
-    
-    diffList = []
-    val = basisList.pop()
-    while len(basisList):
-      bottomVal = basisList.pop()
-      diffList.append(round((val-bottomVal)/1000,2))
-      val = bottomVal
-      
-    if diffList.count(diffList[0]) != len(diffList):
-      raise FormatError
-    
-    # The difference between each Basis value should equal Stepwidth.
-    if diffList[0] != round(self["Stepwidth"],2):
-      raise FormatError
+    if "Startenergy" in expected and abs(expected["Startenergy"] - basis[0]) > tolerances["startenergy"]:
+      violations.append(Violation("startenergy", dataLine, expected["Startenergy"], float(basis[0])))
+
+    # The difference between each Basis value should be consistent. A file with a single data point has no steps to check.
+    if len(basis) > 1:
+      steps = numpy.diff(basis)
+      step = numpy.median(steps)
+      for indx in numpy.nonzero(numpy.abs(steps - step) > tolerances["stepsize"])[0]:
+        violations.append(Violation("stepsize", None if dataLine is None else dataLine + int(indx) + 1, float(step), float(steps[indx])))
+
+      # The difference between each Basis value should equal Stepwidth.
+      if "Stepwidth" in expected and abs(step - expected["Stepwidth"]) > tolerances["stepwidth"]:
+        violations.append(Violation("stepwidth", lineNumbers.get("Stepwidth"), expected["Stepwidth"], float(step)))
+
+    raiseviolations(violations, collect)
 
-      
   def __parsetext(self):
     """
     Steps through file text and populates the StaibDat object's data.
@@ -266,45 +693,27 @@ class StaibDat(dict):
     # Handle all of the metadata lines.
     for indx, line in enumerate(self.__lineTypeList):
       if line == "metadata":
-        # Parse the metadata line.
-        metadataLine = self.__metadata.parseString(self["fileText"][indx])
-        
-        # Try to coerce the value into a number if possible. int first, then float.
-        try:
-          value = int(metadataLine.value)
-        except:
-          try:
-            value = float(metadataLine.value)
-          except:
-            value = metadataLine.value
-        
-        # Compress out any whitespace in the metadata key.
-        key = re.sub("\s+","",metadataLine.key)
-        
-        # Some of the metadata doesn't have units. Try to make an entry with units, but don't fail if there isn't a unit.
-        if len(metadataLine.unit) != 0:
-          self[key] = {"value":value,
-                       "unit":metadataLine.unit}
-        else:
-          self[key] = value
+        # Parse the metadata line. Some of the metadata doesn't have units; see StaibGrammar for how those are handled.
+        key, entry = self.__grammar.parsemetadata(self["fileText"][indx])
+        self[key] = entry
+        self.__lineNumbers[key] = indx + 1
+        if key not in self.__metadataKeys:
+          self.__metadataKeys.append(key)
       else:
         pass
       
     # Handle the data lines, including the datakeys.
     
-    # Create dict accessable data in the StaibDat object out of the datakeys.
+    # Create dict accessable data in the StaibDat object out of the datakeys. A datakey without a unit gets an empty string.
     for datakey in self.__datakeysList:
-      self[datakey.key] = {"value":[]}
-      # The unit might not exist. If not, just continue on.
-      try:
-        self[datakey.key]["unit"] = datakey.unit
-      except:
-        pass
+      self[datakey.key] = {"value":[],
+                           "unit":datakey.unit}
         
     # Next step through the remaining lines of the file and put each data value in its proper location.
+    self.__lineNumbers["datavalues"] = self.__datakeysLineIndx + 2
     for datavaluesLine in self["fileText"][self.__datakeysLineIndx + 1:]:
       # Parse the line
-      datavaluesList = self.__datavalues.parseString(datavaluesLine)
+      datavaluesList = self.__grammar.parsedatavalues(datavaluesLine)
       # Match each data value to its proper place in the StaibDat object.
       for indx, datavalue in enumerate(datavaluesList):
         self[self.__datakeysList[indx].key]["value"].append(datavalue)
@@ -312,27 +721,94 @@ class StaibDat(dict):
 
   def __userfriendify(self):
     """
-    Generate the numpy arrays for KE, BE, and Cn.
+    Add the keys of the numpy arrays for KE, BE, and Cn.
     
     According to conversations with Staib, the analyzer has an internal bias
     and therefore we don't have to compensate for the analyzer work function.
+    The arrays are deferred, so each is only computed the first time it is
+    accessed.
     """
     
-    self["KE"] = numpy.array(self["Basis"]["value"])/1000
-    self["BE"] = self["SourceEnergy"] - self["KE"]
-    
-    # First, find the line where the datakeys are.
-    datakeysLine = self.__lineTypeList.index("datakeys")
+    basis = self.__values("Basis")
+    self["KE"] = _Deferred(_kineticenergy, basis)
+    self["BE"] = _Deferred(_bindingenergy, self["SourceEnergy"], basis)
     
-    # Parse the datakeys and make a list of each one, possibly with units.
-    datakeysList = self.__datakeys.parseString(self["fileText"][datakeysLine])
-    
-    # Assign each additional channel a convenience array.
+    # Assign each additional channel a convenience array. In compact mode the value already is an array, so share it instead of copying.
     for indx,datakey in enumerate(self.__datakeysList[1:]):
       key = "C" + str(indx+1)
-      self[key] = numpy.array(self[datakey.key]["value"])
+      if self.__compact:
+        self[key] = self[datakey.key]["value"]
+      else:
+        self[key] = _Deferred(_channel, self.__values(datakey.key))
+
+  def __getitem__(self, key):
+    """
+    Returns the entry for key, computing and caching it if it was deferred.
+    """
+
+    value = dict.__getitem__(self, key)
+    if isinstance(value, _Deferred):
+      value = value()
+      dict.__setitem__(self, key, value)
+    return value
+
+  # The following dict methods would otherwise hand out deferred placeholders instead of their entries.
+  def get(self, key, default = None):
+    if key in self:
+      return self[key]
+    return default
+
+  def setdefault(self, key, default = None):
+    if key not in self:
+      self[key] = default
+    return self[key]
+
+  def pop(self, key, *default):
+    if key in self:
+      value = self[key]
+      del self[key]
+      return value
+    return dict.pop(self, key, *default)
+
+  def popitem(self):
+    key = next(iter(self))
+    return key, self.pop(key)
+
+  def values(self):
+    return [self[key] for key in self]
+
+  def items(self):
+    return [(key, self[key]) for key in self]
+
+  def itervalues(self):
+    return (self[key] for key in self)
+
+  def iteritems(self):
+    return ((key, self[key]) for key in self)
+
+  def copy(self):
+    return dict(self.items())
   
-  def smooth(self, key, kernel = 13, order = 3):
+  def channelkeys(self):
+    """
+    Returns a list of the Cn keys of the object, e.g. ["C1", "C2"].
+    """
+
+    return ["C" + str(indx+1) for indx in range(len(self.__datakeysList) - 1)]
+
+  def __keydata(self, key):
+    """
+    Returns the array a key argument refers to: a single key, a list of keys, or an array.
+    """
+
+    if isinstance(key, _basestring):
+      return self[key]
+    elif isinstance(key, numpy.ndarray):
+      return key
+    else:
+      return numpy.array([self[k] for k in key])
+
+  def smooth(self, key, kernel = 13, order = 3, mode = "zero"):
     """
     Returns numpy array of smoothed data.
     
@@ -340,11 +816,16 @@ class StaibDat(dict):
     StaibDat class's default data arrays. Input arguments as well as their 
     default values are given as follows:
       key: A string indicating which of the object's data should be smoothed 
-        (e.g. C1, C2).
+        (e.g. C1, C2). A list of strings, e.g. SD.channelkeys(), smooths each
+        of them and returns a 2-D array with one row per key. A numpy array
+        is smoothed directly; a 2-D array is treated as one spectrum per row.
       kernel: A positive integer giving the number of points the smoothing 
         algorithm should consider. Default = 13.
       order: A positive integer giving the order of the polynomial used in the 
         smoothing algorithm. Default = 3.
+      mode: A string indicating how the edges are treated: "zero" pads the
+        data with zeros, "interp" fits a polynomial to the first and last
+        kernel points instead. Default = "zero".
         
     The implementation of Savitzky-Golay was wholesale copied and slightly 
     modified from the SciPy cookbook: 
@@ -353,9 +834,9 @@ class StaibDat(dict):
     See the original Savitzky-Golay paper at DOI: 10.1021/ac60214a047
     """
 
-    return self.__savitzky_golay(self[key],kernel,order,deriv = 0)
+    return Analysis.savitzky_golay(self.__keydata(key),kernel,order,deriv = 0,mode = mode)
   
-  def differentiate(self, key, kernel = 13, order= 3):
+  def differentiate(self, key, kernel = 13, order= 3, mode = "zero"):
     """
     Returns numpy array of approximation of first derivative of data.
     
@@ -363,11 +844,16 @@ class StaibDat(dict):
     data given in one of the StaibDat class's default data arrays. Input 
     arguments as well as their default values are given as follows:
       key: A string indicating which of the object's data should be smoothed 
-        (e.g. C1, C2).
+        (e.g. C1, C2). A list of strings, e.g. SD.channelkeys(), returns a 2-D
+        array with one row per key. A numpy array is differentiated directly;
+        a 2-D array is treated as one spectrum per row.
       kernel: A positive integer giving the number of points the smoothing 
         algorithm should consider. Default = 13.
       order: A positive integer giving the order of the polynomial used in the 
         smoothing algorithm. Default = 3.
+      mode: A string indicating how the edges are treated: "zero" pads the
+        data with zeros, "interp" fits a polynomial to the first and last
+        kernel points instead. Default = "zero".
         
     The implementation of Savitzky-Golay was wholesale copied and slightly 
     modified from the SciPy cookbook: 
@@ -376,73 +862,33 @@ class StaibDat(dict):
     See the original Savitzky-Golay paper at DOI: 10.1021/ac60214a047
     """
 
-    return self.__savitzky_golay(self[key],kernel,order,deriv = 1)
-
-  def __savitzky_golay(self, data, kernel, order, deriv):
-    """
-    Return smooth or differentiated data according to the Savitzky-Golay 
-    algorithm.
-    
-    The implementation of Savitzky-Golay was wholesale copied and slightly 
-    modified from the SciPy cookbook: 
-      http://www.scipy.org/Cookbook/SavitzkyGolay
+    return Analysis.savitzky_golay(self.__keydata(key),kernel,order,deriv = 1,mode = mode)
 
-    See the original Savitzky-Golay paper at DOI: 10.1021/ac60214a047
-    """
-    try:
-      kernel = abs(int(kernel))
-      order = abs(int(order))
-    except ValueError, msg:
-      raise ValueError("kernel and order have to be of type int (floats will be converted).")
-    if kernel % 2 != 1 or kernel < 1:
-      raise TypeError("kernel size must be a positive odd number, was: %d" % kernel)
-    if kernel < order + 2:
-      raise TypeError("kernel is to small for the polynomals\nshould be > order + 2")
-
-    # a second order polynomal has 3 coefficients
-    order_range = range(order+1)
-    half_window = (kernel -1) // 2
-    b = numpy.mat([[k**i for i in order_range] for k in range(-half_window, half_window+1)])
-    # since we don't want the derivative, else choose [1] or [2], respectively
-    m = numpy.linalg.pinv(b).A[deriv]
-    window_size = len(m)
-    half_window = (window_size-1) // 2
-
-    # precompute the offset values for better performance
-    offsets = range(-half_window, half_window+1)
-    offset_data = zip(offsets, m)
-
-    smooth_data = list()
-
-    # temporary data, with padded zeros (since we want the same length after smoothing)
-    data = numpy.concatenate((numpy.zeros(half_window), data, numpy.zeros(half_window)))
-    for i in range(half_window, len(data) - half_window):
-      value = 0.0
-      for offset, weight in offset_data:
-        value += weight * data[i + offset]
-      smooth_data.append(value)
-    return numpy.array(smooth_data)
-  
-  def gaussian_fit(self, key, index1, index2, order, backgroundtype, fit_size):
+  def gaussian_fit(self, key, index1 = 0, index2 = None, order = 1, backgroundtype = None, fit_size = 0, guess = None):
     """
     This method returns an n-peak Gaussian fit in the form of a numpy array, along with some Gaussian-related statistics. 
 
-    For a specified subset of the data, the outputs of this method are the median and standard deviation, sum of the least square errors (SSE), and the coefficient of determination (R^2) of the fitting. If there is more than one peak to be fitted, relative coefficients of each peak will also be returned. 
+    For a specified subset of the data, the outputs of this method are the median and standard deviation, sum of the least square errors (SSE), and the coefficient of determination (R^2) of the fitting. If there is more than one peak to be fitted, relative coefficients of each peak will also be returned. The results are returned as a tfan_parsers.Analysis.GaussianFit, with the fitted array under "fit", the medians under "centers" and the standard deviations under "widths". The fit is done along the binding energy.
 
     The inputs and their defaults are:
        key: A string indicating which of the object's data should be analyzed (count data).
-       index1: A positive integer that corresponds to the index of the first energy value that is greater than the lower bound of the energy range to be gaussian fitted.
-       index2: A positive integer that corresponds to the index of the last energy value that is less than the upper bound of the energy range to be gaussian fitted.
+       index1: A positive integer that corresponds to the index of the first energy value that is greater than the lower bound of the energy range to be gaussian fitted; see window for finding it from energies. Default value is 0.
+       index2: A positive integer that corresponds to the index of the last energy value that is less than the upper bound of the energy range to be gaussian fitted. Default value is the last index.
        order: A positive integer telling how many peaks should compose the fit. Default value is 1.
-       backgroundtype: A string indicating the background type to be removed.
-       fit_size: A positive integer indicating the desired number of evenly spaced data points in the returned Gaussian fit.       
+       backgroundtype: A string indicating the background type to be removed, see rm_background. Default value is None, for no background.
+       fit_size: A positive integer indicating the desired number of evenly spaced data points in the returned Gaussian fit. Default value is the number of points between index1 and index2.
+       guess: The (amplitude, center, width) of each peak to start the fit from, as an array of shape (order, 3) or the result of a previous fit. Starting from the fit of a similar spectrum, e.g. the previous one of a depth profile, saves most of the iterations. Default value is None, which picks the peaks from the data.
 
- 
+    The fitting is implemented in tfan_parsers.Analysis.gaussian_fit.
     """
-    pass
+
+    if index2 is None:
+      index2 = len(self["BE"]) - 1
+    interval = slice(index1, index2 + 1)
+    return Analysis.gaussian_fit(self["BE"][interval], self.__keydata(key)[..., interval], order, guess, backgroundtype, fit_size)
 
 
-  def rm_background(self, key, loBE = self["BE"][0], hiBE = self["BE"][-1], size = 0, model = "linear"):
+  def rm_background(self, key, loBE = None, hiBE = None, size = 0, model = "linear", **args):
     """
     Return a numpy array corresponding to the background electron count.
     
@@ -459,10 +905,12 @@ class StaibDat(dict):
     Input arguments as well as their units and default values are given as
     follows:
       key: A string indicating which of the object's data should be analyzed.
+      A list of strings, e.g. SD.channelkeys(), returns a 2-D array with one
+      row per key.
       loBE [eV]: Numerical value of the lower bound of the binding energy
       interval to be analyzed. Default: lower bound of the object's binding
       energy.
-      hiBE [eV]: Numerical value of the lower bound of the binding energy
+      hiBE [eV]: Numerical value of the upper bound of the binding energy
       interval to be analyzed. Default: upper bound of the object's binding
       energy.
       size: Integer specifying the number of elements the returned array
@@ -471,21 +919,82 @@ class StaibDat(dict):
       model: A string indicating the name of background removal algorithm to
       use. Valid input is "linear", "shirley", "tougaard", or "blended" for
       blended Shirley type background.
+      args: Any other keyword arguments are passed on to the background
+      model, see tfan_parsers.Analysis.background.
+
+    The background models are implemented in tfan_parsers.Analysis.
     """
-    pass
+
+    interval = Analysis.window(self["BE"], loBE, hiBE)
+    energy = self["BE"][interval]
+    background = Analysis.background(energy, self.__keydata(key)[..., interval], model, **args)
+    if size:
+      background = Analysis.resize(energy, background, size)
+    return background
 
 
-  def integrate(self, abscissa, ordinate, index1, index2, backgroundtype, integralmethod, args): 
+  def window(self, lo = None, hi = None, abscissa = "BE"):
+    """
+    Returns the (index1, index2) of the energies of a window, for integrate and gaussian_fit.
+
+    The energy axis is searched with a binary search, so finding a window
+    costs O(log n). Input arguments as well as their units and default values
+    are given as follows:
+      lo [eV]: The lower bound of the window, or an array of lower bounds.
+      Default: the lower bound of the axis.
+      hi [eV]: The upper bound of the window, or an array of upper bounds.
+      Default: the upper bound of the axis.
+      abscissa: A string indicating the energy axis of the bounds, "BE" or
+      "KE". Default = "BE".
+
+    index1 and index2 are the first and last index of the energies with lo <=
+    energy <= hi, both included, e.g.:
+      SD.integrate("BE", "C1", *SD.window(280, 295))
+    With arrays of bounds they are arrays, one window per pair of bounds.
+    Raises ValueError if a window holds no energies.
     """
-    This method will allow you to calculate the area under a spectrum, along with statistics/parameters from integration. 
 
-    The inputs are:
+    index1, index2 = Analysis.window_indices(self[abscissa], lo, hi)
+    if numpy.any(index2 < index1):
+      raise ValueError("no %s data between %s and %s eV" % (abscissa, lo, hi))
+    if numpy.ndim(index1) == 0:
+      return int(index1), int(index2)
+    return index1, index2
+
+  def resample(self, key, grid, abscissa = "KE", fill = numpy.nan):
+    """
+    Returns the data of a key linearly interpolated onto an energy grid.
+
+    key is a single key, e.g. "C1", or a list of keys, which returns a 2-D
+    array with one row per key. grid is a monotonic array of energies in eV
+    on the abscissa axis, "KE" or "BE". Energies of the grid outside the axis
+    of the object get fill. To put many spectra onto one grid at once, see
+    StaibStack or tfan_parsers.Analysis.resample.
+    """
+
+    data = self.__keydata(key)
+    result = Analysis.resample(self[abscissa], data, grid, fill)
+    return result[0] if numpy.ndim(data) == 1 else result
+
+  def integrate(self, abscissa, ordinate, index1 = 0, index2 = None, backgroundtype = None, integralmethod = "trapezoid", args = None):
+    """
+    This method will allow you to calculate the area under a spectrum.
+
+    The area is positive whichever direction the abscissa runs in. index1 and
+    index2 may be arrays of indices, or index1 an array of (index1, index2)
+    pairs, to get the areas of many windows at once; all of them are computed
+    in a single pass over the data from cumulative sums.
+
+    The inputs and their defaults are:
        abscissa: A string indicating which of the object's data will be the abscissa values (KE, BE).
-       ordinate: A string indicating which of the object's data will be the ordinate values (count data).
-       index1: A positive integer that corresponds to the index of the first energy value that is greater than the lower bound of the energy range to be integrated.
-       index2: A positive integer that corresponds to the index of the last energy value that is less than the upper bound of the energy range to be integrated.	
-       backgroundtype: A string indicating the background type to be removed.
-       integralmethod: A string indicating method of integration (Simpson, etc). 
-       args: Other arguments affecting the integration method.
-    """
-    pass
\ No newline at end of file
+       ordinate: A string indicating which of the object's data will be the ordinate values (count data). A list of strings returns one row of areas per key.
+       index1: A positive integer that corresponds to the index of the first energy value that is greater than the lower bound of the energy range to be integrated; see window for finding it from energies. Default value is 0.
+       index2: A positive integer that corresponds to the index of the last energy value that is less than the upper bound of the energy range to be integrated. Default value is the last index.
+       backgroundtype: A string indicating the background type to be removed from each window, see rm_background. Default value is None, for no background.
+       integralmethod: A string indicating method of integration, "trapezoid" or "simpson". Default value is "trapezoid".
+       args: A dictionary of other arguments passed on to the background model. Default value is None.
+
+    The integration is implemented in tfan_parsers.Analysis.integrate.
+    """
+
+    return Analysis.integrate(self[abscissa], self.__keydata(ordinate), index1, index2, integralmethod, backgroundtype, self["BE"], **(args or {}))
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+from .Errors import FormatError
+import re
+import collections
+
+# A single entry of the datakeys line, e.g. "Basis[mV]" becomes DataKey("Basis", "mV"). The unit is an empty string if the datakey doesn't have one.
+DataKey = collections.namedtuple("DataKey", ["key", "unit"])
+
+def _jointokens(tokens):
+  """
+  Parse action joining multiple words into a single space separated string.
+  """
+  return " ".join(tokens)
+
+def _tofloat(tokens):
+  """
+  Parse action coercing a numerical token to a float.
+  """
+  return float(tokens[0])
+
+def _metadataitem(key, unit, value):
+  """
+  Returns the StaibDat key and entry for a parsed metadata line.
+
+  Any whitespace is compressed out of the key. The value is coerced into a
+  number if possible, int first, then float. Metadata with a unit becomes a
+  dictionary with "value" and "unit" entries; otherwise the entry is simply
+  the value.
+  """
+
+  try:
+    value = int(value)
+  except:
+    try:
+      value = float(value)
+    except:
+      pass
+
+  key = re.sub(r"\s+","",key)
+
+  if len(unit) != 0:
+    return key, {"value":value,
+                 "unit":unit}
+  else:
+    return key, value
+
+class StaibGrammar(object):
+  """
+  Pre-built grammar describing the lines of a winspectro .dat file.
+
+  Building the pyparsing forms is a noticeable part of the time it takes to
+  import a small file, so a StaibGrammar is built once and shared by every
+  StaibDat object that uses it. The default grammar, DEFAULT_GRAMMAR, is built
+  when the module is imported and follows the Backus-Naur Form given in
+  WINSPECTRO_DATA_FILE_STRUCTURE.TXT. Only the regular expressions are
+  compiled then; the pyparsing forms are built, and pyparsing imported, the
+  first time one of them is used, so reading files that the fast engine
+  handles on its own never imports pyparsing.
+
+  Other variants of the winspectro format can be described by building a new
+  StaibGrammar with different input arguments and passing it to StaibDat via
+  its grammar argument. Build such a grammar once and reuse it; the object
+  can't be modified after it has been built. Input arguments as well as their
+  default values are given as follows:
+    keywordChars: String of the characters, other than alphanums, allowed in a
+      keyword. Default = "-_".
+    valuewordChars: String of the characters, other than alphanums, allowed in
+      a valueword. Default = "./=:".
+    unitwordChars: String of the characters, other than alphas, allowed in a
+      unitword. Default = "%".
+    equalsdelimiter: String separating the key from the value in a metadata
+      line. Default = ":    ".
+    reservedword: String making up a line of the reserved section.
+      Default = "reserved".
+
+  A StaibGrammar provides the pyparsing forms metadata, reserved, datakeys and
+  datavalues used by the pyparsing engine, as well as the compiled regular
+  expressions used by the fast engine. Each regular expression only matches a
+  whole line if the corresponding pyparsing form would label and parse that
+  line the same way.
+
+  pyparsing's packrat caching is deliberately left off. Every parse of these
+  line grammars is a fresh call on a short string, so the cache is never hit,
+  and keeping it up to date made the pyparsing engine roughly 60% slower.
+  """
+
+  def __init__(self, keywordChars = "-_", valuewordChars = "./=:", unitwordChars = "%", equalsdelimiter = ":    ", reservedword = "reserved"):
+    """
+    Build the regular expressions of the grammar.
+    """
+
+    # Keep the input arguments so that the grammar can be pickled by rebuilding it.
+    object.__setattr__(self, "_arguments", (keywordChars, valuewordChars, unitwordChars, equalsdelimiter, reservedword))
+
+    # The regular expressions for the fast engine use the same character classes as the pyparsing forms, see __buildforms.
+    keywordRegex = "[A-Za-z0-9" + re.escape(keywordChars) + "]+"
+    unitRegex = r"\[[ \t]*([A-Za-z" + re.escape(unitwordChars) + r"]+)[ \t]*\]"
+    valuewordRegex = "[A-Za-z0-9" + re.escape(valuewordChars) + "]+"
+    numvalueRegex = "-?[0-9]+"
+    endRegex = r"[ \t\r\n]*\Z"
+
+    object.__setattr__(self, "metadataRegex", re.compile("^[ \t]*(" + keywordRegex + "(?:[ \t]+" + keywordRegex + ")*)[ \t]*(?:" + unitRegex + ")?[ \t]*" + re.escape(equalsdelimiter) + "[ \t]*(" + valuewordRegex + "(?:[ \t]+" + valuewordRegex + ")*)" + endRegex))
+    object.__setattr__(self, "reservedRegex", re.compile("^[ \t]*" + re.escape(reservedword) + endRegex))
+    object.__setattr__(self, "datakeyRegex", re.compile("(" + keywordRegex + ")(?:[ \t]*" + unitRegex + ")?"))
+    object.__setattr__(self, "datakeysRegex", re.compile("^[ \t]*" + keywordRegex + "(?:[ \t]*" + unitRegex + ")?(?:[ \t]+" + keywordRegex + "(?:[ \t]*" + unitRegex + ")?)+" + endRegex))
+    object.__setattr__(self, "datavaluesRegex", re.compile("^[ \t]*" + numvalueRegex + "(?:[ \t]+" + numvalueRegex + ")+" + endRegex))
+    # pyparsing tries metadata, reserved and datavalues before datakeys, and searches the whole line for them. A datakeys line containing any of the following would get a different label from pyparsing.
+    object.__setattr__(self, "datakeysVetoRegex", re.compile(re.escape(equalsdelimiter) + "|" + re.escape(reservedword) + "|[0-9](?:[ \t\r\n]*-|[ \t\r\n]+)[0-9]"))
+
+  def __getattr__(self, name):
+    # The pyparsing forms are only built, and pyparsing only imported, the first time one of them is used.
+    if name in ("metadata", "reserved", "datakeys", "datavalues"):
+      self.__buildforms()
+      return object.__getattribute__(self, name)
+    raise AttributeError("'StaibGrammar' object has no attribute '%s'" % name)
+
+  def __buildforms(self):
+    """
+    Build the pyparsing forms of the grammar.
+    """
+
+    import pyparsing
+    keywordChars, valuewordChars, unitwordChars, equalsdelimiter, reservedword = self._arguments
+
+    # Define pyparsing forms for each type of data found in lines of the file.
+    unitword = pyparsing.Word(pyparsing.alphas + unitwordChars)
+    valueword = pyparsing.Word(pyparsing.alphanums + valuewordChars)
+    keyword = pyparsing.Word(pyparsing.alphanums + keywordChars)
+    numvalue = pyparsing.Combine(pyparsing.Optional("-") + pyparsing.Word(pyparsing.nums))
+
+    # In the following I'm using setParseAction because some of the keys and values in the metadata are made up of multiple words. A priori I don't know which ones are, and I don't want to guess and write a bunch of fragile lookup lists and tests that I'll ultimately have to change later. The setParseAction method allows me to combine the multiple words into a single entry in the returned list. See p.19 of McGuire's "Getting Started with Pyparsing" for more details.
+    key = pyparsing.OneOrMore(keyword)
+    key.setParseAction(_jointokens)
+    unit = pyparsing.Suppress("[") + unitword + pyparsing.Suppress("]")
+    delimiter = pyparsing.Suppress(equalsdelimiter)
+    value = pyparsing.OneOrMore(valueword)
+    value.setParseAction(_jointokens)
+
+    # Again, I'm using setParseAction in this section. For the datavalues section, I'm using setParseAction to coerce the values directly to numbers since I know they are supposed to be anyway. I will also need to use Results Names in order to make the extraction of the data from the parsed results doable.
+    metadata = key.setResultsName("key") + \
+      pyparsing.Optional(unit.setResultsName("unit")) + delimiter + \
+      value.setResultsName("value")
+    reserved = pyparsing.Literal(reservedword)
+    datakeys = pyparsing.Group(keyword.setResultsName("key") + \
+      pyparsing.Optional(unit.setResultsName("unit"))) + \
+      pyparsing.OneOrMore(pyparsing.Group(keyword.setResultsName("key") + \
+      pyparsing.Optional(unit.setResultsName("unit"))))
+    datavalues = numvalue.setParseAction(_tofloat) + \
+      pyparsing.OneOrMore(numvalue.setParseAction(_tofloat))
+
+    for name, form in (("metadata", metadata), ("reserved", reserved), ("datakeys", datakeys), ("datavalues", datavalues)):
+      object.__setattr__(self, name, form.streamline())
+
+  def __reduce__(self):
+    # The compiled forms can't be pickled. The default grammar is looked up again by name; any other grammar is rebuilt from its input arguments.
+    if self is DEFAULT_GRAMMAR:
+      return (_defaultgrammar, ())
+    return (StaibGrammar, self._arguments)
+
+  def __setattr__(self, name, value):
+    raise AttributeError("StaibGrammar objects can't be modified; build a new StaibGrammar instead.")
+
+  def __delattr__(self, name):
+    raise AttributeError("StaibGrammar objects can't be modified; build a new StaibGrammar instead.")
+
+  def labelline(self, line):
+    """
+    Returns a string indicating what section of the file the line comes from.
+
+    This is the pyparsing engine's labeling: each form is searched for
+    anywhere in the line, in the order metadata, reserved, datavalues,
+    datakeys.
+    """
+
+    if len(self.metadata.searchString(line)) != 0:
+      return "metadata"
+    elif len(self.reserved.searchString(line)) != 0:
+      return "reserved"
+    elif len(self.datavalues.searchString(line)) != 0:
+      return "datavalues"
+    elif len(self.datakeys.searchString(line)) != 0:
+      return "datakeys"
+    else:
+      return "other"
+
+  def fastlabelline(self, line):
+    """
+    Returns the fast engine's label for a line and the regular expression match.
+
+    The label is None if the fast engine can't label the line with certainty.
+    The match is only returned for metadata lines, otherwise it is None.
+    """
+
+    if self.datavaluesRegex.match(line):
+      return "datavalues", None
+    match = self.metadataRegex.match(line)
+    if match:
+      return "metadata", match
+    elif self.reservedRegex.match(line):
+      return "reserved", None
+    elif self.datakeysRegex.match(line) and not self.datakeysVetoRegex.search(line):
+      return "datakeys", None
+    else:
+      return None, None
+
+  def parsemetadata(self, line):
+    """
+    Returns the StaibDat key and entry of a metadata line using pyparsing.
+
+    Raises FormatError if the line doesn't parse.
+    """
+
+    import pyparsing
+    try:
+      metadataLine = self.metadata.parseString(line)
+    except pyparsing.ParseException:
+      raise FormatError("metadata line doesn't parse: %r" % line, "syntax")
+    return _metadataitem(metadataLine.key, "".join(metadataLine.unit), metadataLine.value)
+
+  def fastparsemetadata(self, match):
+    """
+    Returns the StaibDat key and entry of a metadata line matched by the fast engine.
+    """
+
+    # The pyparsing parse actions join multiple words with a single space, so do the same here.
+    return _metadataitem(match.group(1), match.group(2) or "", " ".join(match.group(3).split()))
+
+  def parsedatakeys(self, line):
+    """
+    Returns a list of DataKey from a datakeys line using pyparsing.
+
+    Raises FormatError if the line doesn't parse.
+    """
+
+    import pyparsing
+    try:
+      datakeysList = self.datakeys.parseString(line)
+    except pyparsing.ParseException:
+      raise FormatError("datakeys line doesn't parse: %r" % line, "syntax")
+    return [DataKey(datakey.key, "".join(datakey.unit)) for datakey in datakeysList]
+
+  def fastparsedatakeys(self, line):
+    """
+    Returns a list of DataKey from a datakeys line labeled by the fast engine.
+    """
+
+    return [DataKey(key, unit) for key, unit in self.datakeyRegex.findall(line)]
+
+  def parsedatavalues(self, line):
+    """
+    Returns a list of the float values of a datavalues line using pyparsing.
+
+    Raises FormatError if the line doesn't parse.
+    """
+
+    import pyparsing
+    try:
+      return list(self.datavalues.parseString(line))
+    except pyparsing.ParseException:
+      raise FormatError("datavalues line doesn't parse: %r" % line, "syntax")
+
+def _defaultgrammar():
+  """
+  Returns DEFAULT_GRAMMAR; used when unpickling it.
+  """
+  return DEFAULT_GRAMMAR
+
+# The grammar used by StaibDat unless told otherwise.
+DEFAULT_GRAMMAR = StaibGrammar()
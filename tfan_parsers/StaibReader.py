@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+from .Errors import FormatError, Violation
+from .StaibGrammar import DEFAULT_GRAMMAR
+
+class StaibReader(object):
+  """
+  Single-pass reader for the lines of a winspectro .dat file.
+
+  A StaibReader is fed the lines of a file one at a time. Each line is
+  labeled, checked against the structure of the file and parsed as soon as
+  it arrives, so the reader works with anything that yields lines: an open
+  file, a BytesIO, a socket's makefile(), or a member of a zip or tar archive.
+  Lines given as bytes are decoded as latin-1. The full text is only held on
+  to if keepText is True.
+
+  Lines are labeled and parsed with the fast engine of the StaibGrammar; any
+  line the fast engine isn't certain about is handed to the grammar's
+  pyparsing forms, so the result is the same as with StaibDat's pyparsing
+  engine. Rows of the data section are converted to numpy arrays in chunks of
+  chunkSize lines. numpy is only imported once there are rows to convert, so
+  reading just the header, see readheader, doesn't import it.
+
+  After the last line has been fed, call close(). The results are available
+  from the following attributes:
+    metadata: List of (key, entry) pairs of the metadata section, in file
+      order, with keys and entries as they appear in a StaibDat object.
+    datakeys: List of DataKey from the datakeys line.
+    columns: 2-D numpy array of the data section with one column per datakey.
+    fileText: List of the lines fed to the reader if keepText is True,
+      otherwise None.
+    lineCount: The number of lines fed to the reader.
+    byteCount: The number of characters in the lines fed to the reader.
+    lineNumbers: Dictionary of the line number (counting from 1) of each
+      metadata key, and of the first line of data under "datavalues".
+  """
+
+  sections = ("metadata", "reserved", "datakeys", "datavalues")
+  chunkSize = 1024
+
+  def __init__(self, grammar = None, keepText = False):
+    """
+    Instantiation of StaibReader object.
+    """
+
+    if grammar is None:
+      grammar = DEFAULT_GRAMMAR
+    self.grammar = grammar
+
+    self.metadata = []
+    self.datakeys = None
+    self.columns = None
+    self.fileText = [] if keepText else None
+    self.lineCount = 0
+    self.byteCount = 0
+    self.lineNumbers = {}
+
+    # Index into sections of the section the previous line belonged to.
+    self.__section = -1
+    # Data lines waiting to be converted, and the arrays converted so far.
+    self.__chunk = []
+    self.__arrays = []
+
+  def read(self, lines):
+    """
+    Feed every line of an iterable to the reader, close it and return it.
+    """
+
+    for line in lines:
+      self.feed(line)
+    self.close()
+    return self
+
+  def readheader(self, lines):
+    """
+    Feed the lines of an iterable up to the reserved section and return the reader.
+
+    Reading stops at the first reserved line, so the data section is never
+    read and the rest of lines is left unconsumed. Only metadata and
+    lineNumbers are filled in. Raises FormatError if the lines end before the
+    reserved section.
+    """
+
+    for line in lines:
+      self.feed(line)
+      if self.__section == self.sections.index("reserved"):
+        return self
+    raise FormatError("the file ends before the reserved section", "structure", [Violation("structure", self.lineCount, "reserved", "end of file")])
+
+  def feed(self, line):
+    """
+    Label, verify and parse a single line.
+
+    Raises FormatError as soon as the line doesn't fit the structure of a
+    winspectro file.
+    """
+
+    line = self.decode(line)
+    if self.fileText is not None:
+      self.fileText.append(line)
+    self.lineCount += 1
+    self.byteCount += len(line)
+
+    lineType, match = self.grammar.fastlabelline(line)
+    fast = lineType is not None
+    if not fast:
+      lineType = self.grammar.labelline(line)
+
+    self.__enter(lineType)
+
+    if lineType == "datavalues":
+      if fast:
+        if len(line.split()) != len(self.datakeys):
+          raise self.__columnserror(len(line.split()))
+        self.__chunk.append(line)
+      else:
+        datavaluesList = self.grammar.parsedatavalues(line)
+        if len(datavaluesList) != len(self.datakeys):
+          raise self.__columnserror(len(datavaluesList))
+        self.__chunk.append(" ".join([repr(datavalue) for datavalue in datavaluesList]) + "\n")
+      if len(self.__chunk) >= self.chunkSize:
+        self.__flush()
+    elif lineType == "metadata":
+      if fast:
+        self.metadata.append(self.grammar.fastparsemetadata(match))
+      else:
+        self.metadata.append(self.grammar.parsemetadata(line))
+      self.lineNumbers[self.metadata[-1][0]] = self.lineCount
+    elif lineType == "datakeys":
+      if fast:
+        self.datakeys = self.grammar.fastparsedatakeys(line)
+      else:
+        self.datakeys = self.grammar.parsedatakeys(line)
+
+  @staticmethod
+  def decode(line):
+    """
+    Returns the line as a string, decoding it as latin-1 if it is bytes.
+    """
+
+    if isinstance(line, bytes) and not isinstance(line, str):
+      return line.decode("latin-1")
+    return line
+
+  def close(self):
+    """
+    Finish reading and assemble the columns of the data section.
+
+    Raises FormatError if the lines fed so far don't make up a complete file.
+    """
+
+    if self.__section != len(self.sections) - 1:
+      raise self.__structureerror("the file ends before the %s section" % self.sections[self.__section + 1], self.sections[self.__section + 1], "end of file")
+    self.columns = self.takerows()
+
+  def takerows(self):
+    """
+    Returns the rows of data fed since the previous call as a 2-D array.
+
+    The rows are forgotten by the reader once taken, so the data section of
+    a file that is still being written can be consumed while it grows. close()
+    only assembles the rows that haven't been taken.
+    """
+
+    import numpy
+    self.__flush()
+    if self.datakeys is None:
+      return numpy.empty((0, 0))
+    rows = numpy.concatenate(self.__arrays + [numpy.empty(0)]).reshape(-1, len(self.datakeys))
+    self.__arrays = []
+    return rows
+
+  def __enter(self, lineType):
+    """
+    Check that a line of the given type may follow the previous line.
+
+    The sections of the file have to come in the order metadata, reserved,
+    datakeys, datavalues, and there can only be a single datakeys line.
+    """
+
+    if lineType not in self.sections:
+      raise self.__structureerror("line %d isn't part of any section" % self.lineCount, None, lineType)
+    section = self.sections.index(lineType)
+    if section == self.__section + 1:
+      self.__section = section
+      if lineType == "datavalues":
+        self.lineNumbers["datavalues"] = self.lineCount
+    elif section != self.__section or lineType == "datakeys":
+      raise self.__structureerror("line %d is %s but follows %s" % (self.lineCount, lineType, self.sections[self.__section] if self.__section >= 0 else "nothing"), self.sections[min(self.__section + 1, len(self.sections) - 1)], lineType)
+
+  def __structureerror(self, message, expected, actual):
+    """
+    Returns the FormatError for a line that doesn't fit the structure of the file.
+    """
+
+    return FormatError(message, "structure", [Violation("structure", self.lineCount, expected, actual)])
+
+  def __columnserror(self, columns):
+    """
+    Returns the FormatError for a line of data with the wrong number of values.
+    """
+
+    message = "line %d has %d values but there are %d datakeys" % (self.lineCount, columns, len(self.datakeys))
+    return FormatError(message, "columns", [Violation("columns", self.lineCount, len(self.datakeys), columns)])
+
+  def __flush(self):
+    """
+    Convert the pending data lines into an array.
+    """
+
+    if len(self.__chunk) != 0:
+      import numpy
+      self.__arrays.append(numpy.fromstring(str("".join(self.__chunk)), dtype = float, sep = " "))
+      self.__chunk = []
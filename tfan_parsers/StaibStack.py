@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+from .StaibDat import StaibDat
+from .Errors import metadatavalue
+from . import Analysis
+import numpy
+
+try:
+  _basestring = basestring
+except NameError:
+  _basestring = str
+
+class StaibStack(dict):
+  """
+  Stack of winspectro spectra sharing a single energy axis.
+
+  A StaibStack is built from a list of StaibDat objects, or of filenames which
+  are then read in compact mode. All of the spectra have to share the same
+  energy axis, i.e. the same Startenergy, Stopenergy, Stepwidth and Basis
+  values; otherwise ValueError is raised. Spectra with different axes, e.g.
+  from different sessions, can be stacked by giving a grid of kinetic
+  energies, onto which all of them are resampled in a single batch, see
+  tfan_parsers.Analysis.resample. The stack keeps one copy of the axis and
+  packs the counts of each channel into a single 2-D numpy array with one
+  row per spectrum, so that operations on every spectrum at once are single
+  numpy operations.
+
+  Like StaibDat, a StaibStack acts like a python dictionary:
+    filename: A list of the filenames of the spectra, in stack order.
+    KE [eV]: A 1-D numpy array with the shared kinetic energy axis.
+    BE [eV]: A numpy array with the binding energy. This is 1-D if all of the
+    spectra have the same SourceEnergy, otherwise 2-D with one row per
+    spectrum.
+    Cn [count]: A 2-D numpy array with one row of counts per spectrum.
+    Any metadata key: A numpy array with one value per spectrum, so that
+    e.g. stack["Technique"] == "XPS" selects spectra. For metadata with
+    units, the entry is a dictionary with the array under "value" and the
+    unit of the first spectrum under "unit". Spectra missing a key get None.
+  """
+
+  def __init__(self, spectra, grid = None):
+    """
+    Instantiation of StaibStack object.
+
+    spectra is a list of StaibDat objects and/or filenames of .dat files.
+    grid is a monotonic array of kinetic energies in eV to resample every
+    spectrum onto, or None to require the spectra to share their axis.
+    Counts at energies of the grid outside the axis of a spectrum are NaN.
+    """
+
+    spectra = [StaibDat(spectrum, compact = True) if isinstance(spectrum, _basestring) else spectrum for spectrum in spectra]
+    if len(spectra) == 0:
+      raise ValueError("a StaibStack needs at least one spectrum")
+
+    # All of the spectra have to share the energy axis of the first one, unless they are resampled onto the grid.
+    first = spectra[0]
+    for spectrum in (spectra[1:] if grid is None else []):
+      for key in ("Startenergy", "Stopenergy"):
+        if metadatavalue(spectrum.get(key)) != metadatavalue(first.get(key)):
+          raise ValueError("%s of %s differs from %s" % (key, spectrum["filename"], first["filename"]))
+      if spectrum["Stepwidth"] != first["Stepwidth"] or not numpy.array_equal(spectrum["KE"], first["KE"]):
+        raise ValueError("energy axis of %s differs from %s" % (spectrum["filename"], first["filename"]))
+
+    self["filename"] = [spectrum["filename"] for spectrum in spectra]
+    self["KE"] = numpy.array(first["KE"] if grid is None else grid, dtype = float)
+
+    # Pack each channel into a 2-D array. Only channels every spectrum has are kept.
+    channelkeys = [key for key in first.channelkeys() if all([key in spectrum for spectrum in spectra])]
+    for key in channelkeys:
+      if grid is None:
+        self[key] = numpy.array([spectrum[key] for spectrum in spectra], dtype = float)
+      else:
+        self[key] = Analysis.resample([spectrum["KE"] for spectrum in spectra], [spectrum[key] for spectrum in spectra], self["KE"])
+    self.__channelkeys = channelkeys
+
+    # Metadata becomes one column per key, in the order the keys first appear.
+    metadataKeys = []
+    for spectrum in spectra:
+      for key in spectrum.metadatakeys():
+        if key not in metadataKeys:
+          metadataKeys.append(key)
+    for key in metadataKeys:
+      entries = [spectrum.get(key) for spectrum in spectra]
+      units = [entry["unit"] for entry in entries if isinstance(entry, dict)]
+      if len(units) != 0:
+        self[key] = {"value":self.__column([entry["value"] if isinstance(entry, dict) else entry for entry in entries]),
+                     "unit":units[0]}
+      else:
+        self[key] = self.__column(entries)
+
+    sourceEnergy = self["SourceEnergy"]
+    if len(set(sourceEnergy.tolist())) == 1:
+      self["BE"] = sourceEnergy[0] - self["KE"]
+    else:
+      self["BE"] = sourceEnergy[:, numpy.newaxis] - self["KE"]
+
+  def __column(self, values):
+    """
+    Returns a numpy array of metadata values; anything not numerical is kept as python objects.
+    """
+
+    column = numpy.array(values)
+    if column.dtype.kind not in "biuf":
+      column = numpy.array(values, dtype = object)
+    return column
+
+  def channelkeys(self):
+    """
+    Returns a list of the Cn keys of the stack, e.g. ["C1", "C2"].
+    """
+
+    return list(self.__channelkeys)
+
+  def window(self, lo = None, hi = None, abscissa = "BE"):
+    """
+    Returns the (index1, index2) of the energies of a window, for integrate and gaussian_fit.
+
+    See StaibDat.window for the input arguments. The spectra of the stack
+    have to share the same SourceEnergy for a window on the BE axis.
+    """
+
+    if self[abscissa].ndim != 1:
+      raise ValueError("the spectra of the stack don't share a binding energy axis")
+    index1, index2 = Analysis.window_indices(self[abscissa], lo, hi)
+    if numpy.any(index2 < index1):
+      raise ValueError("no %s data between %s and %s eV" % (abscissa, lo, hi))
+    if numpy.ndim(index1) == 0:
+      return int(index1), int(index2)
+    return index1, index2
+
+  def sum(self, key):
+    """
+    Returns a numpy array of the counts of channel key summed over the stack.
+    """
+
+    return self[key].sum(axis = 0)
+
+  def mean(self, key):
+    """
+    Returns a numpy array of the counts of channel key averaged over the stack.
+    """
+
+    return self[key].mean(axis = 0)
+
+  def normalize(self, key, method = "max"):
+    """
+    Returns a 2-D numpy array with every spectrum of channel key normalized.
+
+    The method argument is a string indicating what each spectrum is divided
+    by: "max" for its largest count, "area" for the area under it on the KE
+    axis (trapezoid rule), or "sum" for its total count. Default = "max".
+    """
+
+    counts = self[key]
+    if method == "max":
+      norm = counts.max(axis = 1)
+    elif method == "area":
+      norm = Analysis.integrate(self["KE"], counts)
+    elif method == "sum":
+      norm = counts.sum(axis = 1)
+    else:
+      raise ValueError("method must be \"max\", \"area\" or \"sum\", was: %s" % method)
+    return counts / norm[:, numpy.newaxis]
+
+  def smooth(self, key, kernel = 13, order = 3, mode = "zero"):
+    """
+    Returns a 2-D numpy array with every spectrum of channel key smoothed.
+
+    See StaibDat.smooth for the input arguments.
+    """
+
+    return Analysis.savitzky_golay(self[key], kernel, order, deriv = 0, mode = mode)
+
+  def differentiate(self, key, kernel = 13, order = 3, mode = "zero"):
+    """
+    Returns a 2-D numpy array with the first derivative of every spectrum of channel key.
+
+    See StaibDat.differentiate for the input arguments.
+    """
+
+    return Analysis.savitzky_golay(self[key], kernel, order, deriv = 1, mode = mode)
+
+  def rm_background(self, key, loBE = None, hiBE = None, size = 0, model = "linear", **args):
+    """
+    Returns a 2-D numpy array with the background of every spectrum of channel key.
+
+    See StaibDat.rm_background for the input arguments. The spectra of the
+    stack have to share the same SourceEnergy.
+    """
+
+    if self["BE"].ndim != 1:
+      raise ValueError("the spectra of the stack don't share a binding energy axis")
+    interval = Analysis.window(self["BE"], loBE, hiBE)
+    energy = self["BE"][interval]
+    background = Analysis.background(energy, self[key][:, interval], model, **args)
+    if size:
+      background = Analysis.resize(energy, background, size)
+    return background
+
+  def integrate(self, abscissa, ordinate, index1 = 0, index2 = None, backgroundtype = None, integralmethod = "trapezoid", args = None):
+    """
+    Returns the areas under every spectrum of channel ordinate, with one row per spectrum.
+
+    See StaibDat.integrate for the input arguments. If the spectra have
+    different SourceEnergy, the BE axis of the first spectrum is used; the
+    spacing of the axis, which is all the areas depend on, is shared.
+    """
+
+    energy = self[abscissa]
+    if energy.ndim != 1:
+      energy = energy[0]
+    return Analysis.integrate(energy, self[ordinate], index1, index2, integralmethod, backgroundtype, -self["KE"], **(args or {}))
+
+  def gaussian_fit(self, key, index1 = 0, index2 = None, order = 1, backgroundtype = None, fit_size = 0, guess = None, series = False):
+    """
+    Returns an n-peak Gaussian fit of the same window of every spectrum of channel key.
+
+    See StaibDat.gaussian_fit for the input arguments. Every field of the
+    returned GaussianFit has one row per spectrum. By default all of the
+    spectra are fitted at once in a single batch, each starting from guess or
+    from its own data. If series is True, the spectra are fitted one after
+    the other in stack order, each starting from the fit of the one before,
+    which suits depth profiles and time series where neighbouring spectra are
+    alike. The spectra have to share the same SourceEnergy.
+    """
+
+    if self["BE"].ndim != 1:
+      raise ValueError("the spectra of the stack don't share a binding energy axis")
+    if index2 is None:
+      index2 = len(self["BE"]) - 1
+    interval = slice(index1, index2 + 1)
+    energy = self["BE"][interval]
+    counts = self[key][:, interval]
+    if not series:
+      return Analysis.gaussian_fit(energy, counts, order, guess, backgroundtype, fit_size)
+
+    fits = []
+    for row in counts:
+      guess = Analysis.gaussian_fit(energy, row, order, guess, backgroundtype, fit_size)
+      fits.append(guess)
+    # Stack the fields of the fits like a batch fit does; the energies are shared.
+    fields = [numpy.array(values) for values in zip(*fits)]
+    fields[0] = fits[0].energy
+    return Analysis.GaussianFit(*fields)
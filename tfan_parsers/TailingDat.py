@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+from .Errors import FormatError, Violation, mergetolerances, checkedmetadata, raiseviolations
+from .StaibReader import StaibReader
+from .StaibDat import StaibDat
+import io
+import os
+import time
+import numpy
+
+class TailingDat(object):
+  """
+  Incremental reader for a winspectro .dat file that is still being written.
+
+  During an acquisition winspectro writes the metadata section first and then
+  the data section one row at a time. A TailingDat reads what is in the file
+  so far and, on each call of poll, only the bytes added since the previous
+  call: the header is parsed once, and each new row of data is appended to
+  arrays that grow with the file and checked against the metadata as it
+  arrives. A dashboard can poll as often as it likes at a cost proportional
+  to the new rows, instead of parsing the whole file with StaibDat on every
+  refresh. Input arguments as well as their default values are given as
+  follows:
+    filename: The name of the .dat file.
+    grammar: A StaibGrammar for variants of the format. Default = None, for
+      DEFAULT_GRAMMAR.
+    tolerance, collect: See StaibDat.
+
+  A TailingDat is accessed like a StaibDat object: by metadata key, by datakey
+  (a dictionary with the "value" and "unit"), and by "filename", "KE", "BE"
+  and "Cn". The arrays hold the rows read so far; they are views onto the
+  storage of the object, so take a copy to keep them unchanged across calls
+  of poll. Only a line that ends in a newline is read, as the rest of it may
+  not have been written yet. len() of a TailingDat is the number of rows read.
+
+  Each new row is checked as it arrives: the first Basis value against
+  Startenergy, the first step between Basis values against Stepwidth and
+  every later step against the first, and the number of rows against
+  DataPoints. Once every row promised by DataPoints has been read, the last
+  Basis value is checked against Stopenergy. A problem raises FormatError
+  from poll, after which the object shouldn't be polled again. If the file shrinks, e.g. because a new acquisition
+  overwrote it, the object starts over from the beginning of the file.
+  """
+
+  def __init__(self, filename, grammar = None, tolerance = None, collect = False):
+    """
+    Instantiation of TailingDat object.
+    """
+
+    self.filename = filename
+    self.grammar = grammar
+    self.collect = collect
+    self.tolerances = mergetolerances(StaibDat.tolerances, tolerance)
+    self.__reset()
+    self.poll()
+
+  def __reset(self):
+    """
+    Forget everything read so far.
+    """
+
+    self.__reader = StaibReader(self.grammar)
+    self.__offset = 0
+    self.__partial = b""
+    self.__metadata = {}
+    # The numeric values of the metadata the rows are checked against, and the violations of the ones that are missing or not numbers.
+    self.__expected = {}
+    self.__metadataViolations = []
+    self.__rows = 0
+    self.__step = None
+    self.__data = numpy.empty((0, 0))
+    self.__energy = numpy.empty((2, 0))
+
+  @property
+  def metadata(self):
+    """
+    List of (key, entry) pairs of the metadata section read so far.
+    """
+
+    return self.__reader.metadata
+
+  @property
+  def datakeys(self):
+    """
+    List of DataKey from the datakeys line, or None if it hasn't been read yet.
+    """
+
+    return self.__reader.datakeys
+
+  @property
+  def lineNumbers(self):
+    """
+    Dictionary of the line number of each metadata key, and of the first line of data under "datavalues".
+    """
+
+    return self.__reader.lineNumbers
+
+  def __len__(self):
+    return self.__rows
+
+  def poll(self):
+    """
+    Read the lines added to the file since the previous call.
+
+    Returns the number of new rows of data.
+    """
+
+    datFile = open(self.filename,"rb")
+    try:
+      if os.fstat(datFile.fileno()).st_size < self.__offset:
+        self.__reset()
+      datFile.seek(self.__offset)
+      text = datFile.read()
+    finally:
+      datFile.close()
+    self.__offset += len(text)
+
+    # Hold on to the end of the text until its line is finished.
+    text = self.__partial + text
+    end = text.rfind(b"\n") + 1
+    self.__partial = text[end:]
+    if end == 0:
+      return 0
+
+    for line in io.BytesIO(text[:end]):
+      self.__reader.feed(line)
+      if self.__reader.datakeys is not None and len(self.__metadata) == 0:
+        self.__metadata = dict(self.__reader.metadata)
+        self.__metadataViolations = []
+        self.__expected = checkedmetadata(self.__metadata, self.lineNumbers, self.__metadataViolations)
+    rows = self.__reader.takerows()
+    if len(rows) != 0:
+      self.__append(rows)
+    return len(rows)
+
+  def follow(self, interval = 1.0, timeout = None):
+    """
+    Poll the file until it is complete, yielding the number of new rows whenever there are any.
+
+    The file is polled every interval seconds. With a timeout, following
+    stops once the file hasn't grown for that many seconds.
+    """
+
+    if len(self) != 0:
+      yield len(self)
+    last = time.time()
+    while not self.complete():
+      time.sleep(interval)
+      new = self.poll()
+      if new != 0:
+        last = time.time()
+        yield new
+      elif timeout is not None and time.time() - last >= timeout:
+        return
+
+  def complete(self):
+    """
+    Returns True once every row promised by DataPoints has been read.
+    """
+
+    return "DataPoints" in self.__expected and self.__rows == self.__expected["DataPoints"]
+
+  def progress(self):
+    """
+    Returns the fraction of the rows promised by DataPoints that has been read.
+    """
+
+    if not self.__expected.get("DataPoints"):
+      return 0.
+    return self.__rows / float(self.__expected["DataPoints"])
+
+  def snapshot(self, compact = True):
+    """
+    Returns a StaibDat object of the rows read so far.
+
+    The data is copied, so the object doesn't change as the file grows. The
+    data of a complete file is verified like any StaibDat object; that of an
+    incomplete one isn't, as it would fail the checks against the metadata.
+    """
+
+    if self.datakeys is None:
+      raise FormatError("the datakeys line hasn't been written yet", "structure", [Violation("structure", self.__reader.lineCount, "datakeys", "end of file")])
+    columns = numpy.array(self.__data[:, :self.__rows].T)
+    return StaibDat.fromparts(self.filename, self.metadata, self.datakeys, columns, compact = compact, verify = self.complete(), tolerance = self.tolerances)
+
+  def keys(self):
+    """
+    Returns a list of the keys available so far.
+    """
+
+    keys = ["filename"] + [key for key, entry in self.metadata]
+    if self.datakeys is not None:
+      keys += [datakey.key for datakey in self.datakeys] + ["KE", "BE"] + ["C" + str(indx+1) for indx in range(len(self.datakeys) - 1)]
+    return keys
+
+  def __contains__(self, key):
+    return key in self.keys()
+
+  def __getitem__(self, key):
+    if key == "filename":
+      return self.filename
+    if self.datakeys is not None:
+      if key == "KE":
+        return self.__energy[0, :self.__rows]
+      elif key == "BE":
+        return self.__energy[1, :self.__rows]
+      elif key[:1] == "C" and key[1:].isdigit() and 0 < int(key[1:]) < len(self.datakeys):
+        return self.__data[int(key[1:]), :self.__rows]
+      for indx, datakey in enumerate(self.datakeys):
+        if datakey.key == key:
+          return {"value":self.__data[indx, :self.__rows],
+                  "unit":datakey.unit}
+    return dict(self.metadata)[key]
+
+  def __append(self, rows):
+    """
+    Check new rows of data and append them to the arrays.
+    """
+
+    start = self.__rows
+    stop = start + len(rows)
+    # The arrays hold one contiguous row per datakey, preallocated for DataPoints rows and doubled if the file has more.
+    if stop > self.__data.shape[1]:
+      capacity = max(stop, 2 * self.__data.shape[1], int(self.__expected.get("DataPoints", 0)))
+      data = numpy.empty((rows.shape[1], capacity))
+      energy = numpy.empty((2, capacity))
+      if start != 0:
+        data[:, :start] = self.__data[:, :start]
+        energy[:, :start] = self.__energy[:, :start]
+      self.__data = data
+      self.__energy = energy
+
+    self.__verify(rows[:, 0] / 1000, start)
+    self.__data[:, start:stop] = rows.T
+    self.__energy[0, start:stop] = rows[:, 0] / 1000
+    self.__energy[1, start:stop] = self.__metadata["SourceEnergy"] - self.__energy[0, start:stop]
+    self.__rows = stop
+
+  def __verify(self, energies, start):
+    """
+    Check the kinetic energies of the rows starting at row start against the metadata.
+
+    Only the new rows, and the step from the last row read before them, are
+    looked at. Raises FormatError as StaibDat does.
+    """
+
+    expected = self.__expected
+    tolerances = self.tolerances
+    dataLine = self.lineNumbers["datavalues"]
+    stop = start + len(energies)
+    # Missing or non-numeric metadata is reported with the first rows, and only the checks needing it are skipped.
+    violations = list(self.__metadataViolations) if start == 0 else []
+
+    # Data Points should be at least the number of rows so far.
+    if "DataPoints" in expected and stop > expected["DataPoints"]:
+      violations.append(Violation("datapoints", self.lineNumbers.get("DataPoints"), expected["DataPoints"], stop))
+
+    # The first value of energy should equal Startenergy.
+    if start == 0 and "Startenergy" in expected and abs(expected["Startenergy"] - energies[0]) > tolerances["startenergy"]:
+      violations.append(Violation("startenergy", dataLine, expected["Startenergy"], float(energies[0])))
+
+    # The difference between each Basis value should be consistent, and equal Stepwidth. Without the whole file there is no median step, so the first step is the one the others are compared to.
+    if start != 0:
+      energies = numpy.concatenate([self.__energy[0, start - 1:start], energies])
+    steps = numpy.diff(energies)
+    if self.__step is None and len(steps) != 0:
+      self.__step = float(steps[0])
+      if "Stepwidth" in expected and abs(self.__step - expected["Stepwidth"]) > tolerances["stepwidth"]:
+        violations.append(Violation("stepwidth", self.lineNumbers.get("Stepwidth"), expected["Stepwidth"], self.__step))
+    for indx in numpy.nonzero(numpy.abs(steps - self.__step) > tolerances["stepsize"])[0]:
+      violations.append(Violation("stepsize", dataLine + stop - len(steps) + int(indx), self.__step, float(steps[indx])))
+
+    # Once the file is complete, the last value of energy should equal Stopenergy.
+    if stop == expected.get("DataPoints") and "Stopenergy" in expected and abs(expected["Stopenergy"] - energies[-1]) > tolerances["stopenergy"]:
+      violations.append(Violation("stopenergy", dataLine + stop - 1, expected["Stopenergy"], float(energies[-1])))
+
+    raiseviolations(violations, self.collect)
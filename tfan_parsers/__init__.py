@@ -1,4 +1,68 @@
 # -*- coding: utf-8 -*-
 
-from StaibDat import StaibDat
-from Errors import FormatError
+import importlib
+import sys
+import types
+
+# The public names of the package and the modules defining them. Each is imported the first time it is used, so that importing the package doesn't import numpy or pyparsing, see _LazyModule.
+_EXPORTS = {"StaibDat":"StaibDat",
+            "StaibGrammar":"StaibGrammar",
+            "FormatError":"Errors",
+            "load_many":"Batch",
+            "BatchResult":"Batch",
+            "ParseCache":"ParseCache",
+            "StaibStack":"StaibStack",
+            "MetadataIndex":"MetadataIndex",
+            "read_header":"MetadataIndex",
+            "MappedDat":"MappedDat",
+            "save_npz":"NpzStore",
+            "load_npz":"NpzStore",
+            "ParseStats":"ParseStats",
+            "TailingDat":"TailingDat",
+            "open_dat":"Archives",
+            "iter_archive":"Archives"}
+
+# asyncio is only available on python 3, and multiprocessing.shared_memory on python 3.8 and later.
+if sys.version_info >= (3, 5):
+  _EXPORTS["AsyncLoader"] = "AsyncLoader"
+if sys.version_info >= (3, 8):
+  _EXPORTS["SharedDat"] = "SharedDat"
+
+__all__ = sorted(_EXPORTS)
+
+class _LazyModule(types.ModuleType):
+  """
+  The tfan_parsers package, importing each of its public names on first use.
+
+  A short-lived script that only reads headers, see read_header, shouldn't
+  pay for importing numpy and pyparsing, which take far longer to import than
+  the rest of the package. Accessing a public name of the package imports
+  the module defining it and keeps the name from then on.
+  """
+
+  def __getattr__(self, name):
+    if name not in _EXPORTS:
+      raise AttributeError("module '%s' has no attribute '%s'" % (self.__name__, name))
+    value = getattr(importlib.import_module("." + _EXPORTS[name], self.__name__), name)
+    types.ModuleType.__setattr__(self, name, value)
+    return value
+
+  def __getattribute__(self, name):
+    value = types.ModuleType.__getattribute__(self, name)
+    # Importing a submodule, e.g. tfan_parsers.StaibDat, puts it in the package under its own name, which hides the public name of the same name.
+    if isinstance(value, types.ModuleType) and _EXPORTS.get(name) == name:
+      value = getattr(value, name)
+      types.ModuleType.__setattr__(self, name, value)
+    return value
+
+  def __dir__(self):
+    return sorted(set(self.__dict__) | set(_EXPORTS))
+
+if sys.version_info >= (3, 5):
+  sys.modules[__name__].__class__ = _LazyModule
+else:
+  # Python 2 can't change the class of a module, so the package is replaced by a copy. The original is kept alive, as python 2 clears the globals of a module when it is garbage collected, and _LazyModule still uses them.
+  _module = _LazyModule(__name__)
+  _module.__dict__.update(globals())
+  _module._original = sys.modules[__name__]
+  sys.modules[__name__] = _module